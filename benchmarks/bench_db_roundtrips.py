@@ -0,0 +1,85 @@
+"""Бенчмарк обращений к БД на один завершенный заказ: создание, сохранение ссылки TPay
+и итоговый статус. Сравнивает прежнее обновление (UPDATE, затем SELECT) с UPDATE ... RETURNING
+и с пакетной записью итоговых статусов. Нужен доступ к PostgreSQL из настроек.
+Запуск: python -m benchmarks.bench_db_roundtrips [--orders 200]"""
+
+import argparse
+import asyncio
+import time
+
+import peewee_async
+
+from src.db_infra import db
+from src.db_infra.writer import OrderBatchWriter
+from src.t_payment.models import StatusCode
+
+_statements = 0
+_run_sql = peewee_async._run_sql
+
+
+async def _counting_run_sql(database, operation, *args, **kwargs):
+    """Считаем каждый запрос к БД — это один сетевой round trip"""
+    global _statements
+    _statements += 1
+    return await _run_sql(database, operation, *args, **kwargs)
+
+
+async def _update_then_select(order):
+    """Прежний способ: UPDATE и отдельный SELECT обновленной записи"""
+    await db._get_conn().execute(
+        db.Orders.update(
+            status=order.status,
+            url=order.url,
+            receipt=order.receipt,
+            payment_id=order.payment_id,
+        ).where(db.Orders.id == order.id)
+    )
+    return await db.get_order_by_number(order.id)
+
+
+async def _lifecycle(update, finalize) -> None:
+    order = await db.add_order(
+        amount=1000,
+        customer_key=542570177,
+        description="BENCH ROUNDTRIPS",
+        email="bench@bench",
+        status=StatusCode.created.value,
+    )
+    order.status, order.url, order.payment_id = StatusCode.new.value, "url", "1"
+    order = await update(order)
+    order.status = StatusCode.confirmed.value
+    await finalize(order)
+
+
+async def main(orders: int) -> None:
+    global _statements
+    peewee_async._run_sql = _counting_run_sql
+    writer = OrderBatchWriter()
+
+    modes = (
+        ("UPDATE + SELECT", _update_then_select, _update_then_select),
+        ("UPDATE RETURNING", db.update_order, db.update_order),
+        ("RETURNING + batch", db.update_order, writer.update),
+    )
+    try:
+        for name, update, finalize in modes:
+            _statements = 0
+            started = time.perf_counter()
+            await asyncio.gather(*(_lifecycle(update, finalize) for _ in range(orders)))
+            elapsed = time.perf_counter() - started
+            print(
+                f"{name:<18} round trips per order: {_statements / orders:.2f}, "
+                f"{orders / elapsed:.0f} orders/s"
+            )
+    finally:
+        peewee_async._run_sql = _run_sql
+        await db._get_conn().execute(
+            db.Orders.delete().where(db.Orders.email == "bench@bench")
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--orders", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(main(args.orders))
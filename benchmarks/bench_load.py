@@ -0,0 +1,365 @@
+"""Нагрузочный прогон полного жизненного цикла заказов без сети и без PostgreSQL.
+Каждый заказ проходит тот же путь, что и в боте: создание в БД, Init в TPay, запись ссылки,
+polling-проверка через checker до итогового статуса, отмена неоплаченных и сообщение юзеру.
+TPay — локальный мок со сценариями статусов, задержкой и долей ошибок в отдельном процессе
+(чтобы мок не делил цикл событий с ботом), БД — хранилище в памяти
+с теми же функциями, что и db_infra.db, бот — заглушка, которая запоминает время сообщений.
+Печатает пропускную способность, p50/p99 выдачи ссылки и задержки уведомления после оплаты,
+запросы к TPay на заказ и пиковую память процесса бота (вместе с хранилищем заказов).
+Запуск: python -m benchmarks.bench_load [--orders 1000] [--arrival-rate 200] [--latency 0.02]
+[--error-rate 0.01] [--outage 5 10] [--pay-min 2] [--pay-max 10] [--delay 1] [--max-attempts 20]
+"""
+
+import argparse
+import asyncio
+import collections
+import copy
+import datetime
+import multiprocessing
+import random
+import resource
+import time
+import tracemalloc
+from unittest.mock import patch
+
+from httpx import AsyncClient
+from benchmarks.mock_tpay import MockTPay, Timeline
+from src.config import settings
+from src.db_infra.db import _OPEN_STATUSES
+from src.t_payment.models import Order, StatusCode
+
+from loguru import logger
+
+
+class InMemoryOrders:
+    """Хранилище заказов в памяти вместо PostgreSQL: функции с теми же сигнатурами
+    и поведением, что и в db_infra.db, включая запрет перезаписи итоговых статусов"""
+
+    def __init__(self) -> None:
+        self.orders: dict[str, Order] = {}
+
+    async def add_order(
+        self, amount: int, customer_key: int, description: str, email: str, status: str
+    ) -> Order:
+        order = Order(
+            amount=amount,
+            customer_key=customer_key,
+            email=email,
+            description=description,
+            status=status,
+            created=datetime.datetime.now(),
+        )
+        self.orders[str(order.id)] = order
+        return copy.copy(order)
+
+    def _update(self, order: Order, open_only: bool) -> Order | None:
+        stored = self.orders.get(str(order.id))
+        if stored is None or (open_only and stored.status not in _OPEN_STATUSES):
+            return None
+        stored.status = order.status
+        stored.url = order.url
+        stored.receipt = order.receipt
+        stored.payment_id = order.payment_id
+        return copy.copy(stored)
+
+    async def update_order(self, order: Order) -> Order | None:
+        return self._update(order, open_only=False)
+
+    async def update_orders(
+        self, orders: list[Order], owner: str | None = None
+    ) -> list[Order]:
+        # Один процесс без аренды: владельца заказов не проверяем
+        updated = (self._update(order, open_only=True) for order in orders)
+        return [order for order in updated if order is not None]
+
+    async def save_poll_states(
+        self, orders: list[Order], owner: str | None = None
+    ) -> int:
+        saved = 0
+        for order in orders:
+            stored = self.orders.get(str(order.id))
+            if stored is None or stored.status not in _OPEN_STATUSES:
+                continue
+            stored.poll_attempts = order.poll_attempts
+            stored.next_check_at = order.next_check_at
+            stored.last_tpay_status = order.last_tpay_status
+            stored.last_checked_at = order.last_checked_at
+            saved += 1
+        return saved
+
+    async def get_order_by_number(self, id: str, cached: bool = True) -> Order | None:
+        order = self.orders.get(str(id))
+        return copy.copy(order) if order is not None else None
+
+    async def get_orders_by_ids(self, ids: list[str]) -> list[Order]:
+        return [copy.copy(self.orders[id]) for id in ids if id in self.orders]
+
+
+class _FakeBot:
+    """Бот-заглушка: запоминает, когда каждый юзер получил сообщение об итоге заказа"""
+
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+        self.sent: dict[int, float] = {}
+
+    async def send_message(self, chat_id: int, text: str) -> None:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent[chat_id] = time.monotonic()
+
+
+class _PaymentTimelines:
+    """Сценарии платежей: часть оплачивается через pay_min-pay_max секунд после Init
+    (сначала открывается форма), часть отклоняется банком, остальные не оплачиваются никогда
+    """
+
+    def __init__(
+        self, paid_share: float, rejected_share: float, pay_min: float, pay_max: float
+    ) -> None:
+        self.paid_share = paid_share
+        self.rejected_share = rejected_share
+        self.pay_min = pay_min
+        self.pay_max = pay_max
+        self._random = random.Random(1)
+
+    def __call__(self, payment_id: str) -> Timeline:
+        pay_time = self._random.uniform(self.pay_min, self.pay_max)
+        outcome = self._random.random()
+        if outcome < self.paid_share:
+            return [(pay_time * 0.3, "FORM_SHOWED"), (pay_time, "CONFIRMED")]
+        if outcome < self.paid_share + self.rejected_share:
+            return [(pay_time * 0.3, "FORM_SHOWED"), (pay_time, "REJECTED")]
+        return [(pay_time * 0.3, "FORM_SHOWED")]
+
+
+def _serve_mock(options: dict, timeline: _PaymentTimelines, connection) -> None:
+    """Процесс мока TPay: отдаем родителю адрес и работаем, пока процесс не остановят"""
+
+    async def serve() -> None:
+        mock = MockTPay(timeline=timeline, seed=1, **options)
+        connection.send(await mock.start())
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+async def _order_lifecycle(
+    number: int, arrival: float, store: InMemoryOrders, bot: _FakeBot, results: dict
+) -> None:
+    """Один заказ так, как его проводит хендлер /get_payment: ссылка юзеру и ожидание итога"""
+    from src.db_infra import db
+    from src.polling import checker
+
+    await asyncio.sleep(arrival)
+    started = time.perf_counter()
+    try:
+        order = await db.add_order(
+            amount=1000,
+            customer_key=number,
+            email="bench@bench",
+            description="BENCH LOAD",
+            status=StatusCode.created.value,
+        )
+        try:
+            order = await checker.client.create_order_link(order)
+        except Exception:
+            # Хендлер в этом случае сообщает юзеру, что TPay недоступен
+            results["link_failed"] += 1
+            return
+        order = await db.update_order(order)
+        results["link_latency"].append(time.perf_counter() - started)
+
+        await checker.check_order_status(order, bot)
+    except Exception as e:
+        logger.warning(f"The order {number} failed: {e}")
+        results["failed"] += 1
+
+
+async def main(args: argparse.Namespace) -> None:
+    # Меряем сам жизненный цикл, без вывода логов на каждый заказ
+    logger.remove()
+    if args.trace_memory:
+        tracemalloc.start()
+
+    context = multiprocessing.get_context("spawn")
+    connection, child_connection = context.Pipe()
+    mock_process = context.Process(
+        target=_serve_mock,
+        args=(
+            {
+                "latency": args.latency,
+                "jitter": args.jitter,
+                "error_rate": args.error_rate,
+                "outages": (
+                    [(args.outage[0], args.outage[0] + args.outage[1])]
+                    if args.outage
+                    else None
+                ),
+            },
+            _PaymentTimelines(
+                args.paid_share, args.rejected_share, args.pay_min, args.pay_max
+            ),
+            child_connection,
+        ),
+    )
+    mock_process.start()
+    settings.t_pay.tpay_url = await asyncio.to_thread(connection.recv)
+    # Настройки проверки и ограничителей читаются при создании клиента и планировщика
+    settings.t_pay.polling_policy = args.policy
+    settings.t_pay.delay = args.delay
+    settings.t_pay.max_attempts = args.max_attempts
+    settings.t_pay.polling_workers = args.workers
+    settings.t_pay.mode = "polling"
+    settings.t_pay.leasing = False
+    for prefix in ("", "init_", "get_state_", "cancel_"):
+        setattr(settings.t_pay, f"{prefix}rate_limit", args.rate_limit)
+        setattr(settings.t_pay, f"{prefix}rate_burst", max(1, int(args.rate_limit)))
+        setattr(settings.t_pay, f"{prefix}max_in_flight", args.max_in_flight)
+
+    from src.db_infra import db
+    from src.db_infra.writer import order_writer, poll_state_writer
+    from src.polling import checker
+    from src.t_payment import t_payment
+
+    checker.client = t_payment.TPay(
+        settings.t_pay.tpay_term_key, settings.t_pay.tpay_pass
+    )
+    store = InMemoryOrders()
+    bot = _FakeBot(args.bot_latency)
+    results = {"link_latency": [], "link_failed": 0, "failed": 0}
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    with patch.multiple(
+        db,
+        add_order=store.add_order,
+        update_order=store.update_order,
+        update_orders=store.update_orders,
+        get_order_by_number=store.get_order_by_number,
+        get_orders_by_ids=store.get_orders_by_ids,
+        save_poll_states=store.save_poll_states,
+    ):
+        await checker.client.open()
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(
+                *(
+                    _order_lifecycle(
+                        number,
+                        number / args.arrival_rate if args.arrival_rate else 0,
+                        store,
+                        bot,
+                        results,
+                    )
+                    for number in range(args.orders)
+                )
+            )
+            elapsed = time.perf_counter() - started
+        finally:
+            await checker.stop_scheduler()
+            await order_writer.close()
+            await poll_state_writer.close()
+            await checker.client.close()
+            async with AsyncClient() as http:
+                mock = (await http.get(settings.t_pay.tpay_url + "stats")).json()
+            mock_process.terminate()
+            mock_process.join()
+
+    statuses = collections.Counter(order.status for order in store.orders.values())
+    notify_delays = []
+    for order in store.orders.values():
+        final_at = mock["final_at"].get(str(order.payment_id))
+        if final_at is not None and order.customer_key in bot.sent:
+            notify_delays.append(bot.sent[order.customer_key] - final_at)
+
+    linked = len(results["link_latency"])
+    print(
+        f"Orders: {args.orders} in {elapsed:.1f} s, statuses: {dict(statuses)}, "
+        f"failed to get a link: {results['link_failed']}, failed: {results['failed']}"
+    )
+    print(f"Throughput: {args.orders / elapsed:.1f} orders/s")
+    print(
+        f"Link latency (add_order + Init + update_order): "
+        f"p50={_percentile(results['link_latency'], 0.5) * 1000:.1f} ms "
+        f"p99={_percentile(results['link_latency'], 0.99) * 1000:.1f} ms"
+    )
+    print(
+        f"Notification delay after the final payment status: "
+        f"p50={_percentile(notify_delays, 0.5):.2f} s "
+        f"p99={_percentile(notify_delays, 0.99):.2f} s"
+    )
+    per_endpoint = ", ".join(
+        f"{endpoint} {count / max(linked, 1):.2f}"
+        for endpoint, count in sorted(mock["requests_by_endpoint"].items())
+    )
+    print(
+        f"TPay requests per order: {mock['requests'] / max(linked, 1):.2f} ({per_endpoint}), "
+        f"error responses: {mock['errors']}"
+    )
+    breaker = checker.client.breaker_stats()
+    print(
+        f"Circuit breaker: opened {breaker['opened']} times, "
+        f"{breaker['rejected']} requests rejected while open"
+    )
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    memory = f"Peak RSS: {rss_peak / 1024:.0f} MiB (+{(rss_peak - rss_before) / 1024:.0f} MiB during the run)"
+    if args.trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        memory += f", peak Python heap: {peak / 2**20:.0f} MiB"
+    print(memory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--orders", type=int, default=1000)
+    parser.add_argument(
+        "--arrival-rate",
+        type=float,
+        default=200,
+        help="новых заказов в секунду, 0 — все сразу",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="задержка ответа TPay, с"
+    )
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0.01)
+    parser.add_argument(
+        "--outage",
+        type=float,
+        nargs=2,
+        metavar=("START", "DURATION"),
+        help="TPay полностью недоступен с START по START + DURATION секунду прогона",
+    )
+    parser.add_argument("--paid-share", type=float, default=0.7)
+    parser.add_argument("--rejected-share", type=float, default=0.1)
+    parser.add_argument("--pay-min", type=float, default=2)
+    parser.add_argument("--pay-max", type=float, default=10)
+    parser.add_argument("--policy", choices=("fixed", "adaptive"), default="fixed")
+    parser.add_argument("--delay", type=int, default=1)
+    parser.add_argument("--max-attempts", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=100)
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=0,
+        help="лимит запросов к TPay в секунду, 0 — без ограничения",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=100,
+        help="одновременных запросов к TPay, по умолчанию — размер пула HTTP-соединений",
+    )
+    parser.add_argument("--bot-latency", type=float, default=0.01)
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="дополнительно мерить пик памяти Python через tracemalloc (заметно замедляет прогон)",
+    )
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,120 @@
+"""Бенчмарк стоимости логов на обходе заказов фоновой проверкой: маппинг строк из БД
+и сообщение о проверке каждого заказа. Сравнивает прежние f-строки (форматируются всегда)
+с ленивыми сообщениями при уровнях INFO и DEBUG. Логи пишутся в /dev/null через очередь,
+как в приложении, время — процессорное, вместе с потоком записи логов. БД не нужна.
+Запуск: python -m benchmarks.bench_log_overhead [--orders 20000]"""
+
+import argparse
+import datetime
+import os
+import time
+
+from loguru import logger
+
+from src import log
+from src.db_infra import db
+from src.t_payment.models import Order, StatusCode
+
+
+def _eager_mapping(db_order: db.Orders) -> Order:
+    """Прежний маппинг: многострочное сообщение и repr заказа форматируются до проверки уровня"""
+    logger.debug(
+        f"Mapping an object {db_order}:\n"
+        f"amount: {db_order.amount},\n"
+        f"customer_key={db_order.customer_key},\n"
+        f"email: {db_order.email},\n"
+        f"description: {db_order.description},\n"
+        f"receipt: {db_order.receipt},\n"
+        f"status: {db_order.status},\n"
+        f"id: {db_order.id},\n"
+        f"url: {db_order.url},\n"
+        f"payment_id: {db_order.payment_id},\n"
+        f"created: {db_order.created}.\n"
+    )
+    order = Order(
+        amount=db_order.amount,
+        customer_key=db_order.customer_key,
+        email=db_order.email,
+        description=db_order.description,
+        receipt=db_order.receipt,
+        status=db_order.status,
+        id=db_order.id,
+        url=db_order.url,
+        payment_id=db_order.payment_id,
+        created=db_order.created,
+    )
+    logger.debug(f"The object was mapped successfully: {order}")
+    return order
+
+
+def _eager_sweep(rows: list[db.Orders]) -> None:
+    for attempt, row in enumerate(rows):
+        order = _eager_mapping(row)
+        logger.info(
+            f"Payment {order.payment_id} verification attempt {attempt}: {order.status}"
+        )
+
+
+def _lazy_sweep(rows: list[db.Orders]) -> None:
+    # Текущий путь чтения: строки приходят из БД кортежами и превращаются в заказы без логов на строку
+    values = [
+        tuple(getattr(row, column) for column in db._ORDER_COLUMNS) for row in rows
+    ]
+    for attempt, order in enumerate(db._to_orders(values)):
+        logger.log(
+            "INFO" if log.sample() else "DEBUG",
+            "Payment {} verification attempt {}: {}",
+            order.payment_id,
+            attempt,
+            order.status,
+        )
+
+
+def _rows(count: int) -> list[db.Orders]:
+    created = datetime.datetime.now()
+    return [
+        db.Orders(
+            id=f"00000000-0000-0000-0000-{number:012d}",
+            amount=1000,
+            customer_key=542570177,
+            email="bench@bench",
+            description="BENCH LOGS",
+            # Чек из БД приходит текстом JSON
+            receipt='{"Email": "bench@bench", "Items": []}',
+            status=StatusCode.new.value,
+            url="https://securepay.tinkoff.ru/new/bench",
+            payment_id=str(number),
+            created=created,
+        )
+        for number in range(count)
+    ]
+
+
+def main(orders: int) -> None:
+    rows = _rows(orders)
+    with open(os.devnull, "w") as sink:
+        for level in ("INFO", "DEBUG"):
+            for name, sweep in (
+                ("eager f-strings", _eager_sweep),
+                ("lazy", _lazy_sweep),
+            ):
+                logger.remove()
+                logger.add(sink, level=level, enqueue=True)
+                started_cpu = time.process_time()
+                started = time.perf_counter()
+                sweep(rows)
+                logger.complete()
+                cpu = time.process_time() - started_cpu
+                elapsed = time.perf_counter() - started
+                print(
+                    f"{level:<5} {name:<15} CPU: {cpu * 1000:.0f} ms "
+                    f"({cpu / orders * 1e6:.1f} us per order), wall: {elapsed * 1000:.0f} ms"
+                )
+    logger.remove()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--orders", type=int, default=20000)
+    args = parser.parse_args()
+    main(args.orders)
@@ -0,0 +1,140 @@
+"""Бенчмарк перевода строк из БД в объекты заказов. Сравнивает прежний путь
+(объект модели peewee на каждую строку, затем копирование полей в Order с __dict__)
+с текущим (строки кортежами сразу в слотовый Order). Строки подаются в те же обертки курсора
+peewee, что и при чтении через peewee_async, поэтому БД не нужна.
+Запуск: python -m benchmarks.bench_order_mapping [--rows 1000000]"""
+
+import argparse
+import datetime
+import gc
+import time
+import tracemalloc
+
+import peewee_async
+from loguru import logger
+
+from src.db_infra import db
+from src.t_payment.models import Order, StatusCode
+
+
+class _DictOrder:
+    """Прежний заказ: обычный объект с __dict__"""
+
+    def __init__(
+        self,
+        amount,
+        customer_key,
+        email,
+        description,
+        receipt,
+        status,
+        id,
+        url,
+        payment_id,
+        created,
+    ):
+        self.amount = amount
+        self.customer_key = customer_key
+        self.email = email
+        self.receipt = receipt
+        self.payment_id = payment_id
+        self.description = description
+        self.id = id
+        self.url = url
+        self.status = status
+        self.created = created
+
+
+def _model_path(rows: list[tuple], description: list[tuple]) -> list:
+    """Прежний путь: SELECT * в объекты модели и копирование полей"""
+    wrapper = db.Orders.select()._get_cursor_wrapper(
+        peewee_async.RowsCursor(rows, description)
+    )
+    return [
+        _DictOrder(
+            amount=db_order.amount,
+            customer_key=db_order.customer_key,
+            email=db_order.email,
+            description=db_order.description,
+            receipt=db_order.receipt,
+            status=db_order.status,
+            id=db_order.id,
+            url=db_order.url,
+            payment_id=db_order.payment_id,
+            created=db_order.created,
+        )
+        for db_order in wrapper
+    ]
+
+
+def _tuple_path(rows: list[tuple], description: list[tuple]) -> list:
+    """Текущий путь: колонки заказа кортежами сразу в Order(*row)"""
+    wrapper = db._select_orders()._get_cursor_wrapper(
+        peewee_async.RowsCursor(rows, description)
+    )
+    return [Order(*row) for row in wrapper]
+
+
+def _rows(count: int) -> tuple[list[tuple], list[tuple]]:
+    """Строки так, как их отдает psycopg2: для SELECT * и для колонок заказа"""
+    created = datetime.datetime.now()
+    full_rows, order_rows = [], []
+    for number in range(count):
+        values = {
+            "id": f"00000000-0000-0000-0000-{number:012d}",
+            "amount": 1000,
+            "customer_key": 542570177,
+            "email": "bench@bench",
+            "receipt": None,
+            "description": "BENCH MAPPING",
+            "status": StatusCode.new.value,
+            "url": "https://securepay.tinkoff.ru/new/bench",
+            "payment_id": str(number),
+            "created": created,
+            "poll_attempts": 0,
+            "next_check_at": None,
+            "last_tpay_status": None,
+            "last_checked_at": None,
+        }
+        full_rows.append(
+            tuple(
+                values.get(field.column_name) for field in db.Orders._meta.sorted_fields
+            )
+        )
+        order_rows.append(tuple(values[column] for column in db._ORDER_COLUMNS))
+    return full_rows, order_rows
+
+
+def _measure(name: str, mapping, rows: list[tuple], description: list[tuple]) -> None:
+    gc.collect()
+    started = time.perf_counter()
+    orders = mapping(rows, description)
+    elapsed = time.perf_counter() - started
+    del orders
+
+    gc.collect()
+    tracemalloc.start()
+    orders = mapping(rows, description)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"{name:<22} {len(orders) / elapsed:>9.0f} rows/s, "
+        f"peak memory: {peak / 2**20:.0f} MiB ({peak / len(orders):.0f} bytes per order)"
+    )
+
+
+def main(count: int) -> None:
+    # Меряем сам маппинг, без вывода логов
+    logger.remove()
+    full_rows, order_rows = _rows(count)
+    full_description = [(field.column_name,) for field in db.Orders._meta.sorted_fields]
+    order_description = [(column,) for column in db._ORDER_COLUMNS]
+    _measure("model + dict Order", _model_path, full_rows, full_description)
+    _measure("tuples + slotted Order", _tuple_path, order_rows, order_description)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+    main(args.rows)
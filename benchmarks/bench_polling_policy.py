@@ -0,0 +1,71 @@
+"""Бенчмарк политик polling на смоделированных оплатах: сколько GetState уходит на заказ
+и через сколько после оплаты мы узнаем о ней. Время оплаты — логнормальное распределение,
+часть заказов не оплачивается никогда.
+Запуск: python -m benchmarks.bench_polling_policy [--orders 10000] [--delay 30] [--max-attempts 60]
+"""
+
+import argparse
+import random
+import statistics
+
+from src.polling.policy import AdaptivePolicy, FixedPolicy, PollingPolicy
+
+
+def _simulate(policy: PollingPolicy, latency: float | None) -> tuple[int, float | None]:
+    """Прогоняем один заказ: возвращаем число проверок и задержку уведомления об оплате"""
+    elapsed, attempt = 0.0, 0
+    while True:
+        attempt += 1
+        if latency is not None and elapsed >= latency:
+            return attempt, elapsed - latency
+        delay = policy.next_delay(attempt, elapsed)
+        if delay is None:
+            return attempt, None
+        elapsed += delay
+
+
+def _run(
+    name: str, policy: PollingPolicy, latencies: list[float | None], tune: bool
+) -> None:
+    calls, delays = [], []
+    for latency in latencies:
+        order_calls, notify_delay = _simulate(policy, latency)
+        calls.append(order_calls)
+        if notify_delay is not None:
+            delays.append(notify_delay)
+            if tune:
+                policy.observe(latency)
+    print(
+        f"{name:<18} GetState per order: mean={statistics.mean(calls):.1f} "
+        f"max={max(calls)}; notification delay: median={statistics.median(delays):.1f}s "
+        f"p90={statistics.quantiles(delays, n=10)[-1]:.1f}s"
+    )
+
+
+def main(orders: int, delay: float, max_attempts: int, paid_share: float) -> None:
+    random.seed(1)
+    deadline = delay * max_attempts
+    latencies = [
+        random.lognormvariate(4, 1) if random.random() < paid_share else None
+        for _ in range(orders)
+    ]
+    # Оплаты после дедлайна мы все равно не увидим
+    latencies = [
+        latency if latency is None or latency < deadline else None
+        for latency in latencies
+    ]
+
+    tiers = [(60, 6), (300, 20)]
+    _run("fixed", FixedPolicy(delay, max_attempts), latencies, tune=False)
+    _run("adaptive", AdaptivePolicy(tiers, deadline), latencies, tune=False)
+    _run("adaptive + tuning", AdaptivePolicy(tiers, deadline), latencies, tune=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--orders", type=int, default=10000)
+    parser.add_argument("--delay", type=float, default=30)
+    parser.add_argument("--max-attempts", type=int, default=60)
+    parser.add_argument("--paid-share", type=float, default=0.7)
+    args = parser.parse_args()
+    main(args.orders, args.delay, args.max_attempts, args.paid_share)
@@ -0,0 +1,97 @@
+"""Бенчмарк холодного старта: время импорта src.main в новом интерпретаторе, чтение настроек,
+создание бота и диспетчера контейнером приложения и, с --db, проверка схемы БД на старте:
+один запрос версии через пул против синхронного прогона миграций в отдельном потоке.
+Каждый замер — в отдельном процессе, чтобы модули не были уже импортированы.
+Запуск: python -m benchmarks.bench_startup [--runs 7] [--db]"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+from loguru import logger
+
+# Код замера, который выполняется в новом интерпретаторе и печатает результат в JSON
+_IMPORT = """
+import json, time
+started = time.perf_counter()
+import src.main
+imported = time.perf_counter() - started
+
+from src.config import get_settings
+settings_loaded_on_import = get_settings.cache_info().currsize > 0
+started = time.perf_counter()
+get_settings()
+settings_time = time.perf_counter() - started
+
+from src.app import Application
+started = time.perf_counter()
+app = Application(src.main.register_handlers)
+app.dispatcher
+app_time = time.perf_counter() - started
+print(json.dumps({
+    "import": imported,
+    "settings": settings_time,
+    "settings_on_import": settings_loaded_on_import,
+    "dispatcher": app_time,
+}))
+"""
+
+_SCHEMA = """
+import asyncio, json, time
+from src.app import Application
+from src.db_infra import db, migrations
+
+async def main():
+    await db.connect()
+    started = time.perf_counter()
+    await Application().migrate()
+    check = time.perf_counter() - started
+    started = time.perf_counter()
+    await asyncio.to_thread(migrations.migrate, db.db)
+    migrate = time.perf_counter() - started
+    await db.close()
+    print(json.dumps({"schema_check": check, "migrate": migrate}))
+
+asyncio.run(main())
+"""
+
+
+def _run(code: str) -> dict:
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def _median(samples: list[dict], key: str) -> float:
+    return statistics.median(sample[key] for sample in samples)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=7)
+    parser.add_argument(
+        "--db", action="store_true", help="measure the schema check (needs PostgreSQL)"
+    )
+    args = parser.parse_args()
+
+    samples = [_run(_IMPORT) for _ in range(args.runs)]
+    logger.info(f"import src.main: {_median(samples, 'import') * 1000:.0f} ms")
+    logger.info(
+        f"settings (first access): {_median(samples, 'settings') * 1000:.1f} ms, "
+        f"loaded on import: {samples[0]['settings_on_import']}"
+    )
+    logger.info(f"bot and dispatcher: {_median(samples, 'dispatcher') * 1000:.1f} ms")
+
+    if args.db:
+        samples = [_run(_SCHEMA) for _ in range(args.runs)]
+        logger.info(
+            f"schema check through the pool: {_median(samples, 'schema_check') * 1000:.1f} ms, "
+            f"synchronous migrations in a thread: {_median(samples, 'migrate') * 1000:.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
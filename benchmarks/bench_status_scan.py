@@ -0,0 +1,86 @@
+"""Бенчмарк запроса фоновой проверки (WHERE status = 'NEW') на большой истории заказов.
+Засевает отдельную таблицу с той же схемой, что и Orders, миллионами завершенных заказов
+и небольшим числом открытых, и сравнивает время запроса без индексов и с частичным индексом
+из миграций. Нужен доступ к PostgreSQL из настроек, таблица Orders не затрагивается.
+Запуск: python -m benchmarks.bench_status_scan [--history 2000000] [--open 500] [--runs 20]
+"""
+
+import argparse
+import statistics
+import time
+
+from src.db_infra import db, migrations
+
+_TABLE = "orders_scan_bench"
+_SWEEP = f'SELECT * FROM "{_TABLE}" WHERE "status" = \'NEW\''
+
+
+def _seed(history: int, open_orders: int) -> None:
+    db.db.execute_sql(f'DROP TABLE IF EXISTS "{_TABLE}"')
+    db.db.execute_sql(f'CREATE TABLE "{_TABLE}" (LIKE "Orders" INCLUDING DEFAULTS)')
+    # История: завершенные заказы за последние пару лет
+    db.db.execute_sql(
+        f'INSERT INTO "{_TABLE}" '
+        '("id", "amount", "customer_key", "email", "receipt", "description", '
+        '"status", "url", "payment_id", "created") '
+        "SELECT gen_random_uuid(), 1000, mod(n, 100000), 'bench@bench', NULL, 'BENCH SCAN', "
+        "(ARRAY['CONFIRMED', 'REJECTED', 'CANCELED', 'MAX_ATTEMPTS'])[mod(n, 4) + 1], "
+        "'url', n::text, now() - (n || ' seconds')::interval * 30 "
+        "FROM generate_series(1, %s) AS n",
+        (history,),
+    )
+    # Открытые заказы: созданы только что
+    db.db.execute_sql(
+        f'INSERT INTO "{_TABLE}" '
+        '("id", "amount", "customer_key", "email", "receipt", "description", '
+        '"status", "url", "payment_id", "created") '
+        "SELECT gen_random_uuid(), 1000, n, 'bench@bench', NULL, 'BENCH SCAN', "
+        "(ARRAY['NEW', 'CREATED'])[mod(n, 2) + 1], 'url', (-n)::text, now() "
+        "FROM generate_series(1, %s) AS n",
+        (open_orders,),
+    )
+    db.db.execute_sql(f'ANALYZE "{_TABLE}"')
+
+
+def _measure(name: str, runs: int) -> None:
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        rows = db.db.execute_sql(_SWEEP).fetchall()
+        timings.append((time.perf_counter() - started) * 1000)
+    plan = db.db.execute_sql(f"EXPLAIN {_SWEEP}").fetchone()[0]
+    print(
+        f"{name:<16} rows: {len(rows)}, p50: {statistics.median(timings):.2f} ms, "
+        f"max: {max(timings):.2f} ms, plan: {plan}"
+    )
+
+
+def main(history: int, open_orders: int, runs: int) -> None:
+    migrations.migrate(db.db)
+    with db.db.connection_context():
+        started = time.perf_counter()
+        _seed(history, open_orders)
+        print(
+            f"Seeded {history} historical and {open_orders} open orders "
+            f"in {time.perf_counter() - started:.1f} s"
+        )
+        try:
+            _measure("no indexes", runs)
+            # Тот же частичный индекс, что создает миграция для Orders
+            db.db.execute_sql(
+                f'CREATE INDEX ON "{_TABLE}" ("status", "created", "id") '
+                "WHERE \"status\" IN ('CREATED', 'NEW')"
+            )
+            db.db.execute_sql(f'ANALYZE "{_TABLE}"')
+            _measure("partial index", runs)
+        finally:
+            db.db.execute_sql(f'DROP TABLE IF EXISTS "{_TABLE}"')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--history", type=int, default=2_000_000)
+    parser.add_argument("--open", type=int, default=500)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+    main(args.history, args.open, args.runs)
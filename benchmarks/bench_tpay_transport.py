@@ -0,0 +1,76 @@
+"""Бенчмарк транспорта TPay: одноразовый AsyncClient на каждый запрос против общего пула.
+Запуск: python -m benchmarks.bench_tpay_transport [--calls 500] [--concurrency 50]"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+from src.config import settings
+from src.t_payment import t_payment
+from src.t_payment.models import Endpoints
+from benchmarks.mock_tpay import MockTPay
+
+
+def _percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+async def _measure(send, calls: int, concurrency: int) -> dict:
+    """Гоняем calls запросов GetState с ограничением параллельности, меряем задержку каждого"""
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+    params = {"TerminalKey": "BENCH", "PaymentId": "1", "Token": "bench"}
+
+    async def one_call():
+        async with semaphore:
+            started = time.perf_counter()
+            await send(Endpoints.get_state.value, params)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one_call() for _ in range(calls)))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": _percentile(latencies, 0.99) * 1000,
+        "rps": calls / elapsed,
+    }
+
+
+async def main(calls: int, concurrency: int) -> None:
+    server = MockTPay()
+    settings.t_pay.tpay_url = await server.start()
+    client = t_payment.TPay(settings.t_pay.tpay_term_key, settings.t_pay.tpay_pass)
+
+    async def per_call_client(endpoint, params):
+        return await t_payment._send_request(endpoint, params)
+
+    async def pooled_client(endpoint, params):
+        return await t_payment._send_request(endpoint, params, client._get_http())
+
+    try:
+        async with client:
+            for mode, send in (
+                ("per-call AsyncClient", per_call_client),
+                ("pooled AsyncClient", pooled_client),
+            ):
+                for parallel in (1, concurrency):
+                    result = await _measure(send, calls, parallel)
+                    print(
+                        f"{mode:<22} concurrency={parallel:<4} "
+                        f"p50={result['p50_ms']:.2f}ms p99={result['p99_ms']:.2f}ms "
+                        f"throughput={result['rps']:.0f} req/s"
+                    )
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(main(args.calls, args.concurrency))
@@ -0,0 +1,223 @@
+"""Локальный мок API TPay для бенчмарков: Init, GetState, Cancel и CheckOrder без похода в сеть"""
+
+import asyncio
+import collections
+import itertools
+import random
+import time
+from typing import Callable
+
+from aiohttp import web
+
+# Сценарий платежа: пары «через сколько секунд после Init, какой статус».
+# До первого шага платеж в NEW, статус меняется в момент шага
+Timeline = list[tuple[float, str]]
+
+_FINAL_STATUSES = ("CONFIRMED", "REJECTED", "CANCELED")
+
+
+class MockTPay:
+    """Мок-сервер TPay. Отвечает в формате реального API,
+    latency — искусственная задержка ответа в секундах, jitter — случайная добавка к ней до jitter секунд,
+    error_rate — доля запросов, на которые TPay отвечает ошибкой сервера (HTTP 503),
+    outages — интервалы «с какой по какую секунду после старта мока» полной недоступности: все запросы — 503,
+    confirm_after — после скольких GetState платеж становится CONFIRMED (None — никогда),
+    timeline — сценарий статусов для каждого платежа по его PaymentId, например,
+    [(2, "FORM_SHOWED"), (8, "CONFIRMED")]; если задан, статус зависит от времени, а не от числа проверок
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        confirm_after: int | None = None,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        outages: list[tuple[float, float]] | None = None,
+        timeline: Callable[[str], Timeline] | None = None,
+        seed: int | None = None,
+    ) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.outages = outages or []
+        self._started_at = time.monotonic()
+        self.confirm_after = confirm_after
+        self.timeline = timeline
+        self.requests = 0
+        self.errors = 0
+        self.requests_by_endpoint: collections.Counter = collections.Counter()
+        self.checks: dict[str, int] = {}
+        # Время Init (по time.monotonic(), часы общие для всех процессов) и сценарий каждого платежа
+        self.started: dict[str, float] = {}
+        self.timelines: dict[str, Timeline] = {}
+        self.cancelled: set[str] = set()
+        # Платежи по номеру заказа для CheckOrder
+        self.payments: dict[str, list[str]] = collections.defaultdict(list)
+        self._random = random.Random(seed)
+        self._payment_ids = itertools.count(1)
+        self._runner: web.AppRunner | None = None
+        self.url: str | None = None
+
+        self.app = web.Application()
+        self.app.router.add_post("/Init", self._init)
+        self.app.router.add_post("/GetState", self._get_state)
+        self.app.router.add_post("/Cancel", self._cancel)
+        self.app.router.add_post("/CheckOrder", self._check_order)
+        self.app.router.add_get("/stats", self._stats)
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Запускаем сервер и возвращаем базовый URL для настройки tpay_url"""
+        self._started_at = time.monotonic()
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}/"
+        return self.url
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def stats(self) -> dict:
+        """Счетчики запросов и моменты итоговых статусов платежей по сценарию"""
+        final_at = {
+            payment_id: self.final_at(payment_id) for payment_id in self.started
+        }
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "requests_by_endpoint": dict(self.requests_by_endpoint),
+            "final_at": {
+                payment_id: moment
+                for payment_id, moment in final_at.items()
+                if moment is not None
+            },
+        }
+
+    def final_at(self, payment_id: str) -> float | None:
+        """Когда (по time.monotonic()) платеж по сценарию получает итоговый статус"""
+        payment_id = str(payment_id)
+        if payment_id not in self.started:
+            return None
+        for offset, status in self.timelines.get(payment_id, []):
+            if status in _FINAL_STATUSES:
+                return self.started[payment_id] + offset
+        return None
+
+    def _status(self, payment_id: str) -> str:
+        """Текущий статус платежа по сценарию или по числу проверок"""
+        if payment_id in self.cancelled:
+            return "CANCELED"
+        if self.timeline is not None:
+            # Платеж, созданный в обход мока (например, засеянный сразу в БД), начинается с первой проверки
+            if payment_id not in self.started:
+                self._start(payment_id)
+            elapsed = time.monotonic() - self.started[payment_id]
+            status = "NEW"
+            for offset, step_status in self.timelines[payment_id]:
+                if offset > elapsed:
+                    break
+                status = step_status
+            return status
+        confirmed = (
+            self.confirm_after is not None
+            and self.checks.get(payment_id, 0) >= self.confirm_after
+        )
+        return "CONFIRMED" if confirmed else "NEW"
+
+    def _create(self, order_id: str, payment_id: str) -> None:
+        self.payments[str(order_id)].append(payment_id)
+        self._start(payment_id)
+
+    def _start(self, payment_id: str) -> None:
+        self.started[payment_id] = time.monotonic()
+        if self.timeline is not None:
+            self.timelines[payment_id] = sorted(self.timeline(payment_id))
+
+    async def _stats(self, request: web.Request) -> web.Response:
+        """Счетчики мока для бенчмарков, которые запускают его в отдельном процессе"""
+        return web.json_response(self.stats())
+
+    async def _reply(
+        self, endpoint: str, payload: dict, apply: Callable[[], None] | None = None
+    ) -> web.Response:
+        """Отвечаем с задержкой, иногда — ошибкой. apply — изменение состояния платежа,
+        которое происходит, только если запрос прошел успешно"""
+        self.requests += 1
+        self.requests_by_endpoint[endpoint] += 1
+        latency = self.latency + (self._random.random() * self.jitter)
+        if latency:
+            await asyncio.sleep(latency)
+        uptime = time.monotonic() - self._started_at
+        if any(start <= uptime < end for start, end in self.outages) or (
+            self.error_rate and self._random.random() < self.error_rate
+        ):
+            self.errors += 1
+            return web.Response(status=503, text="Service Unavailable")
+        if apply is not None:
+            apply()
+        return web.json_response({"Success": True, "ErrorCode": "0", **payload})
+
+    async def _init(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        payment_id = str(next(self._payment_ids))
+        return await self._reply(
+            "Init",
+            {
+                "TerminalKey": data.get("TerminalKey"),
+                "Status": "NEW",
+                "PaymentId": payment_id,
+                "OrderId": data.get("OrderId"),
+                "Amount": data.get("Amount"),
+                "PaymentURL": f"{self.url}pay/{payment_id}",
+            },
+            apply=lambda: self._create(data.get("OrderId"), payment_id),
+        )
+
+    async def _get_state(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        payment_id = str(data.get("PaymentId"))
+        self.checks[payment_id] = self.checks.get(payment_id, 0) + 1
+        return await self._reply(
+            "GetState",
+            {
+                "TerminalKey": data.get("TerminalKey"),
+                "Status": self._status(payment_id),
+                "PaymentId": data.get("PaymentId"),
+            },
+        )
+
+    async def _cancel(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        payment_id = str(data.get("PaymentId"))
+        return await self._reply(
+            "Cancel",
+            {
+                "TerminalKey": data.get("TerminalKey"),
+                "Status": "CANCELED",
+                "PaymentId": data.get("PaymentId"),
+            },
+            apply=lambda: self.cancelled.add(payment_id),
+        )
+
+    async def _check_order(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        order_id = str(data.get("OrderId"))
+        return await self._reply(
+            "CheckOrder",
+            {
+                "TerminalKey": data.get("TerminalKey"),
+                "OrderId": order_id,
+                "Payments": [
+                    {
+                        "PaymentId": payment_id,
+                        "Status": self._status(payment_id),
+                        "Success": True,
+                        "ErrorCode": "0",
+                    }
+                    for payment_id in self.payments.get(order_id, [])
+                ],
+            },
+        )
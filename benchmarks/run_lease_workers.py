@@ -0,0 +1,175 @@
+"""Проверка распределения заказов между несколькими процессами в режиме аренды (LEASING).
+Засевает заказы в NEW, поднимает мок TPay (платеж подтверждается на третьей проверке)
+и запускает несколько процессов фоновой проверки на одной PostgreSQL. По желанию убивает
+один процесс посреди работы: его заказы должны перейти к остальным после истечения аренды.
+В конце печатает время, распределение заказов по процессам и повторные уведомления
+(их быть не должно). Нужен доступ к PostgreSQL из настроек.
+Запуск: python -m benchmarks.run_lease_workers [--workers 4] [--orders 300] [--kill-after 3]
+"""
+
+import argparse
+import asyncio
+import collections
+import multiprocessing
+import os
+import queue
+import re
+import sys
+import time
+
+from benchmarks.mock_tpay import MockTPay
+from src.t_payment.models import StatusCode
+
+# Модули приложения читают настройки при импорте, поэтому импортируются внутри функций:
+# процессы проверки задают свои настройки через переменные окружения до импорта
+
+_EMAIL = "bench@bench"
+_PAYMENT_MESSAGE = re.compile(r"The payment (\S+) was")
+
+
+class _QueueBot:
+    """Бот-заглушка: сообщения пользователю уходят в общую очередь родительского процесса"""
+
+    def __init__(self, name: str, messages: multiprocessing.Queue) -> None:
+        self.name = name
+        self.messages = messages
+
+    async def send_message(self, chat_id: int, text: str) -> None:
+        self.messages.put((self.name, text))
+
+
+def _worker(
+    name: str, tpay_url: str, lease_ttl: int, messages: multiprocessing.Queue
+) -> None:
+    """Процесс фоновой проверки. Настройки читаются при импорте,
+    поэтому переменные окружения задаются до импорта модулей приложения"""
+    os.environ.update(
+        TPAY_URL=tpay_url,
+        LEASING="true",
+        WORKER_ID=name,
+        LEASE_TTL=str(lease_ttl),
+        POLLING_POLICY="fixed",
+        DELAY="1",
+        MAX_ATTEMPTS="120",
+        LOGGER_LEVEL="WARNING",
+    )
+    asyncio.run(_run_worker(name, messages))
+
+
+async def _run_worker(name: str, messages: multiprocessing.Queue) -> None:
+    from loguru import logger
+    from src.db_infra import db
+    from src.polling import checker
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    await db.connect()
+    await checker.client.open()
+    await checker.run_checker(_QueueBot(name, messages))
+
+
+async def _seed(orders: int) -> None:
+    """Создаем заказы и переводим их в NEW, как это делает хендлер после Init"""
+    from src.db_infra import db
+
+    created = [
+        await db.add_order(
+            amount=1000,
+            customer_key=542570177,
+            description="BENCH LEASES",
+            email=_EMAIL,
+            status=StatusCode.created.value,
+        )
+        for _ in range(orders)
+    ]
+    for number, order in enumerate(created):
+        order.status = StatusCode.new.value
+        order.payment_id = f"lease-{number}"
+    await db.update_orders(created)
+
+
+async def _open_orders() -> int:
+    from src.db_infra import db
+
+    return await db._get_conn().count(
+        db.Orders.select().where(
+            (db.Orders.email == _EMAIL)
+            & db.Orders.status.in_([StatusCode.created.value, StatusCode.new.value])
+        )
+    )
+
+
+async def main(workers: int, orders: int, kill_after: float, lease_ttl: int) -> None:
+    from src.db_infra import db, migrations
+
+    migrations.migrate(db.db)
+    mock = MockTPay(confirm_after=3)
+    tpay_url = await mock.start()
+    await db.connect()
+    await _seed(orders)
+
+    context = multiprocessing.get_context("spawn")
+    messages = context.Queue()
+    processes = [
+        context.Process(
+            target=_worker, args=(f"worker-{number}", tpay_url, lease_ttl, messages)
+        )
+        for number in range(workers)
+    ]
+    started = time.perf_counter()
+    for process in processes:
+        process.start()
+
+    killed = False
+    try:
+        while await _open_orders():
+            if kill_after and not killed and time.perf_counter() - started > kill_after:
+                # Убиваем процесс без освобождения аренды, как при падении
+                processes[0].kill()
+                killed = True
+                print(f"Killed worker-0 after {kill_after} s")
+            await asyncio.sleep(0.5)
+        elapsed = time.perf_counter() - started
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+        per_worker = collections.Counter()
+        per_order = collections.Counter()
+        while True:
+            try:
+                name, text = messages.get(timeout=0.5)
+            except queue.Empty:
+                break
+            per_worker[name] += 1
+            match = _PAYMENT_MESSAGE.search(text)
+            if match:
+                per_order[match.group(1)] += 1
+
+        await db._get_conn().execute(
+            db.Orders.delete().where(db.Orders.email == _EMAIL)
+        )
+        await db.close()
+        await mock.stop()
+
+    print(
+        f"{workers} workers finalized {orders} orders in {elapsed:.1f} s "
+        f"({orders / elapsed:.1f} orders/s, {mock.requests} TPay requests)"
+    )
+    print(f"Orders per worker: {dict(sorted(per_worker.items()))}")
+    duplicates = {order_id: count for order_id, count in per_order.items() if count > 1}
+    print(f"Orders notified more than once: {len(duplicates)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--orders", type=int, default=300)
+    parser.add_argument(
+        "--kill-after", type=float, default=0, help="убить worker-0 через N секунд"
+    )
+    parser.add_argument("--lease-ttl", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.workers, args.orders, args.kill_after, args.lease_ttl))
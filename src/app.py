@@ -0,0 +1,114 @@
+import asyncio
+import functools
+import time
+from typing import Callable
+
+from aiogram import Bot, Dispatcher
+from src.config import settings
+from src.db_infra import db, migrations
+from src.db_infra.writer import order_writer, poll_state_writer
+from src.metrics import MetricsServer
+from src.polling import checker
+from src.t_payment.notifications import NotificationReceiver
+from src.t_payment.t_payment import TPay
+from src.tg_infra.messages import MessageQueue, message_queue
+
+from loguru import logger
+
+
+class Application:
+    """Контейнер приложения: бот и диспетчер апдейтов, клиент TPay, пул соединений с БД,
+    очередь сообщений юзерам, приемник уведомлений TPay и эндпоинт метрик.
+    Объекты создаются при первом обращении, а соединения открываются только в start(),
+    поэтому импорт модулей и создание контейнера не трогают ни сеть, ни БД.
+
+    register — функция, которая регистрирует хендлеры в диспетчере
+
+    Методы:
+    start() — проверяет схему БД, открывает пулы соединений и запускает фоновые задачи
+    stop() — останавливает фоновые задачи, дописывает накопленное в БД и закрывает пулы
+    """
+
+    def __init__(self, register: Callable[[Dispatcher], None] | None = None) -> None:
+        self._register = register
+        self._checker: asyncio.Task | None = None
+
+    @property
+    def client(self) -> TPay:
+        """Клиент TPay общий с фоновой проверкой: один пул соединений и одни ограничители запросов"""
+        return checker.client
+
+    @property
+    def messages(self) -> MessageQueue:
+        """Сообщения о статусах платежей уходят юзерам через общую очередь с лимитами Telegram"""
+        return message_queue
+
+    @functools.cached_property
+    def bot(self) -> Bot:
+        return Bot(token=settings.tg.tg_token)
+
+    @functools.cached_property
+    def dispatcher(self) -> Dispatcher:
+        dispatcher = Dispatcher(self.bot)
+        if self._register is not None:
+            self._register(dispatcher)
+        return dispatcher
+
+    @functools.cached_property
+    def receiver(self) -> NotificationReceiver:
+        """Приемник уведомлений TPay, работает только в режиме webhook"""
+        return NotificationReceiver(
+            self.client,
+            lambda data: checker.handle_notification(data, self.messages),
+        )
+
+    @functools.cached_property
+    def metrics_server(self) -> MetricsServer:
+        """Эндпоинт метрик для Prometheus"""
+        return MetricsServer()
+
+    async def migrate(self) -> int:
+        """Приводим схему БД к версии, которую ожидает код.
+        Версия схемы проверяется одним запросом через пул: если она уже последняя,
+        синхронные миграции не запускаются"""
+        version = await db.schema_version()
+        if version >= migrations.latest_version():
+            logger.info(f"DB schema is up to date, version {version}")
+            return version
+        # Миграции синхронные, поэтому выполняем их в отдельном потоке, чтобы не блокировать цикл событий
+        return await asyncio.to_thread(migrations.migrate, db.db)
+
+    async def start(self, dispatcher: Dispatcher | None = None) -> None:
+        """Открываем пул соединений с БД и проверяем схему, открываем пул клиента TPay,
+        поднимаем эндпоинт метрик, в режиме webhook — приемник уведомлений,
+        запускаем очередь сообщений и фоновую проверку платежей"""
+        started = time.perf_counter()
+        await db.connect()
+        await self.migrate()
+        await self.client.open()
+        if settings.metrics_enabled:
+            await self.metrics_server.start()
+        if settings.t_pay.mode == "webhook":
+            await self.receiver.start()
+        await self.messages.start(self.bot)
+        self._checker = asyncio.create_task(checker.run_checker(self.messages))
+        logger.info(f"Application started in {time.perf_counter() - started:.3f}s")
+
+    async def stop(self, dispatcher: Dispatcher | None = None) -> None:
+        """Останавливаем приемник уведомлений, эндпоинт метрик, фоновую проверку и планировщик проверок,
+        дописываем в БД накопленные статусы и состояние проверок, только потом отпускаем арендованные заказы,
+        сохраняем неотправленные сообщения и закрываем пулы соединений клиента TPay и БД
+        """
+        await self.receiver.stop()
+        await self.metrics_server.stop()
+        if self._checker is not None:
+            self._checker.cancel()
+            await asyncio.gather(self._checker, return_exceptions=True)
+            self._checker = None
+        await checker.stop_scheduler()
+        await order_writer.close()
+        await poll_state_writer.close()
+        await checker.release_leases()
+        await self.messages.close()
+        await self.client.close()
+        await db.close()
@@ -1,5 +1,10 @@
+import functools
+import os
+import socket
+
+from dotenv import load_dotenv
 from pydantic_settings import BaseSettings, SettingsConfigDict
-from pydantic import Extra
+from pydantic import Extra, Field
 
 
 class BaseSettingsWithConfig(BaseSettings):
@@ -17,6 +22,18 @@ class TgSettings(BaseSettingsWithConfig):
     # Креды Telegram
     tg_token: str
     skip_updates: bool = True
+    # Очередь исходящих сообщений юзерам с лимитами Telegram: не больше message_rate сообщений в секунду всего
+    # и одного в message_chat_interval секунд в один чат, до message_max_in_flight отправок одновременно.
+    # В памяти держится до message_queue_size сообщений, остальные и неотправленные при остановке
+    # сохраняются в БД и отправляются позже. Сетевые ошибки повторяются до message_attempts раз
+    message_rate: float = 30
+    message_chat_interval: float = 1.0
+    message_max_in_flight: int = 10
+    message_queue_size: int = 10000
+    message_attempts: int = 3
+    # Бюджет времени хендлера в секундах: хендлеры дольше попадают в лог предупреждением.
+    # Время всех хендлеров пишется в метрику telegram_handler_seconds
+    handler_latency_budget: float = 2.0
 
 
 class DBSettings(BaseSettingsWithConfig):
@@ -27,6 +44,22 @@ class DBSettings(BaseSettingsWithConfig):
     db_user: str
     db_password: str
     db_host: str
+    # Пул соединений с БД: минимум и максимум соединений и сколько секунд ждать свободное соединение
+    pool_min_connections: int = 1
+    pool_max_connections: int = 10
+    pool_acquire_timeout: float = 10.0
+    # Пакетная запись статусов: изменения копятся batch_window секунд
+    # (или до batch_max_size заказов) и уходят в БД одним UPDATE
+    batch_window: float = 0.05
+    batch_max_size: int = 500
+    # Состояние polling-проверок заказов копится poll_state_window секунд и уходит в БД одним UPDATE
+    poll_state_window: float = 1.0
+    # Кэш заказов в памяти процесса: сколько секунд держать заказ и сколько заказов максимум.
+    # 0 — кэш выключен
+    order_cache_ttl: float = 30.0
+    order_cache_size: int = 10000
+    # Сколько заказов читать из БД за один запрос при обходе заказов по статусу
+    scan_page_size: int = 500
 
 
 class TPaySettings(BaseSettingsWithConfig):
@@ -44,6 +77,97 @@ class TPaySettings(BaseSettingsWithConfig):
     # Итоговое время ожидания платежа = delay * max_attempts
     delay: int
     max_attempts: int
+    # Пул HTTP-соединений к API TPay: один клиент на все запросы, keep-alive между вызовами
+    http_timeout: float = 10.0
+    http_connect_timeout: float = 5.0
+    http_max_connections: int = 100
+    http_max_keepalive_connections: int = 20
+    http_keepalive_expiry: float = 30.0
+    # HTTP/2 работает только при установленном пакете h2 (pip install httpx[http2])
+    http2: bool = False
+    # Планировщик polling-проверок: число воркеров (одновременных GetState) и размер очереди к ним
+    polling_workers: int = 20
+    polling_queue_size: int = 100
+    # Новые заказы приходят из БД через LISTEN/NOTIFY, а полный обход заказов в NEW — только страховка:
+    # раз в reconcile_interval секунд или раз в reconcile_fallback_interval, пока подписка не работает
+    reconcile_interval: int = 60
+    reconcile_fallback_interval: int = 5
+    # Распределение заказов между несколькими процессами: каждый процесс (worker_id) берет заказы
+    # в аренду пачками по lease_batch_size, но не больше lease_max_orders одновременно,
+    # и продлевает аренду, пока проверяет их. Аренда упавшего процесса истекает через lease_ttl секунд,
+    # и его заказы забирают остальные
+    leasing: bool = False
+    worker_id: str = Field(
+        default_factory=lambda: f"{socket.gethostname()}-{os.getpid()}"
+    )
+    lease_ttl: int = 60
+    lease_batch_size: int = 100
+    lease_max_orders: int = 1000
+    # Политика polling: fixed — раз в delay секунд max_attempts раз,
+    # adaptive — часто сразу после выдачи ссылки и все реже потом, в пределах того же delay * max_attempts.
+    # Ступени adaptive — пары «до скольких секунд с начала проверок, с каким интервалом»,
+    # после min_samples оплат они подстраиваются под реальное время оплаты
+    polling_policy: str = "adaptive"
+    polling_tiers: list[tuple[float, float]] = [(60, 6), (300, 20)]
+    polling_jitter: float = 0.1
+    polling_min_interval: float = 1.0
+    polling_max_interval: float = 300.0
+    polling_tune_min_samples: int = 50
+    # Режим получения статусов: polling — только проверки GetState,
+    # webhook — TPay сам присылает уведомления на notification_url, а polling остается страховкой:
+    # проверки раз в safety_net_delay секунд
+    mode: str = "polling"
+    notification_url: str | None = None
+    webhook_host: str = "0.0.0.0"
+    webhook_port: int = 8080
+    webhook_path: str = "/tpay/notifications"
+    safety_net_delay: int = 300
+    # Ограничение запросов к API TPay: токен-бакет (запросов в секунду и размер всплеска)
+    # и максимум одновременных запросов — общие и для каждого эндпоинта. 0 — без ограничения.
+    # При нехватке мест первым проходит Init (пользователь ждет ссылку), затем CheckOrder (проверка Init
+    # без ответа), затем Cancel, затем GetState
+    rate_limit: float = 20
+    rate_burst: int = 20
+    max_in_flight: int = 20
+    init_rate_limit: float = 10
+    init_rate_burst: int = 10
+    init_max_in_flight: int = 10
+    get_state_rate_limit: float = 15
+    get_state_rate_burst: int = 15
+    get_state_max_in_flight: int = 15
+    cancel_rate_limit: float = 5
+    cancel_rate_burst: int = 5
+    cancel_max_in_flight: int = 5
+    check_order_rate_limit: float = 5
+    check_order_rate_burst: int = 5
+    check_order_max_in_flight: int = 5
+    # Повторы запросов к TPay после сетевых ошибок, таймаутов и ответов 5xx/429: попыток на вызов по эндпоинтам
+    # (GetState и так повторяет polling-проверка), пауза перед повтором — случайная от 0 до retry_base_delay * 2^n,
+    # но не больше retry_max_delay, и повтор не начинается позже retry_deadline секунд после первой попытки.
+    # Бюджет повторов эндпоинта: каждый запрос добавляет retry_budget_ratio повтора, копится не больше retry_budget_max.
+    # Init не идемпотентен: его повторяем сразу, только если запрос точно не дошел до TPay (не удалось соединиться,
+    # ответ 429), а после таймаута ответа, обрыва или 5xx — только если CheckOrder не нашел платежа по заказу
+    init_attempts: int = 3
+    get_state_attempts: int = 2
+    cancel_attempts: int = 3
+    check_order_attempts: int = 1
+    retry_base_delay: float = 0.2
+    retry_max_delay: float = 5.0
+    retry_deadline: float = 20.0
+    retry_budget_ratio: float = 0.2
+    retry_budget_max: int = 10
+    # Автомат отключения: после breaker_failures ошибок подряд запросы к TPay не отправляются
+    # breaker_reset_timeout секунд, а фоновые проверки встают на паузу. Затем уходит один пробный запрос:
+    # удачный возвращает обычную работу, неудачный отключает запросы снова на вдвое большее время,
+    # но не больше breaker_max_reset_timeout
+    breaker_failures: int = 5
+    breaker_reset_timeout: float = 5.0
+    breaker_max_reset_timeout: float = 60.0
+    # Повторный /get_payment того же юзера на ту же сумму отдает уже открытый заказ (NEW со ссылкой),
+    # если он создан не раньше open_order_ttl секунд назад, вместо нового заказа и Init.
+    # В памяти процесса держится до open_order_cache_size таких заказов, остальные ищутся в БД
+    open_order_ttl: int = 600
+    open_order_cache_size: int = 10000
 
 
 class Settings(BaseSettingsWithConfig):
@@ -51,10 +175,46 @@ class Settings(BaseSettingsWithConfig):
 
     # Уровень отображения логов
     logger_level: str
+    # Частые сообщения (попытки проверки каждого заказа) пишутся через одно из logger_sample_every,
+    # логи пишутся через очередь в отдельном потоке, не блокируя цикл событий
+    logger_sample_every: int = 10
+    logger_enqueue: bool = True
+    # Метрики в формате Prometheus на локальном HTTP-эндпоинте http://metrics_host:metrics_port/metrics
+    metrics_enabled: bool = True
+    metrics_host: str = "127.0.0.1"
+    metrics_port: int = 9100
+
+    tg: TgSettings = Field(default_factory=TgSettings)
+    db: DBSettings = Field(default_factory=DBSettings)
+    t_pay: TPaySettings = Field(default_factory=TPaySettings)
+
+
+@functools.cache
+def get_settings() -> Settings:
+    """Читаем настройки один раз при первом обращении.
+    .env загружается в переменные окружения (уже заданные переменные важнее файла),
+    поэтому файл читается один раз, а не отдельно для каждого раздела настроек"""
+    config = BaseSettingsWithConfig.model_config
+    load_dotenv(config["env_file"], encoding=config["env_file_encoding"])
+    return Settings(
+        _env_file=None,
+        tg=TgSettings(_env_file=None),
+        db=DBSettings(_env_file=None),
+        t_pay=TPaySettings(_env_file=None),
+    )
+
+
+class _LazySettings:
+    """Настройки, которые читаются при первом обращении к ним, а не при импорте модуля.
+    Чтение и запись атрибутов уходят в общий объект get_settings()"""
+
+    __slots__ = ()
+
+    def __getattr__(self, name: str):
+        return getattr(get_settings(), name)
 
-    tg: TgSettings = TgSettings()
-    db: DBSettings = DBSettings()
-    t_pay: TPaySettings = TPaySettings()
+    def __setattr__(self, name: str, value) -> None:
+        setattr(get_settings(), name, value)
 
 
-settings = Settings()
+settings = _LazySettings()
@@ -0,0 +1,158 @@
+import collections
+import time
+
+from src.config import settings
+from src.t_payment.models import Order
+
+# Место PaymentId в снимке заказа
+_PAYMENT_ID = Order.__slots__.index("payment_id")
+
+
+class OrderCache:
+    """Кэш заказов в памяти процесса: read-through для функций db.py.
+    Заказ ищется по id или по PaymentId, попадает в кэш при каждом чтении и записи
+    и держится ttl секунд; при переполнении вытесняются давно не запрошенные (LRU).
+
+    В кэше лежат не сами заказы, а снимки их полей: вызывающие меняют заказы на месте
+    (например, статус после GetState), и эти изменения не должны попадать к другим читателям,
+    пока их не записали в БД. Каждое обращение отдает новый объект Order.
+
+    Чтение, которое началось до записи заказа, а закончилось после, могло прочитать
+    старую строку. Поэтому запрос берет token() до обращения к БД, и если заказ за это время
+    записали (или две записи разошлись), заказ убирается из кэша и следующее чтение идет в БД.
+
+    Методы:
+    get()/get_by_payment_id() — снимок заказа или None, если его нет или он устарел
+    token() — метка перед запросом в БД, которую передают в put()
+    put() — кладем заказы из ответа БД, write=True — ответ на запись заказа
+    invalidate() — убираем заказ, когда не знаем, что сейчас лежит в БД
+    """
+
+    def __init__(self, ttl: float | None = None, max_size: int | None = None) -> None:
+        # Параметры, которые не передали явно, берутся из настроек в момент использования
+        self._ttl = ttl
+        self._max_size = max_size
+        # id заказа -> (когда снимок устаревает по time.monotonic(), значения полей в порядке Order.__slots__)
+        self._orders: collections.OrderedDict[str, tuple[float, tuple]] = (
+            collections.OrderedDict()
+        )
+        self._payment_ids: dict[str, str] = {}
+        # Номер последней записи каждого заказа: по нему отбрасываются чтения, которые ее обогнали.
+        # Хранятся последние записи в пределах размера кэша
+        self._generation = 0
+        self._written: collections.OrderedDict[str, int] = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def ttl(self) -> float:
+        return settings.db.order_cache_ttl if self._ttl is None else self._ttl
+
+    @property
+    def max_size(self) -> int:
+        return (
+            settings.db.order_cache_size if self._max_size is None else self._max_size
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_size > 0
+
+    def __len__(self) -> int:
+        """Количество заказов в кэше"""
+        return len(self._orders)
+
+    def stats(self) -> dict:
+        """Счетчики: попадания, промахи, вытесненные и сброшенные заказы"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+    def token(self) -> int:
+        return self._generation
+
+    def get(self, id: str) -> Order | None:
+        """Снимок заказа по id"""
+        entry = self._orders.get(str(id))
+        if entry is not None and time.monotonic() >= entry[0]:
+            self._remove(str(id))
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._orders.move_to_end(str(id))
+        return Order(*entry[1])
+
+    def get_by_payment_id(self, payment_id: str) -> Order | None:
+        """Снимок заказа по PaymentId в TPay"""
+        id = self._payment_ids.get(str(payment_id))
+        if id is None:
+            self.misses += 1
+            return None
+        return self.get(id)
+
+    def put(self, orders: list[Order], token: int, write: bool = False) -> None:
+        """Кладем заказы, прочитанные или записанные запросом, который начался на метке token"""
+        if not self.enabled:
+            return
+        expires = time.monotonic() + self.ttl
+        for order in orders:
+            key = str(order.id)
+            if self._written.get(key, 0) > token:
+                # Заказ записали, пока шел запрос: не знаем, какая версия свежее
+                self._remove(key)
+            else:
+                self._store(key, expires, order)
+            if write:
+                self._mark_written(key)
+
+    def invalidate(self, id: str) -> None:
+        """Убираем заказ из кэша, следующее чтение пойдет в БД"""
+        key = str(id)
+        self._mark_written(key)
+        if key in self._orders:
+            self._remove(key)
+            self.invalidations += 1
+
+    def clear(self) -> None:
+        self._orders.clear()
+        self._payment_ids.clear()
+        self._written.clear()
+
+    def _store(self, key: str, expires: float, order: Order) -> None:
+        self._remove(key)
+        self._orders[key] = (
+            expires,
+            tuple(getattr(order, field) for field in Order.__slots__),
+        )
+        if order.payment_id:
+            self._payment_ids[str(order.payment_id)] = key
+        while len(self._orders) > self.max_size:
+            self._remove(next(iter(self._orders)))
+            self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        entry = self._orders.pop(key, None)
+        if entry is None:
+            return
+        payment_id = entry[1][_PAYMENT_ID]
+        if payment_id and self._payment_ids.get(str(payment_id)) == key:
+            del self._payment_ids[str(payment_id)]
+
+    def _mark_written(self, key: str) -> None:
+        self._generation += 1
+        self._written[key] = self._generation
+        self._written.move_to_end(key)
+        while len(self._written) > max(self.max_size, 1):
+            self._written.popitem(last=False)
+
+
+# Общий кэш заказов для всех функций db.py
+order_cache = OrderCache()
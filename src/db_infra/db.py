@@ -1,9 +1,18 @@
+import asyncio
+import time
+from decimal import Decimal
+from typing import AsyncIterator
+
+import aiopg
+import orjson
 import peewee_async
 from peewee import *
-from src.t_payment.models import Order
+from src.t_payment.models import Order, StatusCode
 from datetime import datetime
 from uuid_extensions import uuid7
 from src.config import settings
+from src import metrics
+from src.db_infra.cache import order_cache
 
 from loguru import logger
 
@@ -12,13 +21,107 @@ def _create_uuidv7():
     return uuid7()
 
 
-# Подключение к базе данных PostgreSQL
-db = peewee_async.PostgresqlDatabase(
-    database=settings.db.db_name,
-    user=settings.db.db_user,
-    password=settings.db.db_password,
-    host=settings.db.db_host,
-)
+class _PoolStats:
+    """Счетчики пула соединений: сколько раз брали соединение, сколько сейчас ждут,
+    суммарное и максимальное время ожидания и сколько раз не дождались"""
+
+    def __init__(self) -> None:
+        self.acquires = 0
+        self.waiting = 0
+        self.acquire_time_total = 0.0
+        self.acquire_time_max = 0.0
+        self.timeouts = 0
+
+
+_pool_stats = _PoolStats()
+
+
+class _MeteredPostgresqlConnection(peewee_async.AsyncPostgresqlConnection):
+    """Пул соединений peewee_async с замером ожидания свободного соединения
+    и ограничением этого ожидания по времени"""
+
+    async def acquire(self):
+        _pool_stats.waiting += 1
+        started = time.perf_counter()
+        try:
+            conn = await asyncio.wait_for(
+                self.pool.acquire(), settings.db.pool_acquire_timeout
+            )
+        except asyncio.TimeoutError:
+            _pool_stats.timeouts += 1
+            raise
+        finally:
+            _pool_stats.waiting -= 1
+
+        acquire_time = time.perf_counter() - started
+        _pool_stats.acquires += 1
+        _pool_stats.acquire_time_total += acquire_time
+        _pool_stats.acquire_time_max = max(_pool_stats.acquire_time_max, acquire_time)
+        return conn
+
+
+class _PooledPostgresqlDatabase(peewee_async.PooledPostgresqlDatabase):
+    """Пул соединений, параметры которого берутся из настроек при первом подключении,
+    а не при импорте модуля: импорт не читает настройки и не трогает БД"""
+
+    def init(self, database, **kwargs):
+        super().init(database, **kwargs)
+        self.init_async(conn_cls=_MeteredPostgresqlConnection)
+
+    def configure(self) -> None:
+        if self.deferred:
+            self.init(
+                settings.db.db_name,
+                user=settings.db.db_user,
+                password=settings.db.db_password,
+                host=settings.db.db_host,
+                min_connections=settings.db.pool_min_connections,
+                max_connections=settings.db.pool_max_connections,
+            )
+
+    def connect(self, reuse_if_open=False):
+        self.configure()
+        return super().connect(reuse_if_open)
+
+    async def connect_async(self, loop=None, timeout=None):
+        self.configure()
+        return await super().connect_async(loop, timeout)
+
+
+# Подключение к базе данных PostgreSQL: один пул соединений на все приложение
+db = _PooledPostgresqlDatabase(None)
+
+# Канал LISTEN/NOTIFY, в который триггер публикует id заказов, перешедших в NEW (миграция 3)
+NEW_ORDERS_CHANNEL = "orders_new"
+
+# Незавершенные статусы: заказ еще проверяется, его аренда действует.
+# Тот же набор литералом для сырых запросов; частичный индекс из миграции 2 должен ему соответствовать
+_OPEN_STATUSES = (StatusCode.created.value, StatusCode.new.value)
+_OPEN_STATUSES_SQL = "(" + ", ".join(f"'{status}'" for status in _OPEN_STATUSES) + ")"
+
+# Менеджер запросов поверх пула, создается при первом обращении
+_manager: peewee_async.Manager | None = None
+
+
+def _json_default(value):
+    """Decimal в JSON без потери точности: целое — числом, дробное — строкой"""
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else str(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def _dump_json(value) -> str:
+    return orjson.dumps(value, default=_json_default).decode()
+
+
+class _JSONBField(Field):
+    """Колонка JSONB: пишем текст JSON от orjson, а читаем текстом (колонку выбираем через ::text),
+    чтобы чек разбирался только у тех заказов, где к нему обращаются"""
+
+    field_type = "JSONB"
+
+    def db_value(self, value):
+        return None if value is None else _dump_json(value)
 
 
 class Orders(Model):
@@ -26,52 +129,169 @@ class Orders(Model):
     amount = IntegerField(null=False)
     customer_key = IntegerField(null=False)
     email = TextField(null=False)
-    receipt = TextField(null=True)
+    # Чек в JSONB (миграция 7)
+    receipt = _JSONBField(null=True)
     description = TextField(null=False)
     status = TextField(null=False)
     url = TextField(null=True)
     payment_id = TextField(null=True)
     created = DateTimeField(default=datetime.now, null=False)
+    # Аренда заказа процессом, который его проверяет (миграция 4)
+    lease_owner = TextField(null=True)
+    lease_expires = DateTimeField(null=True)
+    # Состояние polling-проверок заказа (миграция 6)
+    poll_attempts = IntegerField(default=0, null=False)
+    next_check_at = DateTimeField(null=True)
+    last_tpay_status = TextField(null=True)
+    last_checked_at = DateTimeField(null=True)
 
     class Meta:
         database = db
         table_name = "Orders"
 
 
+class Messages(Model):
+    """Недоставленные сообщения юзерам (миграция 5)"""
+
+    id = BigAutoField(primary_key=True)
+    chat_id = BigIntegerField(null=False)
+    text = TextField(null=False)
+    created = DateTimeField(default=datetime.now, null=False)
+
+    class Meta:
+        database = db
+        table_name = "Messages"
+
+
 def _get_conn() -> peewee_async.Manager:
-    return peewee_async.Manager(db)
+    """Отдаем общий менеджер запросов, все функции модуля работают через один пул"""
+    global _manager
+    if _manager is None:
+        _manager = peewee_async.Manager(db)
+    return _manager
 
 
-def _order_mapping(db_order: _get_conn()) -> Order:
-    logger.debug(
-        f"Mapping an object {db_order}:\n"
-        f"amount: {db_order.amount},\n"
-        f"customer_key={db_order.customer_key},\n"
-        f"email: {db_order.email},\n"
-        f"description: {db_order.description},\n"
-        f"receipt: {db_order.receipt},\n"
-        f"status: {db_order.status},\n"
-        f"id: {db_order.id},\n"
-        f"url: {db_order.url},\n"
-        f"payment_id: {db_order.payment_id},\n"
-        f"created: {db_order.created}.\n"
-    )
-
-    order = Order(
-        amount=db_order.amount,
-        customer_key=db_order.customer_key,
-        email=db_order.email,
-        description=db_order.description,
-        receipt=db_order.receipt,
-        status=db_order.status,
-        id=db_order.id,
-        url=db_order.url,
-        payment_id=db_order.payment_id,
-        created=db_order.created,
-    )
-
-    logger.debug(f"The object was mapped successfully: {order}")
-    return order
+async def connect() -> None:
+    """Открываем пул соединений на старте приложения"""
+    await _get_conn().connect()
+    logger.info(
+        f"DB connection pool opened: {settings.db.pool_min_connections}-"
+        f"{settings.db.pool_max_connections} connections"
+    )
+
+
+async def close() -> None:
+    """Закрываем пул соединений при остановке приложения"""
+    await _get_conn().close()
+    logger.info("DB connection pool closed")
+
+
+def pool_stats() -> dict:
+    """Состояние пула соединений: размер, занятые и свободные соединения,
+    ожидающие запросы и время ожидания соединения в секундах"""
+    pool = db._async_conn.pool if db._async_conn is not None else None
+    size = pool.size if pool is not None else 0
+    free = pool.freesize if pool is not None else 0
+    return {
+        "size": size,
+        "in_use": size - free,
+        "free": free,
+        "max": settings.db.pool_max_connections,
+        "waiting": _pool_stats.waiting,
+        "acquires": _pool_stats.acquires,
+        "acquire_time_avg": (
+            _pool_stats.acquire_time_total / _pool_stats.acquires
+            if _pool_stats.acquires
+            else 0.0
+        ),
+        "acquire_time_max": _pool_stats.acquire_time_max,
+        "acquire_timeouts": _pool_stats.timeouts,
+    }
+
+
+def order_cache_stats() -> dict:
+    """Счетчики кэша заказов: размер, попадания, промахи, вытесненные и сброшенные заказы"""
+    return {"size": len(order_cache), **order_cache.stats()}
+
+
+# Состояние пула соединений считается в момент запроса метрик
+for _stat in ("size", "in_use", "free", "waiting", "acquires", "acquire_timeouts"):
+    metrics.GaugeFunc(
+        f"db_pool_{_stat}",
+        f"DB connection pool {_stat.replace('_', ' ')}",
+        lambda stat=_stat: pool_stats()[stat],
+    )
+metrics.GaugeFunc(
+    "db_order_cache",
+    "Order cache: size, hits, misses, evictions and invalidations",
+    lambda: {(name,): value for name, value in order_cache_stats().items()},
+    ("stat",),
+)
+
+
+# Чек читается текстом JSON, его разбирает Order при первом обращении
+_RECEIPT_TEXT = Orders.receipt.cast("text")
+
+# Колонки заказа в порядке аргументов Order: строка из БД сразу превращается в Order(*row),
+# без промежуточного объекта модели peewee
+_ORDER_FIELDS = (
+    Orders.amount,
+    Orders.customer_key,
+    Orders.email,
+    Orders.description,
+    _RECEIPT_TEXT,
+    Orders.status,
+    Orders.id,
+    Orders.url,
+    Orders.payment_id,
+    Orders.created,
+    Orders.poll_attempts,
+    Orders.next_check_at,
+    Orders.last_tpay_status,
+    Orders.last_checked_at,
+)
+# Имена колонок заказа в том же порядке (чек выбирается выражением, у него нет имени колонки)
+_ORDER_COLUMNS = tuple(
+    Orders.receipt.column_name if field is _RECEIPT_TEXT else field.column_name
+    for field in _ORDER_FIELDS
+)
+_ORDER_COLUMNS_SQL = ", ".join(
+    f'o."{column}"::text' if column == Orders.receipt.column_name else f'o."{column}"'
+    for column in _ORDER_COLUMNS
+)
+
+
+# Время и исход каждого вызова функций модуля пишутся в метрики db_query_seconds и db_queries_total
+_timed = metrics.timed(metrics.DB_QUERY_SECONDS, metrics.DB_QUERIES)
+
+
+def _select_orders() -> Select:
+    """SELECT колонок заказа: строки приходят кортежами, а не объектами модели"""
+    return Orders.select(*_ORDER_FIELDS).tuples()
+
+
+def _is_due(due_before: datetime):
+    """Условие на заказы, которые пора проверить до due_before (или которые еще не проверяли)"""
+    return Orders.next_check_at.is_null() | (Orders.next_check_at <= due_before)
+
+
+def _lease_guard(owner: str | None, params: list) -> str:
+    """Условие для пакетной записи в режиме аренды: заказ не арендован или арендован процессом owner.
+    Процесс, чью аренду уже забрали, не перезаписывает заказ нового владельца.
+    Параметр условия добавляется в конец params"""
+    if owner is None:
+        return ""
+    params.append(owner)
+    return "AND (o.lease_owner IS NULL OR o.lease_owner = %s) "
+
+
+def _to_orders(rows) -> list[Order]:
+    """Переводим строки из БД в объекты заказов.
+    Функция вызывается на каждый запрос, поэтому лог формируется, только если включен DEBUG
+    """
+    orders = [Order(*row) for row in rows]
+    logger.debug("Mapped {} orders: {}", len(orders), orders)
+    return orders
 
 
 def create_tables(
@@ -82,67 +302,463 @@ def create_tables(
     logger.info("Tables created")
 
 
+@_timed
+async def schema_version() -> int:
+    """Последняя примененная версия схемы (таблица schema_version из migrations.py) через общий пул.
+    0 — если миграций еще не было"""
+    try:
+        rows = await _get_conn().execute(
+            Orders.raw(
+                'SELECT COALESCE(MAX("version"), 0) FROM "schema_version"'
+            ).tuples()
+        )
+    except ProgrammingError:
+        return 0
+    return list(rows)[0][0]
+
+
+@_timed
 async def get_orders() -> list:
     """Функция для получения всех платежей из БД"""
     elements = list(await _get_conn().execute(Orders.select()))
-    logger.debug(f"Get all of objects from db: {elements}")
+    logger.debug("Got {} objects from db", len(elements))
     return elements
 
 
+@_timed
 async def get_all_orders_by_status(status: str) -> list:
     """Функция для получения всех заказов в статусе NEW"""
-    db_orders = list(
-        await _get_conn().execute(Orders.select().where(Orders.status == status))
+    token = order_cache.token()
+    orders = _to_orders(
+        await _get_conn().execute(_select_orders().where(Orders.status == status))
     )
-    logger.debug(f"Get all of objects by status from db: {db_orders}")
-    orders = [_order_mapping(db_order) for db_order in db_orders]
-    logger.debug(f"Get all of order objects by DB objects: {orders}")
+    order_cache.put(orders, token)
+    logger.debug("Got {} orders by status {}", len(orders), status)
     return orders
 
 
-async def get_order_by_number(id: str) -> Order:
-    """Функция для получения платежа из БД по номеру"""
+async def iter_orders_by_status(
+    status: str, page_size: int | None = None, due_before: datetime | None = None
+) -> AsyncIterator[Order]:
+    """Асинхронный генератор заказов в статусе status в порядке создания.
+    Заказы читаются страницами по page_size с пагинацией по ключу (created, id):
+    каждая страница начинается после последнего заказа предыдущей, поэтому в памяти
+    не больше одной страницы, а обработка начинается сразу после первого запроса.
+    due_before — только заказы, чью следующую проверку пора сделать до этого времени"""
+    page_size = page_size or settings.db.scan_page_size
+    last_key = None
+    while True:
+        query = _select_orders().where(Orders.status == status)
+        if due_before is not None:
+            query = query.where(_is_due(due_before))
+        if last_key is not None:
+            query = query.where(Tuple(Orders.created, Orders.id) > Tuple(*last_key))
+        query = query.order_by(Orders.created, Orders.id).limit(page_size)
+
+        token = order_cache.token()
+        with metrics.measure(
+            metrics.DB_QUERY_SECONDS,
+            metrics.DB_QUERIES,
+            function="iter_orders_by_status",
+        ):
+            rows = await _get_conn().execute(query)
+        orders = _to_orders(rows)
+        order_cache.put(orders, token)
+        logger.debug("Got a page of {} orders by status {}", len(orders), status)
+        for order in orders:
+            yield order
+
+        if len(orders) < page_size:
+            return
+        last_key = (orders[-1].created, orders[-1].id)
+
+
+@_timed
+async def get_orders_by_ids(ids: list[str]) -> list[Order]:
+    """Функция для получения пачки заказов по номерам одним запросом.
+    Заказы из кэша в запрос не попадают"""
+    orders = []
+    missing = []
+    for id in ids:
+        order = order_cache.get(id)
+        if order is not None:
+            orders.append(order)
+        else:
+            missing.append(id)
+    if not missing:
+        return orders
+    token = order_cache.token()
+    db_orders = _to_orders(
+        await _get_conn().execute(_select_orders().where(Orders.id.in_(missing)))
+    )
+    order_cache.put(db_orders, token)
+    return orders + db_orders
+
+
+async def listen_new_orders() -> AsyncIterator[list[str]]:
+    """Асинхронный генератор id заказов, которые перешли в NEW.
+    Подписка держится на отдельном соединении, а не на соединении из пула: LISTEN действует,
+    пока соединение открыто. Первой отдается пустая пачка — знак, что подписка оформлена,
+    дальше уведомления, накопившиеся к моменту чтения, отдаются одной пачкой.
+    Если соединение оборвалось, генератор завершается исключением — переподключается вызывающий
+    """
+    conn = await aiopg.connect(
+        database=settings.db.db_name,
+        user=settings.db.db_user,
+        password=settings.db.db_password,
+        host=settings.db.db_host,
+    )
     try:
-        order_db = await _get_conn().get(Orders, id=id)
-        logger.debug(f"Get order from db: {order_db.id}")
-        return _order_mapping(order_db)
+        async with conn.cursor() as cursor:
+            await cursor.execute(f'LISTEN "{NEW_ORDERS_CHANNEL}"')
+        logger.info(f"Listening to the DB channel {NEW_ORDERS_CHANNEL}")
+        yield []
+
+        while True:
+            order_ids = [(await conn.notifies.get()).payload]
+            while not conn.notifies.empty():
+                order_ids.append(conn.notifies.get_nowait().payload)
+            yield order_ids
+    finally:
+        await conn.close()
+
+
+@_timed
+async def get_order_by_number(id: str, cached: bool = True) -> Order:
+    """Функция для получения платежа из БД по номеру. Сначала заказ ищется в кэше.
+    cached=False — читаем из БД: кэш у каждого процесса свой, и заказ, который завершил
+    другой процесс, в нем может быть еще незавершенным. Прочитанный заказ обновляет кэш
+    """
+    order = order_cache.get(id) if cached else None
+    if order is not None:
+        return order
+    try:
+        token = order_cache.token()
+        orders = _to_orders(
+            await _get_conn().execute(_select_orders().where(Orders.id == id).limit(1))
+        )
+        order_cache.put(orders, token)
+        logger.debug("Get order from db: {}", id)
+        return orders[0] if orders else None
     except Exception as e:
         logger.debug(f"Something went wrong: {e}")
 
 
+@_timed
+async def get_order_by_payment_id(payment_id: str) -> Order | None:
+    """Функция для получения платежа по PaymentId в TPay. Сначала заказ ищется в кэше"""
+    order = order_cache.get_by_payment_id(payment_id)
+    if order is not None:
+        return order
+    token = order_cache.token()
+    orders = _to_orders(
+        await _get_conn().execute(
+            _select_orders().where(Orders.payment_id == str(payment_id)).limit(1)
+        )
+    )
+    order_cache.put(orders, token)
+    return orders[0] if orders else None
+
+
+@_timed
+async def get_open_order(
+    customer_key: int, amount: int, created_after: datetime
+) -> Order | None:
+    """Последний заказ юзера на сумму amount в NEW со ссылкой на оплату, созданный после created_after"""
+    token = order_cache.token()
+    orders = _to_orders(
+        await _get_conn().execute(
+            _select_orders()
+            .where(
+                Orders.customer_key == customer_key,
+                Orders.amount == amount,
+                Orders.status == StatusCode.new.value,
+                Orders.url.is_null(False),
+                Orders.created > created_after,
+            )
+            .order_by(Orders.created.desc())
+            .limit(1)
+        )
+    )
+    order_cache.put(orders, token)
+    return orders[0] if orders else None
+
+
+@_timed
 async def add_order(
     amount: int, customer_key: int, description: str, email: str, status: str
 ) -> Order:
-    """Функция для создания нового платежа в БД"""
-    new_db_order = await _get_conn().create(
-        Orders,
-        amount=amount,
-        customer_key=customer_key,
-        email=email,
-        description=description,
-        status=status,
+    """Функция для создания нового платежа в БД.
+    Созданная запись возвращается тем же запросом (INSERT ... RETURNING)"""
+    token = order_cache.token()
+    db_orders = await _get_conn().execute(
+        Orders.insert(
+            amount=amount,
+            customer_key=customer_key,
+            email=email,
+            description=description,
+            status=status,
+        )
+        .returning(*_ORDER_FIELDS)
+        .tuples()
     )
-    return _order_mapping(new_db_order)
+    orders = _to_orders(db_orders)
+    order_cache.put(orders, token, write=True)
+    return orders[0]
 
 
+@_timed
 async def update_order(order: Order) -> Order:
-    """Функция для обновления платежа в БД"""
+    """Функция для обновления платежа в БД.
+    Обновленная запись возвращается тем же запросом (UPDATE ... RETURNING), без повторного чтения,
+    и сразу заменяет заказ в кэше. Чек пишется, только если его заменили
+    """
 
-    logger.debug(f"Updating the order in the database. The order: {order}")
+    logger.debug("Updating the order in the database. The order: {}", order)
+    fields = {
+        "status": order.status,
+        "url": order.url,
+        "payment_id": order.payment_id,
+    }
+    if order.receipt_changed:
+        fields["receipt"] = order.receipt
+    if order.status not in _OPEN_STATUSES:
+        # Заказ завершен — освобождаем его аренду
+        fields.update(lease_owner=None, lease_expires=None)
+    token = order_cache.token()
     try:
-        result = await _get_conn().execute(
-            Orders.update(
-                status=order.status,
-                url=order.url,
-                receipt=str(order.receipt),
-                payment_id=order.payment_id,
-            ).where(Orders.id == order.id)
+        db_orders = list(
+            await _get_conn().execute(
+                Orders.update(**fields)
+                .where(Orders.id == order.id)
+                .returning(*_ORDER_FIELDS)
+                .tuples()
+            )
         )
-        logger.debug(f"Result of the payment {order.id} update: {result}")
     except Exception as e:
         logger.warning(f"Error updating the payment {order.id} in the database: {e}")
+        # Отдаем то, что сейчас лежит в БД, а не в кэше
+        order_cache.invalidate(order.id)
+        return await get_order_by_number(order.id, cached=False)
+
+    if not db_orders:
+        logger.debug(f"The order {order.id} not found in the database")
+        order_cache.invalidate(order.id)
+        return None
+    order.receipt_changed = False
+    updated_orders = _to_orders(db_orders)
+    order_cache.put(updated_orders, token, write=True)
+    return updated_orders[0]
+
+
+@_timed
+async def update_orders(orders: list[Order], owner: str | None = None) -> list[Order]:
+    """Функция для обновления пачки платежей в БД одним запросом UPDATE ... FROM (VALUES ...).
+    Итоговый статус окончательный: заказы, которые уже завершены (например, другим процессом),
+    не перезаписываются и не попадают в результат. У завершенных заказов освобождается аренда.
+    owner — в режиме аренды: заказы, которые арендует другой процесс, не перезаписываются.
+    Возвращает обновленные заказы в том виде, в каком они сохранились в БД.
+    Чек пишется только у заказов, где его заменили (в том числе на None), у остальных остается прежний.
+    Обновленные заказы заменяются в кэше, а не обновленные из него убираются"""
+    if not orders:
+        return []
+
+    values = ", ".join(
+        ["(%s::uuid, %s::text, %s::text, %s::boolean, %s::jsonb, %s::text)"]
+        * len(orders)
+    )
+    params = []
+    for order in orders:
+        params += [
+            str(order.id),
+            order.status,
+            order.url,
+            order.receipt_changed,
+            (
+                _dump_json(order.receipt)
+                if order.receipt_changed and order.receipt is not None
+                else None
+            ),
+            order.payment_id,
+        ]
+
+    lease_guard = _lease_guard(owner, params)
+    query = Orders.raw(
+        f'UPDATE "{Orders._meta.table_name}" AS o '
+        f"SET status = v.status, url = v.url, "
+        f"receipt = CASE WHEN v.receipt_changed THEN v.receipt ELSE o.receipt END, "
+        f"payment_id = v.payment_id, "
+        f"lease_owner = CASE WHEN v.status IN {_OPEN_STATUSES_SQL} THEN o.lease_owner END, "
+        f"lease_expires = CASE WHEN v.status IN {_OPEN_STATUSES_SQL} THEN o.lease_expires END "
+        f"FROM (VALUES {values}) AS v(id, status, url, receipt_changed, receipt, payment_id) "
+        f"WHERE o.id = v.id AND o.status IN {_OPEN_STATUSES_SQL} {lease_guard}"
+        f"RETURNING {_ORDER_COLUMNS_SQL}",
+        *params,
+    ).tuples()
+    token = order_cache.token()
+    try:
+        updated_orders = _to_orders(await _get_conn().execute(query))
+    except Exception:
+        for order in orders:
+            order_cache.invalidate(order.id)
+        raise
+    order_cache.put(updated_orders, token, write=True)
+    updated_ids = {str(order.id) for order in updated_orders}
+    for order in orders:
+        if str(order.id) in updated_ids:
+            order.receipt_changed = False
+        else:
+            order_cache.invalidate(order.id)
+    logger.debug(
+        "Batch update of {} orders, updated: {}", len(orders), len(updated_orders)
+    )
+    return updated_orders
+
+
+@_timed
+async def claim_orders(
+    owner: str, limit: int, ttl: int, due_before: datetime | None = None
+) -> list[Order]:
+    """Берем в аренду до limit заказов в NEW, которые никто не проверяет или чья аренда истекла.
+    FOR UPDATE SKIP LOCKED: несколько процессов разбирают заказы параллельно
+    и не ждут друг друга на строках, которые прямо сейчас забирает другой.
+    due_before — только заказы, чью следующую проверку пора сделать до этого времени"""
+    table = Orders._meta.table_name
+    due = ""
+    params = [owner, ttl, StatusCode.new.value]
+    if due_before is not None:
+        due = "AND (next_check_at IS NULL OR next_check_at <= %s) "
+        params.append(due_before)
+    query = Orders.raw(
+        f'UPDATE "{table}" AS o '
+        f"SET lease_owner = %s, lease_expires = LOCALTIMESTAMP + %s * INTERVAL '1 second' "
+        f'FROM (SELECT id FROM "{table}" '
+        f"WHERE status = %s AND (lease_expires IS NULL OR lease_expires < LOCALTIMESTAMP) {due}"
+        f"ORDER BY created, id LIMIT %s FOR UPDATE SKIP LOCKED) AS c "
+        f"WHERE o.id = c.id RETURNING {_ORDER_COLUMNS_SQL}",
+        *params,
+        limit,
+    ).tuples()
+    token = order_cache.token()
+    orders = _to_orders(await _get_conn().execute(query))
+    order_cache.put(orders, token)
+    logger.debug("The worker {} claimed {} orders", owner, len(orders))
+    return orders
+
+
+@_timed
+async def save_poll_states(orders: list[Order], owner: str | None = None) -> int:
+    """Сохраняем состояние polling-проверок пачки заказов одним запросом UPDATE ... FROM (VALUES ...):
+    число попыток, время следующей проверки, последний статус в TPay и время последней проверки.
+    Завершенные заказы и, если передан owner, заказы, которые арендует другой процесс, не трогаем.
+    Возвращает количество обновленных заказов"""
+    if not orders:
+        return 0
+
+    values = ", ".join(
+        ["(%s::uuid, %s::integer, %s::timestamp, %s::text, %s::timestamp)"]
+        * len(orders)
+    )
+    params = []
+    for order in orders:
+        params += [
+            str(order.id),
+            order.poll_attempts,
+            order.next_check_at,
+            order.last_tpay_status,
+            order.last_checked_at,
+        ]
+
+    lease_guard = _lease_guard(owner, params)
+    query = Orders.raw(
+        f'UPDATE "{Orders._meta.table_name}" AS o '
+        f"SET poll_attempts = v.poll_attempts, next_check_at = v.next_check_at, "
+        f"last_tpay_status = v.last_tpay_status, last_checked_at = v.last_checked_at "
+        f"FROM (VALUES {values}) "
+        f"AS v(id, poll_attempts, next_check_at, last_tpay_status, last_checked_at) "
+        f"WHERE o.id = v.id AND o.status IN {_OPEN_STATUSES_SQL} {lease_guard}"
+        f"RETURNING {_ORDER_COLUMNS_SQL}",
+        *params,
+    ).tuples()
+    token = order_cache.token()
+    updated_orders = _to_orders(await _get_conn().execute(query))
+    order_cache.put(updated_orders, token, write=True)
+    logger.debug(
+        "Saved the polling state of {} orders, updated: {}",
+        len(orders),
+        len(updated_orders),
+    )
+    return len(updated_orders)
+
+
+@_timed
+async def claim_order(id: str, owner: str, ttl: int, force: bool = False) -> bool:
+    """Берем в аренду конкретный незавершенный заказ. False — его уже проверяет другой процесс.
+    force — забираем аренду и у другого процесса (уведомление TPay с итоговым статусом):
+    его записи по заказу после этого не проходят, а продление аренды снимает заказ с его проверок
+    """
+    condition = (Orders.id == id) & Orders.status.in_(_OPEN_STATUSES)
+    if not force:
+        condition &= (
+            Orders.lease_owner.is_null()
+            | (Orders.lease_owner == owner)
+            | (Orders.lease_expires < SQL("LOCALTIMESTAMP"))
+        )
+    updated = await _get_conn().execute(
+        Orders.update(
+            lease_owner=owner,
+            lease_expires=SQL("LOCALTIMESTAMP + %s * INTERVAL '1 second'", [ttl]),
+        ).where(condition)
+    )
+    return updated > 0
+
+
+@_timed
+async def renew_leases(owner: str, ttl: int) -> set[str]:
+    """Продлеваем аренду всех незавершенных заказов процесса одним запросом.
+    Возвращаем id заказов, которые все еще за ним"""
+    query = Orders.raw(
+        f'UPDATE "{Orders._meta.table_name}" '
+        f"SET lease_expires = LOCALTIMESTAMP + %s * INTERVAL '1 second' "
+        f"WHERE lease_owner = %s AND status IN {_OPEN_STATUSES_SQL} RETURNING id",
+        ttl,
+        owner,
+    )
+    return {str(db_order.id) for db_order in await _get_conn().execute(query)}
+
+
+@_timed
+async def release_leases(owner: str) -> int:
+    """Освобождаем все аренды процесса (при остановке), чтобы другие забрали заказы сразу"""
+    released = await _get_conn().execute(
+        Orders.update(lease_owner=None, lease_expires=None).where(
+            Orders.lease_owner == owner
+        )
+    )
+    logger.info(f"The worker {owner} released {released} order leases")
+    return released
+
+
+@_timed
+async def save_messages(messages: list[tuple[int, str]]) -> int:
+    """Сохраняем недоставленные сообщения (chat_id, text) одним запросом"""
+    if not messages:
+        return 0
+    await _get_conn().execute(
+        Messages.insert_many(messages, fields=[Messages.chat_id, Messages.text])
+    )
+    return len(messages)
+
 
-    logger.debug(f"Searching the order in the database: {order}")
-    updated_db_object = await get_order_by_number(order.id)
-    logger.debug(f"Updated order: {updated_db_object}")
-    return updated_db_object
+@_timed
+async def take_messages(limit: int) -> list[tuple[int, str]]:
+    """Забираем до limit сохраненных сообщений в порядке сохранения и удаляем их из БД.
+    Строки, которые прямо сейчас забирает другой процесс, пропускаются (SKIP LOCKED)"""
+    query = Messages.raw(
+        'DELETE FROM "Messages" WHERE "id" IN ('
+        'SELECT "id" FROM "Messages" ORDER BY "id" LIMIT %s FOR UPDATE SKIP LOCKED) '
+        'RETURNING "id", "chat_id", "text"',
+        limit,
+    ).tuples()
+    rows = sorted(await _get_conn().execute(query))
+    return [(chat_id, text) for _, chat_id, text in rows]
@@ -0,0 +1,268 @@
+"""Версионные миграции схемы БД.
+Каждый шаг — функция с номером версии. Примененные версии записываются в таблицу schema_version,
+поэтому на старте выполняются только новые шаги, а повторный запуск ничего не меняет.
+Шаги с CREATE INDEX CONCURRENTLY не строят индекс под блокировкой записи, но не могут идти
+в транзакции, поэтому такие шаги написаны так, чтобы их можно было безопасно повторить
+"""
+
+import ast
+import json
+from typing import Callable
+
+from peewee import Database
+
+from loguru import logger
+
+# Ключ advisory-блокировки: миграции из нескольких процессов выполняются по очереди
+_LOCK_KEY = 7_302_511
+
+_VERSION_TABLE = "schema_version"
+
+
+class Migration:
+    """Шаг миграции: версия, описание и функция, которая меняет схему.
+    transactional=False — шаг выполняется вне транзакции (нужно для CONCURRENTLY)"""
+
+    def __init__(
+        self,
+        version: int,
+        name: str,
+        apply: Callable[[Database], None],
+        transactional: bool = True,
+    ) -> None:
+        self.version = version
+        self.name = name
+        self.apply = apply
+        self.transactional = transactional
+
+
+MIGRATIONS: list[Migration] = []
+
+
+def migration(version: int, name: str, transactional: bool = True):
+    """Регистрируем функцию как шаг миграции"""
+
+    def register(apply: Callable[[Database], None]) -> Callable[[Database], None]:
+        MIGRATIONS.append(Migration(version, name, apply, transactional))
+        MIGRATIONS.sort(key=lambda step: step.version)
+        return apply
+
+    return register
+
+
+def _create_index_concurrently(database: Database, name: str, definition: str) -> None:
+    """Создаем индекс без блокировки записи в таблицу.
+    Если прошлая попытка прервалась, от нее остается невалидный индекс — удаляем его и строим заново
+    """
+    cursor = database.execute_sql(
+        "SELECT i.indisvalid FROM pg_index i "
+        "JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = %s",
+        (name,),
+    )
+    row = cursor.fetchone()
+    if row is not None and not row[0]:
+        logger.warning(
+            f"Dropping the invalid index {name} left by an interrupted build"
+        )
+        database.execute_sql(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+    database.execute_sql(
+        f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{name}" {definition}'
+    )
+
+
+@migration(1, "create Orders")
+def _create_orders(database: Database) -> None:
+    database.execute_sql(
+        'CREATE TABLE IF NOT EXISTS "Orders" ('
+        '"id" UUID NOT NULL PRIMARY KEY, '
+        '"amount" INTEGER NOT NULL, '
+        '"customer_key" INTEGER NOT NULL, '
+        '"email" TEXT NOT NULL, '
+        '"receipt" TEXT, '
+        '"description" TEXT NOT NULL, '
+        '"status" TEXT NOT NULL, '
+        '"url" TEXT, '
+        '"payment_id" TEXT, '
+        '"created" TIMESTAMP NOT NULL)'
+    )
+
+
+@migration(2, "indexes for status scans and lookups", transactional=False)
+def _create_order_indexes(database: Database) -> None:
+    # Частичный индекс только по незавершенным заказам: его размер и время сканирования
+    # зависят от числа открытых заказов, а не от всей истории.
+    # Условие индекса должно совпадать с db._OPEN_STATUSES: иначе запросы по открытым заказам его не используют.
+    # Миграция уже применена, поэтому при изменении набора статусов индекс пересоздает новая миграция
+    _create_index_concurrently(
+        database,
+        "orders_open_status_idx",
+        """ON "Orders" ("status", "created", "id") WHERE "status" IN ('CREATED', 'NEW')""",
+    )
+    _create_index_concurrently(
+        database, "orders_payment_id_idx", 'ON "Orders" ("payment_id")'
+    )
+    _create_index_concurrently(
+        database, "orders_customer_key_idx", 'ON "Orders" ("customer_key")'
+    )
+
+
+@migration(3, "notify about orders entering NEW")
+def _notify_new_orders(database: Database) -> None:
+    # Заказ вошел в NEW — публикуем его id в канал orders_new (уйдет после коммита транзакции)
+    database.execute_sql(
+        "CREATE OR REPLACE FUNCTION orders_notify_new() RETURNS trigger AS $$ "
+        "BEGIN PERFORM pg_notify('orders_new', NEW.id::text); RETURN NULL; END; "
+        "$$ LANGUAGE plpgsql"
+    )
+    database.execute_sql('DROP TRIGGER IF EXISTS orders_new_insert ON "Orders"')
+    database.execute_sql(
+        'CREATE TRIGGER orders_new_insert AFTER INSERT ON "Orders" FOR EACH ROW '
+        "WHEN (NEW.status = 'NEW') EXECUTE FUNCTION orders_notify_new()"
+    )
+    database.execute_sql('DROP TRIGGER IF EXISTS orders_new_update ON "Orders"')
+    database.execute_sql(
+        'CREATE TRIGGER orders_new_update AFTER UPDATE OF status ON "Orders" FOR EACH ROW '
+        "WHEN (NEW.status = 'NEW' AND OLD.status IS DISTINCT FROM NEW.status) "
+        "EXECUTE FUNCTION orders_notify_new()"
+    )
+
+
+@migration(4, "order leases for distributed polling")
+def _add_order_leases(database: Database) -> None:
+    # Какой процесс проверяет заказ и до какого времени
+    database.execute_sql(
+        'ALTER TABLE "Orders" ADD COLUMN IF NOT EXISTS "lease_owner" TEXT'
+    )
+    database.execute_sql(
+        'ALTER TABLE "Orders" ADD COLUMN IF NOT EXISTS "lease_expires" TIMESTAMP'
+    )
+
+
+@migration(5, "outbox of undelivered Telegram messages")
+def _create_messages(database: Database) -> None:
+    # Сообщения юзерам, которые не успели отправить (переполнение очереди, остановка процесса)
+    database.execute_sql(
+        'CREATE TABLE IF NOT EXISTS "Messages" ('
+        '"id" BIGSERIAL NOT NULL PRIMARY KEY, '
+        '"chat_id" BIGINT NOT NULL, '
+        '"text" TEXT NOT NULL, '
+        '"created" TIMESTAMP NOT NULL DEFAULT LOCALTIMESTAMP)'
+    )
+
+
+@migration(6, "polling state of orders")
+def _add_poll_state(database: Database) -> None:
+    # Сколько проверок сделано, когда следующая и что ответил TPay в последний раз:
+    # после перезапуска проверки продолжаются с того же места, а не с первой попытки
+    database.execute_sql(
+        'ALTER TABLE "Orders" ADD COLUMN IF NOT EXISTS "poll_attempts" INTEGER NOT NULL DEFAULT 0'
+    )
+    database.execute_sql(
+        'ALTER TABLE "Orders" ADD COLUMN IF NOT EXISTS "next_check_at" TIMESTAMP'
+    )
+    database.execute_sql(
+        'ALTER TABLE "Orders" ADD COLUMN IF NOT EXISTS "last_tpay_status" TEXT'
+    )
+    database.execute_sql(
+        'ALTER TABLE "Orders" ADD COLUMN IF NOT EXISTS "last_checked_at" TIMESTAMP'
+    )
+
+
+def _receipt_to_json(text: str | None) -> str | None:
+    """Чек, который раньше писался в TEXT через str(dict), переводим в текст JSON.
+    Пустой чек ('None') становится NULL, а текст, который не разбирается, сохраняется строкой JSON
+    """
+    if text is None or text in ("", "None"):
+        return None
+    try:
+        value = ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        try:
+            value = json.loads(text)
+        except ValueError:
+            logger.warning(f"Keeping the unparsable receipt as a JSON string: {text!r}")
+            value = text
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+@migration(7, "JSONB receipts")
+def _convert_receipts(database: Database) -> None:
+    # Чеки переносим в новую колонку пачками по id, затем она занимает место старой
+    database.execute_sql(
+        'ALTER TABLE "Orders" ADD COLUMN IF NOT EXISTS "receipt_json" JSONB'
+    )
+    last_id = "00000000-0000-0000-0000-000000000000"
+    while True:
+        rows = database.execute_sql(
+            'SELECT "id", "receipt" FROM "Orders" '
+            'WHERE "receipt" IS NOT NULL AND "id" > %s ORDER BY "id" LIMIT 1000',
+            (last_id,),
+        ).fetchall()
+        if not rows:
+            break
+        params = []
+        for id, receipt in rows:
+            params += [str(id), _receipt_to_json(receipt)]
+        values = ", ".join(["(%s::uuid, %s::jsonb)"] * len(rows))
+        database.execute_sql(
+            f'UPDATE "Orders" AS o SET "receipt_json" = v.receipt '
+            f"FROM (VALUES {values}) AS v(id, receipt) WHERE o.id = v.id",
+            params,
+        )
+        last_id = str(rows[-1][0])
+    database.execute_sql('ALTER TABLE "Orders" DROP COLUMN "receipt"')
+    database.execute_sql(
+        'ALTER TABLE "Orders" RENAME COLUMN "receipt_json" TO "receipt"'
+    )
+
+
+def current_version(database: Database) -> int:
+    """Последняя примененная версия схемы, 0 — если миграций еще не было"""
+    cursor = database.execute_sql(
+        f'SELECT COALESCE(MAX("version"), 0) FROM "{_VERSION_TABLE}"'
+    )
+    return cursor.fetchone()[0]
+
+
+def latest_version() -> int:
+    """Версия схемы, которую ожидает код: номер последнего шага миграций"""
+    return MIGRATIONS[-1].version if MIGRATIONS else 0
+
+
+def migrate(database: Database) -> int:
+    """Применяем все новые шаги миграций по порядку и возвращаем итоговую версию схемы.
+    Функция синхронная: на старте приложения ее запускают в отдельном потоке"""
+    with database.connection_context():
+        database.execute_sql(
+            f'CREATE TABLE IF NOT EXISTS "{_VERSION_TABLE}" ('
+            '"version" INTEGER NOT NULL PRIMARY KEY, '
+            '"name" TEXT NOT NULL, '
+            '"applied" TIMESTAMP NOT NULL DEFAULT now())'
+        )
+        database.execute_sql("SELECT pg_advisory_lock(%s)", (_LOCK_KEY,))
+        try:
+            version = current_version(database)
+            for step in MIGRATIONS:
+                if step.version <= version:
+                    continue
+                logger.info(f"Applying the migration {step.version}: {step.name}")
+                if step.transactional:
+                    with database.atomic():
+                        step.apply(database)
+                        _record(database, step)
+                else:
+                    step.apply(database)
+                    _record(database, step)
+                version = step.version
+        finally:
+            database.execute_sql("SELECT pg_advisory_unlock(%s)", (_LOCK_KEY,))
+
+    logger.info(f"DB schema is up to date, version {version}")
+    return version
+
+
+def _record(database: Database, step: Migration) -> None:
+    database.execute_sql(
+        f'INSERT INTO "{_VERSION_TABLE}" ("version", "name") VALUES (%s, %s)',
+        (step.version, step.name),
+    )
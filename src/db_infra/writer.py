@@ -0,0 +1,201 @@
+import asyncio
+
+from src.config import settings
+from src.db_infra import db
+from src.t_payment.models import Order
+
+from loguru import logger
+
+
+def _lease_owner() -> str | None:
+    """В режиме аренды пачки пишутся от имени процесса: заказы, аренду которых забрал
+    другой процесс, не перезаписываются"""
+    return settings.t_pay.worker_id if settings.t_pay.leasing else None
+
+
+class OrderBatchWriter:
+    """Пакетная запись изменений заказов (статус, ссылка, чек, PaymentId).
+    Изменения копятся window секунд или до max_size заказов и уходят в БД одним UPDATE.
+    Несколько изменений одного заказа за окно схлопываются в последнее.
+    Каждый вызывающий получает свой обновленный заказ, как от db.update_order(),
+    или None, если заказ уже завершен (итоговый статус не перезаписывается).
+
+    Методы:
+    update() — поставить изменение заказа в пачку и дождаться записи
+    flush() — записать накопленное прямо сейчас
+    close() — записать все и дождаться незавершенных записей (при остановке приложения)
+    """
+
+    def __init__(
+        self, window: float | None = None, max_size: int | None = None
+    ) -> None:
+        # Параметры, которые не передали явно, берутся из настроек в момент использования
+        self._window = window
+        self._max_size = max_size
+        self._pending: dict[str, tuple[Order, list[asyncio.Future]]] = {}
+        self._timer: asyncio.TimerHandle | None = None
+        self._flushes: set[asyncio.Task] = set()
+
+    @property
+    def window(self) -> float:
+        return settings.db.batch_window if self._window is None else self._window
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size or settings.db.batch_max_size
+
+    def __len__(self) -> int:
+        """Количество заказов, ожидающих записи"""
+        return len(self._pending)
+
+    async def update(self, order: Order) -> Order:
+        """Ставим изменение заказа в пачку и ждем, пока пачка запишется"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        order_key = str(order.id)
+
+        if order_key in self._pending:
+            # Последнее изменение заказа за окно перекрывает предыдущие
+            self._pending[order_key] = (order, self._pending[order_key][1] + [future])
+        else:
+            self._pending[order_key] = (order, [future])
+
+        if len(self._pending) >= self.max_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self.flush)
+
+        return await future
+
+    def flush(self) -> asyncio.Task | None:
+        """Отправляем накопленную пачку в БД, не дожидаясь записи"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return None
+
+        batch, self._pending = self._pending, {}
+        task = asyncio.create_task(self._write(batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+        return task
+
+    async def close(self) -> None:
+        """Записываем все накопленное и ждем завершения всех записей"""
+        self.flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+        logger.info("Order batch writer flushed")
+
+    async def _write(
+        self, batch: dict[str, tuple[Order, list[asyncio.Future]]]
+    ) -> None:
+        """Пишем пачку одним запросом. Если запрос не прошел, пишем заказы по одному,
+        чтобы ошибка в одном заказе не потеряла изменения остальных"""
+        orders = [order for order, _ in batch.values()]
+        try:
+            updated_orders = {
+                str(order.id): order
+                for order in await db.update_orders(orders, owner=_lease_owner())
+            }
+        except Exception as e:
+            logger.warning(
+                f"Error in the batch update of {len(orders)} orders, updating one by one: {e}"
+            )
+            updated_orders = {}
+            for order in orders:
+                try:
+                    for updated_order in await db.update_orders(
+                        [order], owner=_lease_owner()
+                    ):
+                        updated_orders[str(order.id)] = updated_order
+                except Exception as order_error:
+                    for future in batch[str(order.id)][1]:
+                        if not future.done():
+                            future.set_exception(order_error)
+
+        for order_key, (_, futures) in batch.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(updated_orders.get(order_key))
+
+
+class PollStateWriter:
+    """Пакетная запись состояния polling-проверок заказов (попытки, следующая проверка,
+    последний статус в TPay). Вызывающий не ждет записи: состояние копится window секунд
+    или до max_size заказов и уходит в БД одним UPDATE, из нескольких состояний одного заказа
+    за окно пишется последнее. Если запись не прошла, после перезапуска заказ продолжит
+    с предыдущего сохраненного состояния — это лишние проверки, а не потерянный заказ.
+
+    Методы:
+    record() — поставить состояние заказа в пачку
+    flush() — записать накопленное прямо сейчас
+    close() — записать все и дождаться незавершенных записей (при остановке приложения)
+    """
+
+    def __init__(
+        self, window: float | None = None, max_size: int | None = None
+    ) -> None:
+        # Параметры, которые не передали явно, берутся из настроек в момент использования
+        self._window = window
+        self._max_size = max_size
+        self._pending: dict[str, Order] = {}
+        self._timer: asyncio.TimerHandle | None = None
+        self._flushes: set[asyncio.Task] = set()
+
+    @property
+    def window(self) -> float:
+        return settings.db.poll_state_window if self._window is None else self._window
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size or settings.db.batch_max_size
+
+    def __len__(self) -> int:
+        """Количество заказов, ожидающих записи"""
+        return len(self._pending)
+
+    def record(self, order: Order) -> None:
+        """Ставим состояние заказа в пачку, не дожидаясь записи"""
+        self._pending[str(order.id)] = order
+        if len(self._pending) >= self.max_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+
+    def flush(self) -> asyncio.Task | None:
+        """Отправляем накопленную пачку в БД, не дожидаясь записи"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return None
+
+        batch, self._pending = self._pending, {}
+        task = asyncio.create_task(self._write(list(batch.values())))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+        return task
+
+    async def close(self) -> None:
+        """Записываем все накопленное и ждем завершения всех записей"""
+        self.flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+        logger.info("Polling state writer flushed")
+
+    async def _write(self, orders: list[Order]) -> None:
+        try:
+            await db.save_poll_states(orders, owner=_lease_owner())
+        except Exception as e:
+            logger.warning(
+                f"Failed to save the polling state of {len(orders)} orders: {e}"
+            )
+
+
+# Общий писатель для всех изменений статусов заказов
+order_writer = OrderBatchWriter()
+
+# Общий писатель состояния polling-проверок
+poll_state_writer = PollStateWriter()
@@ -0,0 +1,58 @@
+"""Логирование приложения.
+setup_logging() настраивает вывод: сообщения пишутся через очередь (enqueue) в отдельном потоке,
+поэтому запись в stderr не блокирует цикл событий.
+
+На горячих путях (проверка каждого заказа, маппинг каждой строки из БД) сообщения
+не форматируются заранее: вместо f-строк аргументы передаются в logger отдельно
+(logger.debug("Order {}", order)) или лениво через logger.opt(lazy=True), и строка собирается,
+только если уровень включен. Частые сообщения одного места вызова прореживаются:
+sample() пропускает каждое n-е, throttle() — не чаще раза в interval секунд"""
+
+import sys
+import time
+
+from src.config import settings
+
+from loguru import logger
+
+# Счетчики прореживания по местам вызова: (файл, строка) -> число вызовов / время последнего сообщения
+_samples: dict[tuple[str, int], int] = {}
+_throttles: dict[tuple[str, int], float] = {}
+
+
+def setup_logging(level: str | None = None, enqueue: bool | None = None) -> None:
+    """Настраиваем единственный вывод логов в stderr с уровнем из настроек"""
+    logger.remove()
+    logger.add(
+        sys.stderr,
+        level=level or settings.logger_level,
+        enqueue=settings.logger_enqueue if enqueue is None else enqueue,
+    )
+
+
+def _call_site() -> tuple[str, int]:
+    frame = sys._getframe(2)
+    return frame.f_code.co_filename, frame.f_lineno
+
+
+def sample(every: int | None = None) -> bool:
+    """Пропускаем первое и дальше каждое every-е сообщение этого места вызова.
+    По умолчанию every берется из настроек, every <= 1 — без прореживания"""
+    every = settings.logger_sample_every if every is None else every
+    if every <= 1:
+        return True
+    site = _call_site()
+    count = _samples.get(site, 0)
+    _samples[site] = count + 1
+    return count % every == 0
+
+
+def throttle(interval: float) -> bool:
+    """Пропускаем сообщение этого места вызова не чаще раза в interval секунд"""
+    site = _call_site()
+    now = time.monotonic()
+    last = _throttles.get(site)
+    if last is not None and now - last < interval:
+        return False
+    _throttles[site] = now
+    return True
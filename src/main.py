@@ -1,76 +1,126 @@
-import asyncio
+import functools
+import time
 
-from aiogram import Bot, Dispatcher, executor, types
+from aiogram import Dispatcher, executor, types
+from src.app import Application
 from src.config import settings
-from src.t_payment import t_payment
 from src.db_infra import db
-from src.t_payment.models import StatusCode
+from src.t_payment.models import Order, StatusCode
 from src.polling import checker
+from src.polling.open_orders import open_orders
+from src.tg_infra.messages import message_queue
+from src import log, metrics
 
-import sys
+from src.log import setup_logging
 from loguru import logger
 
-logger.remove()
-logger.add(sys.stderr, level=settings.logger_level)
+# Клиент TPay общий с фоновой проверкой: у них один пул соединений и одни ограничители запросов
+client = checker.client
 
-# Запускаем бота
-bot = Bot(token=settings.tg.tg_token)
-dp = Dispatcher(bot)
 
-# Создаем клиента для TPay
-client = t_payment.TPay(settings.t_pay.tpay_term_key, settings.t_pay.tpay_pass)
+def _latency_budget(handler):
+    """Замеряем время хендлера: пишем его в метрики, а если хендлер не уложился
+    в бюджет handler_latency_budget, предупреждаем в логе (не чаще раза в 5 секунд)"""
 
-# Создаем бд
-db.create_tables(db.db, db.Orders)
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.TELEGRAM_HANDLER_SECONDS.observe(elapsed, handler=handler.__name__)
+            budget = settings.tg.handler_latency_budget
+            if elapsed > budget and log.throttle(5):
+                logger.warning(
+                    f"The handler {handler.__name__} took {elapsed:.2f}s, "
+                    f"the budget is {budget}s"
+                )
 
+    return wrapper
 
-# TODO: Нужно реализовать проверку незавершенных платежей при перезапуске
 
-
-@dp.message_handler(commands=["start"])
 async def send_welcome(message: types.Message):
     """Проверяем, что все ок и что бот работает"""
     await message.reply("Hi!\nThe bot is working.")
     await message.reply(f"Available tables in db: {db.db.get_tables()}")
 
 
-@dp.message_handler(commands=["get_payment"])
-async def get_payment_link(message: types.Message) -> None:
-    """Создаем платеж в БД, а потом в TPay,
-    отправляем юзеру ссылку, запускаем polling-проверку"""
+# Сумма тестового платежа в копейках, нужно «очеловечивать» — например, у себя делить на 100
+PAYMENT_AMOUNT = 1000
+
+
+async def _create_order(customer_key: int) -> Order | None:
+    """Создаем платеж в БД, а потом в TPay, и сохраняем ссылку на оплату.
+    Если TPay ответил ошибкой или недоступен, заказ остается в CREATED, а ошибка уходит вызывающему.
+    None — заказ со ссылкой не удалось записать в БД
+    """
+    order = await db.add_order(
+        amount=PAYMENT_AMOUNT,
+        customer_key=customer_key,
+        email="fedorenko-pavel@mail.ru",
+        description="Услуги по транскрибации аудио и видео файлов путем предоставления доступа к "
+        "Программному комплексу распознавания и синтеза речи Voicee (Войси)",
+        status=StatusCode.created.value,
+    )
+    logger.debug("The order object was created: {}", order)
 
     try:
-        # Создаем платеж в базе
-        order = await db.add_order(
-            amount=1000,  # Сумма передается в копейках, нужно «очеловечивать» — например, у себя делить на 100
-            customer_key=message.from_id,
-            email="fedorenko-pavel@mail.ru",
-            description="Услуги по транскрибации аудио и видео файлов путем предоставления доступа к "
-            "Программному комплексу распознавания и синтеза речи Voicee (Войси)",
-            status=StatusCode.created.value,
+        order = await client.create_order_link(order)
+    except Exception as e:
+        logger.warning(
+            f"Failed to create the TPay payment for the order {order.id}: {e!r}"
         )
+        raise
+    logger.debug("The TPay order was created: {}", order)
 
-        logger.debug(f"The order object was created: {type(order)}: {order}")
+    # Обновляем заказ в базе
+    updated_order = await db.update_order(order)
+    if updated_order is None:
+        logger.warning(f"The order {order.id} with the payment link was not saved")
+    return updated_order
 
-        # Создаем платеж в TPay
-        order = await client.create_order_link(order)
-        logger.debug(f"The TPay order was created: {type(order)}, {order}")
-        # Обновляем заказа в базе
-        updated_order = await db.update_order(order)
 
-        # Отправляем сообщение юзеру
-        await message.answer(
-            f"Link to your order: {updated_order.url}. Payment status: {updated_order.status}"
+@_latency_budget
+async def get_payment_link(message: types.Message) -> None:
+    """Отдаем юзеру ссылку на оплату и отдаем заказ фоновой проверке.
+    Если у юзера уже есть открытый заказ на эту сумму (например, он нажал дважды),
+    повторно отдаем его ссылку, иначе создаем заказ в БД и в TPay.
+    Хендлер не ждет ни оплаты, ни доставки сообщения: из внешних запросов в нем только Init в TPay,
+    поэтому апдейт обрабатывается за один запрос к TPay, а не за все время polling-проверки
+    """
+
+    try:
+        try:
+            order = await open_orders.get_or_create(
+                message.from_id,
+                PAYMENT_AMOUNT,
+                lambda: _create_order(message.from_id),
+            )
+        except Exception:
+            logger.exception(f"Failed to get a payment link for {message.from_id}")
+            order = None
+        if order is None or not order.url:
+            await message_queue.send_message(
+                message.chat.id,
+                "The payment service is temporarily unavailable. Please try again later.",
+            )
+            return
+
+        # Отправляем сообщение юзеру через общую очередь сообщений
+        await message_queue.send_message(
+            message.chat.id,
+            f"Link to your order: {order.url}. Payment status: {order.status}",
         )
 
-        # Запускаем polling-проверку статуса платежа
-        await checker.check_order_status(updated_order, bot)
+        # Отдаем заказ фоновой polling-проверке, итоговый статус придет юзеру сообщением.
+        # Повторно выданный заказ уже отслеживается, второй проверки не будет
+        checker.track_order(order, message_queue)
 
     except Exception as e:
         logger.error(f"Somethings went wrong: {e}")
 
 
-@dp.message_handler()
 async def echo(message: types.Message):
     await message.answer(
         "This bot demonstrates the possibilities of interacting with the TPay API."
@@ -78,7 +128,20 @@ async def echo(message: types.Message):
     )
 
 
+def register_handlers(dispatcher: Dispatcher) -> None:
+    """Регистрируем хендлеры бота в диспетчере"""
+    dispatcher.register_message_handler(send_welcome, commands=["start"])
+    dispatcher.register_message_handler(get_payment_link, commands=["get_payment"])
+    dispatcher.register_message_handler(echo)
+
+
 if __name__ == "__main__":
-    loop = asyncio.get_event_loop()
-    loop.create_task(checker.run_checker())
-    executor.start_polling(dp, skip_updates=settings.tg.skip_updates)
+    setup_logging()
+    # Бот, пулы соединений и фоновые задачи создаются и запускаются только здесь, а не при импорте
+    app = Application(register_handlers)
+    executor.start_polling(
+        app.dispatcher,
+        skip_updates=settings.tg.skip_updates,
+        on_startup=app.start,
+        on_shutdown=app.stop,
+    )
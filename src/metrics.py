@@ -0,0 +1,302 @@
+"""Метрики приложения в формате Prometheus.
+Счетчики (Counter), гистограммы задержек (Histogram) и показатели, которые считаются
+в момент запроса метрик (GaugeFunc), например, размер очередей и статистика пулов.
+Запись метрики — это поиск по словарю и bisect по границам корзин, без блокировок и аллокаций строк,
+поэтому метрики можно держать включенными в проде. Текст для Prometheus собирается только на запрос /metrics,
+его отдает локальный HTTP-сервер MetricsServer"""
+
+import bisect
+import functools
+import math
+import time
+from typing import Callable
+
+from aiohttp import web
+from src.config import settings
+
+from loguru import logger
+
+# Границы корзин по умолчанию: от 5 мс до 10 с — для запросов к TPay, БД и Telegram
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Все зарегистрированные метрики в порядке объявления
+REGISTRY: list["_Metric"] = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """Общая часть метрик: имя, описание, тип и имена меток"""
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        return "\n".join(lines + self.samples())
+
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик, например, число запросов с разбивкой по исходу"""
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        super().__init__(name, help, labels)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, value: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self) -> list[str]:
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+            for key, value in self.values.items()
+        ]
+
+
+class Histogram(_Metric):
+    """Гистограмма значений (обычно задержек в секундах) с фиксированными корзинами"""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # По каждому набору меток: количество в каждой корзине (не накопленное), сумма и число значений
+        self.values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def time(self, **labels) -> "_Timer":
+        """Контекст, который записывает в гистограмму время выполнения блока"""
+        return _Timer(self, None, labels)
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}"
+                )
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class GaugeFunc(_Metric):
+    """Показатель, который вычисляется в момент запроса метрик.
+    Функция возвращает число или словарь «кортеж значений меток -> число»"""
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        function: Callable[[], float | dict[tuple, float]],
+        labels: tuple[str, ...] = (),
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.function = function
+
+    def samples(self) -> list[str]:
+        try:
+            values = self.function()
+        except Exception as e:
+            logger.warning(f"Failed to collect the metric {self.name}: {e}")
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+            for key, value in values.items()
+        ]
+
+
+class _Timer:
+    __slots__ = ("histogram", "counter", "labels", "started")
+
+    def __init__(
+        self, histogram: Histogram, counter: Counter | None, labels: dict
+    ) -> None:
+        self.histogram = histogram
+        self.counter = counter
+        self.labels = labels
+
+    def __enter__(self) -> "_Timer":
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        if self.counter is not None:
+            outcome = "success" if exc_type is None else "error"
+            self.counter.inc(outcome=outcome, **self.labels)
+
+
+def measure(histogram: Histogram, counter: Counter, **labels) -> _Timer:
+    """Контекст, который записывает время выполнения блока в histogram,
+    а вызов с исходом (success/error) — в counter"""
+    return _Timer(histogram, counter, labels)
+
+
+def timed(histogram: Histogram, counter: Counter, label: str = "function"):
+    """Декоратор асинхронной функции: то же, что measure(), с меткой label — именем функции"""
+
+    def decorator(function):
+        labels = {label: function.__name__}
+
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            with _Timer(histogram, counter, labels):
+                return await function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus"""
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+# Запросы к API TPay
+TPAY_REQUESTS = Counter(
+    "tpay_requests_total",
+    "TPay API requests by endpoint and outcome: success, failure (Success=false), "
+    "error or rejected (the circuit breaker is open)",
+    ("endpoint", "outcome"),
+)
+TPAY_REQUEST_SECONDS = Histogram(
+    "tpay_request_seconds",
+    "TPay API request latency without the rate limiter wait",
+    ("endpoint",),
+)
+TPAY_RETRIES = Counter(
+    "tpay_retries_total", "Retried TPay API requests by endpoint", ("endpoint",)
+)
+
+# Запросы к БД
+DB_QUERIES = Counter(
+    "db_queries_total",
+    "DB function calls by function and outcome",
+    ("function", "outcome"),
+)
+DB_QUERY_SECONDS = Histogram("db_query_seconds", "DB function latency", ("function",))
+
+# Жизненный цикл заказов и polling
+ORDERS_FINALIZED = Counter(
+    "orders_finalized_total", "Orders that reached a final status", ("status",)
+)
+PAYMENT_CONFIRMATION_SECONDS = Histogram(
+    "payment_confirmation_seconds",
+    "Time from the order creation to CONFIRMED",
+    buckets=(5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 10800),
+)
+POLLING_LAG_SECONDS = Histogram(
+    "polling_lag_seconds",
+    "Delay between the planned and the actual time of a payment check",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+
+# Сообщения в Telegram
+TELEGRAM_MESSAGES = Counter(
+    "telegram_messages_total",
+    "Telegram API calls by method and outcome",
+    ("method", "outcome"),
+)
+TELEGRAM_SEND_SECONDS = Histogram(
+    "telegram_send_seconds", "Telegram API call latency", ("method",)
+)
+TELEGRAM_HANDLER_SECONDS = Histogram(
+    "telegram_handler_seconds", "Telegram update handler latency", ("handler",)
+)
+
+
+class MetricsServer:
+    """Локальный HTTP-эндпоинт /metrics для Prometheus.
+
+    Методы:
+    start() — поднимает HTTP-сервер
+    stop() — останавливает его"""
+
+    def __init__(self) -> None:
+        self.app = web.Application()
+        self.app.router.add_get("/metrics", self._handle)
+        self._runner: web.AppRunner | None = None
+        self.url: str | None = None
+
+    async def start(self, host: str | None = None, port: int | None = None) -> str:
+        """Поднимаем HTTP-сервер и возвращаем адрес эндпоинта"""
+        host = host or settings.metrics_host
+        port = settings.metrics_port if port is None else port
+
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}/metrics"
+        logger.info(f"Metrics are exposed on {self.url}")
+        return self.url
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+            logger.info("Metrics server stopped")
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(
+            text=render(),
+            content_type="text/plain",
+            charset="utf-8",
+            headers={"X-Prometheus-Format": "0.0.4"},
+        )
@@ -1,46 +1,243 @@
 import asyncio
+import datetime
 from src.t_payment.models import Order
-from aiogram import Bot
 from src.config import settings
+from src import metrics
 from src.t_payment import t_payment
 from src.db_infra import db
+from src.db_infra.writer import order_writer, poll_state_writer
 from src.t_payment.models import StatusCode
+from src.polling.scheduler import PollingScheduler
+from src.polling.registry import SingleFlight
+from src.polling.open_orders import open_orders
 
 from loguru import logger
 
-# Создаем клиента для TPay
-client = t_payment.TPay(settings.t_pay.tpay_term_key, settings.t_pay.tpay_pass)
+# Создаем клиента для TPay, креды берутся из настроек при первом запросе
+client = t_payment.TPay()
+
+# Общий планировщик проверок для всех заказов, создается при первом использовании
+scheduler: PollingScheduler | None = None
+
+# Реестр отслеживаемых заказов: у каждого открытого заказа ровно один активный polling
+in_flight = SingleFlight()
+
+# Заказы, которые прямо сейчас финализируются: защита от двойной обработки
+# итогового статуса polling-проверкой и уведомлением TPay
+finalizing: set[str] = set()
+
+# Подписка на новые заказы из БД (LISTEN/NOTIFY) работает: полный обход нужен только как страховка
+listening = False
+
+# Просьба к фоновой проверке обойти заказы в NEW вне очереди (например, после переподключения подписки)
+_rescan = asyncio.Event()
+
+# Состояние проверки и ограничителей TPay считается в момент запроса метрик
+metrics.GaugeFunc(
+    "polling_open_orders", "Open orders tracked by this process", lambda: len(in_flight)
+)
+metrics.GaugeFunc(
+    "polling_scheduler_checks",
+    "Polling scheduler checks: tracked orders, scheduled and queued to the workers",
+    lambda: {
+        (name,): value
+        for name, value in (scheduler.stats() if scheduler is not None else {}).items()
+    },
+    ("state",),
+)
+metrics.GaugeFunc(
+    "tpay_circuit_state",
+    "TPay circuit breaker state: 0 closed, 1 half-open, 2 open",
+    lambda: {"closed": 0, "half_open": 1, "open": 2}[client.breaker_stats()["state"]],
+)
+metrics.GaugeFunc(
+    "tpay_circuit_events",
+    "TPay circuit breaker openings and requests rejected while it was open",
+    lambda: {
+        ("opened",): client.breaker_stats()["opened"],
+        ("rejected",): client.breaker_stats()["rejected"],
+    },
+    ("event",),
+)
+for _stat in ("requests", "delayed", "wait_total", "wait_max", "in_flight", "queued"):
+    metrics.GaugeFunc(
+        f"tpay_limiter_{_stat}",
+        f"TPay rate limiter {_stat.replace('_', ' ')}",
+        lambda stat=_stat: {
+            (name,): stats[stat] for name, stats in client.limiter_stats().items()
+        },
+        ("limiter",),
+    )
+
+
+async def _get_scheduler(bot) -> PollingScheduler:
+    """Отдаем общий планировщик проверок, при первом вызове создаем и запускаем его"""
+    global scheduler
+    if scheduler is None:
+        scheduler = PollingScheduler(
+            check=client.check_order,
+            finalize=lambda order: finalize_order(order, bot),
+            # Пока TPay недоступен, фоновые проверки стоят на паузе
+            gate=lambda: client.wait_available(),
+            # Состояние проверок пачками уходит в БД: после перезапуска продолжаем с того же места
+            record=poll_state_writer.record,
+        )
+    await scheduler.start()
+    return scheduler
+
+
+async def stop_scheduler() -> None:
+    """Останавливаем планировщик проверок при остановке приложения"""
+    if scheduler is not None:
+        await scheduler.stop()
+
+
+async def release_leases() -> None:
+    """В режиме аренды отпускаем свои заказы, чтобы их сразу забрали другие процессы.
+    Вызывается, когда статусы и состояние проверок уже записаны в БД: иначе другой процесс
+    заберет заказ раньше, чем до БД дойдет последний статус"""
+    if settings.t_pay.leasing:
+        await db.release_leases(settings.t_pay.worker_id)
+
+
+def _order_keys(order: Order) -> list[str | None]:
+    """Ключи заказа в реестре: id заказа и PaymentId в TPay"""
+    payment_key = f"payment:{order.payment_id}" if order.payment_id else None
+    return [f"order:{order.id}", payment_key]
+
+
+def is_tracked(order: Order) -> bool:
+    """Проверяем, отслеживается ли уже заказ"""
+    return in_flight.get(_order_keys(order)) is not None
+
+
+async def _poll_order(order: Order, bot, leased: bool = False) -> Order:
+    """Ставим заказ на polling-проверку в общий планировщик и ждем итогового статуса.
+    В режиме аренды сначала берем заказ в аренду, если он еще не наш:
+    заказ, который проверяет другой процесс, возвращаем как есть"""
+    if settings.t_pay.leasing and not leased:
+        claimed = await db.claim_order(
+            order.id, settings.t_pay.worker_id, settings.t_pay.lease_ttl
+        )
+        if not claimed:
+            logger.info(f"The order {order.id} is polled by another worker")
+            return order
+    return await (await _get_scheduler(bot)).submit(order)
+
+
+def track_order(order: Order, bot, leased: bool = False) -> asyncio.Task:
+    """Берем заказ на отслеживание, не дожидаясь результата.
+    Если заказ уже отслеживается, второй polling не запускается.
+    leased — заказ уже взят в аренду этим процессом"""
+    return in_flight.start(_order_keys(order), lambda: _poll_order(order, bot, leased))
 
 
 async def check_order_status(order: Order, bot) -> Order:
-    """Запускаем проверку статуса заказа в TPay и реагируем на изменения статусов.
+    """Отслеживаем заказ и ждем итогового статуса.
+    Повторные вызовы для того же заказа подключаются к уже идущей проверке"""
+    return await in_flight.run(_order_keys(order), lambda: _poll_order(order, bot))
+
+
+async def finalize_order(checked_order: Order, bot) -> Order:
+    """Реагируем на итоговый статус заказа в TPay.
     Если лимит проверок закончился, получили ошибку или платеж отменился, руками отменяем платеж,
     чтобы не наткнуться на ошибку."""
-    checked_order = await client.check_order_polling(order)
-    logger.debug(f"The order id: {checked_order.id}, status: {checked_order.status}")
+    logger.debug("The order id: {}, status: {}", checked_order.id, checked_order.status)
 
-    if checked_order.status == StatusCode.confirmed.value:
-        checked_order = await payment_received(checked_order, bot)
+    order_key = str(checked_order.id)
+    if order_key in finalizing:
+        logger.info(f"The order {order_key} is already being finalized")
+        return checked_order
 
-    elif checked_order.status in (
+    finalizing.add(order_key)
+    # Ссылку на завершенный заказ больше нельзя выдавать повторно
+    open_orders.discard(checked_order)
+    try:
+        if checked_order.status == StatusCode.confirmed.value:
+            checked_order = await payment_received(checked_order, bot)
+
+        elif checked_order.status in (
+            StatusCode.rejected.value,
+            StatusCode.cancelled.value,
+            StatusCode.max_attempts.value,
+        ):
+            checked_order = await cancel_payment(checked_order, bot)
+    finally:
+        finalizing.discard(order_key)
+
+    return checked_order
+
+
+async def handle_notification(data: dict, bot) -> Order | None:
+    """Обрабатываем уведомление TPay с уже проверенной подписью: обновляем заказ
+    и запускаем ту же реакцию на итоговый статус, что и после polling.
+    Промежуточные статусы и повторные уведомления по завершенному заказу пропускаем"""
+    status = data.get("Status")
+    if status not in (
+        StatusCode.confirmed.value,
         StatusCode.rejected.value,
         StatusCode.cancelled.value,
-        StatusCode.max_attempts.value,
     ):
-        checked_order = await cancel_payment(checked_order, bot)
+        logger.debug(f"Skipping the intermediate status {status} of the notification")
+        return None
 
-    return checked_order
+    # Читаем мимо кэша: заказ мог завершить другой процесс, а по устаревшему снимку
+    # уведомление об отказе отменило бы платеж в TPay второй раз
+    order = await db.get_order_by_number(data.get("OrderId"), cached=False)
+    if order is None:
+        logger.warning(
+            f"The order {data.get('OrderId')} from the notification not found"
+        )
+        return None
+    if order.payment_id and str(order.payment_id) != str(data.get("PaymentId")):
+        logger.warning(
+            f"The notification payment {data.get('PaymentId')} "
+            f"does not match the order payment {order.payment_id}"
+        )
+        return None
+    if order.status not in (StatusCode.created.value, StatusCode.new.value):
+        logger.info(f"The order {order.id} is already finalized: {order.status}")
+        return order
+
+    if settings.t_pay.leasing:
+        # Итоговый статус пишет арендатор заказа: забираем аренду, даже если заказ проверяет другой процесс
+        await db.claim_order(
+            order.id, settings.t_pay.worker_id, settings.t_pay.lease_ttl, force=True
+        )
+
+    # Снимаем заказ с polling-проверок, чтобы планировщик не обработал его второй раз
+    future = scheduler.detach(order.id) if scheduler is not None else None
+    order.status = status
+    try:
+        result = await finalize_order(order, bot)
+    except Exception as e:
+        if future is not None and not future.done():
+            future.set_exception(e)
+        raise
+
+    if future is not None and not future.done():
+        future.set_result(result)
+    return result
 
 
 async def payment_received(order: Order, bot) -> Order:
     """Действия при удачной оплате: обновляем объект заказа в БД, отсылаем подробности юзеру"""
 
-    # Обновляем заказ в бд
-    updated_order = await db.update_order(order)
+    # Обновляем заказ в бд: итоговые статусы одной проверки уходят в БД одной пачкой
+    updated_order = await order_writer.update(order)
+    if updated_order is None:
+        logger.info(f"The order {order.id} is already finalized by another worker")
+        return order
     logger.info(
         f"The payment {updated_order.id} received. Status: {updated_order.status}"
     )
 
+    metrics.ORDERS_FINALIZED.inc(status=updated_order.status)
+    if updated_order.created is not None:
+        metrics.PAYMENT_CONFIRMATION_SECONDS.observe(
+            (datetime.datetime.now() - updated_order.created).total_seconds()
+        )
+
     # Сообщение для понимания, что платеж прошел успешно
     await bot.send_message(
         order.customer_key,
@@ -63,9 +260,13 @@ async def cancel_payment(order: Order, bot) -> Order:
         )
 
     logger.debug("Updating the payment in DB")
-    updated_order = await db.update_order(order)
+    updated_order = await order_writer.update(order)
+    if updated_order is None:
+        logger.info(f"The order {order.id} is already finalized by another worker")
+        return order
 
     logger.info(f"The payment {updated_order.id} canceled")
+    metrics.ORDERS_FINALIZED.inc(status=updated_order.status)
 
     # Сообщение для понимания, что платеж прошел с ошибкой
     await bot.send_message(
@@ -77,14 +278,162 @@ async def cancel_payment(order: Order, bot) -> Order:
     return updated_order
 
 
-async def run_checker():
-    """Запускаем постоянную проверку новых платежей.
-    Актуально при перезапуске или в случае сбоев"""
-    bot = Bot(token=settings.tg.tg_token)
+async def _take_new_orders(orders: list[Order], bot) -> int:
+    """Берем на отслеживание заказы в NEW, которые еще не отслеживаются.
+    Заказы, которые уже отслеживаются (например, из хендлера), второй раз не берем"""
+    taken = 0
+    for order in orders:
+        if order.status == StatusCode.new.value and not is_tracked(order):
+            track_order(order, bot)
+            taken += 1
+    return taken
+
+
+def _due_before() -> datetime.datetime:
+    """До какого времени должна быть назначена проверка заказа, чтобы взять его сейчас.
+    Заказы, которые проверять позже следующего обхода, остаются в БД до него"""
+    return datetime.datetime.now() + datetime.timedelta(seconds=_reconcile_interval())
+
+
+async def _claim_new_orders(bot) -> None:
+    """Режим аренды: берем свободные заказы в NEW пачками, пока не наберем lease_max_orders.
+    Так заказы распределяются между процессами, а заказы упавшего процесса
+    забираются, как только истекает их аренда. Берем только заказы, которые пора проверять
+    """
+    taken = 0
+    while len(in_flight) < settings.t_pay.lease_max_orders:
+        limit = min(
+            settings.t_pay.lease_batch_size,
+            settings.t_pay.lease_max_orders - len(in_flight),
+        )
+        orders = await db.claim_orders(
+            settings.t_pay.worker_id, limit, settings.t_pay.lease_ttl, _due_before()
+        )
+        for order in orders:
+            track_order(order, bot, leased=True)
+        taken += len(orders)
+        if len(orders) < limit:
+            break
+    logger.info(
+        f"The worker {settings.t_pay.worker_id} claimed {taken} NEW orders, "
+        f"{len(in_flight)} tracked"
+    )
+
+
+async def _renew_leases() -> None:
+    """Продлеваем аренду своих заказов, пока проверяем их.
+    Заказы, которые ушли другому процессу (например, аренда истекла во время долгой паузы),
+    снимаем с проверок, чтобы не проверять и не финализировать их дважды"""
+    while True:
+        await asyncio.sleep(settings.t_pay.lease_ttl / 3)
+        try:
+            owned = await db.renew_leases(
+                settings.t_pay.worker_id, settings.t_pay.lease_ttl
+            )
+        except Exception as e:
+            logger.warning(f"Failed to renew the order leases: {e}")
+            continue
+        if scheduler is None:
+            continue
+        for order_id in scheduler.order_ids():
+            if order_id not in owned:
+                logger.warning(f"The lease of the order {order_id} is lost")
+                future = scheduler.detach(order_id)
+                if future is not None:
+                    future.cancel()
+
+
+async def _scan_new_orders(bot) -> None:
+    """Полный обход заказов в NEW: страховка на случай пропущенных уведомлений из БД.
+    Заказы читаются из БД постранично и берутся на отслеживание по мере чтения,
+    поэтому большой накопившийся хвост не держится в памяти целиком
+    и первые проверки начинаются сразу после первой страницы.
+    Читаем только заказы, которые пора проверить до следующего обхода:
+    после перезапуска проверки продолжаются по сохраненному состоянию, а не с начала"""
+    new_orders = taken = 0
+    async for order in db.iter_orders_by_status(
+        StatusCode.new.value, due_before=_due_before()
+    ):
+        new_orders += 1
+        taken += await _take_new_orders([order], bot)
+    logger.info(
+        f"Listening to changes in NEW orders: {new_orders} due, {taken} taken, "
+        f"{len(in_flight)} tracked"
+    )
+
+
+async def _listen_new_orders(bot) -> None:
+    """Берем заказы на отслеживание сразу, как только они переходят в NEW:
+    БД присылает их id через LISTEN/NOTIFY, пачку id дочитываем из БД одним запросом.
+    Если подписка оборвалась, переподключаемся, а пока ее нет, полный обход идет часто
+    """
+    global listening
     while True:
-        new_orders = await db.get_all_orders_by_status(StatusCode.new.value)
-        logger.debug(f"All of new orders: {new_orders}")
-        tasks = [check_order_status(order, bot) for order in new_orders]
-        logger.info(f"Listening to changes in NEW orders")
-        await asyncio.gather(*tasks)
-        await asyncio.sleep(5)
+        try:
+            async for order_ids in db.listen_new_orders():
+                if not order_ids:
+                    # Подписка оформлена: обходим заказы, чтобы подобрать пропущенные без нее
+                    listening = True
+                    _rescan.set()
+                    continue
+                if settings.t_pay.leasing:
+                    # Уведомление получают все процессы, заказ достанется тому, кто первым возьмет аренду
+                    await _claim_new_orders(bot)
+                    continue
+                orders = await db.get_orders_by_ids(list(set(order_ids)))
+                taken = await _take_new_orders(orders, bot)
+                logger.debug(
+                    f"Got {len(order_ids)} new orders from the DB notifications, {taken} taken"
+                )
+        except asyncio.CancelledError:
+            listening = False
+            raise
+        except Exception as e:
+            logger.warning(f"The DB notifications listener failed: {e}")
+        listening = False
+        await asyncio.sleep(settings.t_pay.reconcile_fallback_interval)
+
+
+def _reconcile_interval() -> float:
+    """Пауза до следующего полного обхода заказов в NEW"""
+    if not listening:
+        return settings.t_pay.reconcile_fallback_interval
+    interval = settings.t_pay.reconcile_interval
+    # В режиме уведомлений TPay обход нужен еще реже
+    if settings.t_pay.mode == "webhook":
+        interval = max(interval, settings.t_pay.safety_net_delay)
+    if settings.t_pay.leasing:
+        # Аренда упавшего процесса истекает через lease_ttl — забираем его заказы без долгой паузы
+        interval = min(interval, settings.t_pay.lease_ttl)
+    return interval
+
+
+async def run_checker(bot):
+    """Запускаем постоянную проверку новых платежей.
+    Новые заказы приходят из БД уведомлениями, а полный обход заказов в NEW
+    подбирает то, что накопилось при перезапуске, сбоях или обрыве подписки.
+    В режиме аренды вместо обхода процесс забирает свободные заказы в аренду.
+    bot — куда отправлять сообщения юзерам, в приложении это общая очередь сообщений,
+    чтобы финализация заказов не ждала доставки в Telegram"""
+    tasks = [asyncio.create_task(_listen_new_orders(bot))]
+    if settings.t_pay.leasing:
+        tasks.append(asyncio.create_task(_renew_leases()))
+    try:
+        while True:
+            _rescan.clear()
+            if settings.t_pay.leasing:
+                await _claim_new_orders(bot)
+            else:
+                await _scan_new_orders(bot)
+            # Статистика собирается, только если включен уровень DEBUG
+            logger.opt(lazy=True).debug(
+                "TPay request limiters: {}", client.limiter_stats
+            )
+            logger.opt(lazy=True).debug("DB connection pool: {}", db.pool_stats)
+            try:
+                await asyncio.wait_for(_rescan.wait(), _reconcile_interval())
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        for task in tasks:
+            task.cancel()
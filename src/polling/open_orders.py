@@ -0,0 +1,150 @@
+import collections
+import datetime
+import time
+from typing import Awaitable, Callable
+
+from src import metrics
+from src.config import settings
+from src.db_infra import db
+from src.polling.registry import SingleFlight
+from src.t_payment.models import Order, StatusCode
+
+from loguru import logger
+
+
+class OpenOrders:
+    """Открытые заказы юзеров: повторный /get_payment отдает уже выданную ссылку на оплату.
+    Заказ ищется по юзеру и сумме: сначала в памяти процесса, потом в БД (NEW со ссылкой,
+    созданный не раньше ttl секунд назад), и только если его нет — создается новый.
+    Одновременные запросы одного юзера (двойное нажатие) ждут одного создания заказа,
+    поэтому не появляются дубли заказов, Init и polling-проверок.
+
+    В памяти держится до max_size заказов, при переполнении вытесняются давно не запрошенные.
+    Заказ уходит из памяти по истечении ttl с момента создания или при финализации (discard()).
+    В режиме аренды заказ может финализировать другой процесс, поэтому память не используется
+    и открытый заказ каждый раз ищется в БД.
+
+    Методы:
+    get_or_create() — отдает открытый заказ юзера на сумму или создает новый
+    discard() — убирает заказ из памяти, когда он получил итоговый статус
+    """
+
+    def __init__(self, ttl: int | None = None, max_size: int | None = None) -> None:
+        # Параметры, которые не передали явно, берутся из настроек в момент использования
+        self._ttl = ttl
+        self._max_size = max_size
+        # (юзер, сумма) -> (когда заказ перестает быть актуальным по time.monotonic(), заказ)
+        self._orders: collections.OrderedDict[tuple[int, int], tuple[float, Order]] = (
+            collections.OrderedDict()
+        )
+        self._creating = SingleFlight()
+
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def ttl(self) -> int:
+        return self._ttl or settings.t_pay.open_order_ttl
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size or settings.t_pay.open_order_cache_size
+
+    def __len__(self) -> int:
+        """Количество заказов в памяти"""
+        return len(self._orders)
+
+    def stats(self) -> dict:
+        """Счетчики: заказы из памяти, из БД, созданные заново и вытесненные из памяти"""
+        return {
+            "hits": self.hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    async def get_or_create(
+        self,
+        customer_key: int,
+        amount: int,
+        create: Callable[[], Awaitable[Order | None]],
+    ) -> Order | None:
+        """Отдаем открытый заказ юзера на сумму amount, а если его нет — создаем вызовом create().
+        None — create() не смог сохранить заказ"""
+        key = (customer_key, amount)
+        if not settings.t_pay.leasing:
+            order = self._get(key)
+            if order is not None:
+                self.hits += 1
+                logger.info(f"Reusing the open order {order.id} of {customer_key}")
+                return order
+        return await self._creating.run(
+            [f"{customer_key}:{amount}"], lambda: self._load_or_create(key, create)
+        )
+
+    def discard(self, order: Order) -> None:
+        """Убираем заказ из памяти, если там лежит именно он"""
+        key = (order.customer_key, order.amount)
+        entry = self._orders.get(key)
+        if entry is not None and str(entry[1].id) == str(order.id):
+            del self._orders[key]
+
+    async def _load_or_create(
+        self, key: tuple[int, int], create: Callable[[], Awaitable[Order | None]]
+    ) -> Order | None:
+        customer_key, amount = key
+        created_after = datetime.datetime.now() - datetime.timedelta(seconds=self.ttl)
+        order = await db.get_open_order(customer_key, amount, created_after)
+        if order is not None:
+            self.db_hits += 1
+            logger.info(f"Reusing the open order {order.id} of {customer_key} from DB")
+        else:
+            self.misses += 1
+            order = await create()
+        if (
+            not settings.t_pay.leasing
+            and order is not None
+            and order.status == StatusCode.new.value
+            and order.url
+        ):
+            self._put(key, order)
+        return order
+
+    def _get(self, key: tuple[int, int]) -> Order | None:
+        entry = self._orders.get(key)
+        if entry is None:
+            return None
+        expires, order = entry
+        if time.monotonic() >= expires or order.status != StatusCode.new.value:
+            del self._orders[key]
+            return None
+        self._orders.move_to_end(key)
+        return order
+
+    def _put(self, key: tuple[int, int], order: Order) -> None:
+        age = 0.0
+        if order.created is not None:
+            age = (datetime.datetime.now() - order.created).total_seconds()
+        self._orders[key] = (time.monotonic() + self.ttl - age, order)
+        self._orders.move_to_end(key)
+        while len(self._orders) > self.max_size:
+            self._orders.popitem(last=False)
+            self.evictions += 1
+
+
+# Общий реестр открытых заказов для хендлера и фоновой проверки
+open_orders = OpenOrders()
+
+metrics.GaugeFunc(
+    "open_orders_cached",
+    "Open orders kept in memory for reuse",
+    lambda: len(open_orders),
+)
+metrics.GaugeFunc(
+    "open_orders_lookups",
+    "Open order lookups: memory hits, DB hits, new orders (misses) and evictions",
+    lambda: {(event,): value for event, value in open_orders.stats().items()},
+    ("event",),
+)
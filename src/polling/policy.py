@@ -0,0 +1,177 @@
+import bisect
+import math
+import random
+
+from src.config import settings
+
+from loguru import logger
+
+
+class LatencyHistogram:
+    """Гистограмма времени, за которое заказы доходят до итогового статуса (CONFIRMED/REJECTED).
+    Корзины растут экспоненциально: от секунды до нескольких суток с шагом factor,
+    поэтому память постоянная, а точность квантилей — в пределах одной корзины"""
+
+    def __init__(
+        self, start: float = 1.0, factor: float = 1.5, max_value: float = 3 * 86400
+    ) -> None:
+        self.bounds: list[float] = []
+        bound = start
+        while bound < max_value:
+            self.bounds.append(bound)
+            bound *= factor
+        self.bounds.append(math.inf)
+        self.counts = [0] * len(self.bounds)
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+
+    def quantile(self, q: float) -> float | None:
+        """Верхняя граница корзины, в которую попадает квантиль q. None, если данных нет"""
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(q * self.count))
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                # У последней корзины нет верхней границы, берем нижнюю
+                return bound if bound != math.inf else self.bounds[-2]
+        return self.bounds[-2]
+
+
+class PollingPolicy:
+    """Политика polling: когда проверять заказ в следующий раз и когда перестать.
+    next_delay() получает номер сделанной попытки и время с начала отслеживания заказа
+    и возвращает паузу до следующей проверки или None, если проверки закончились.
+    observe() получает время, за которое заказ дошел до итогового статуса"""
+
+    def next_delay(self, attempt: int, elapsed: float) -> float | None:
+        raise NotImplementedError
+
+    def observe(self, latency: float) -> None:
+        pass
+
+
+class FixedPolicy(PollingPolicy):
+    """Проверка раз в delay секунд, не больше max_attempts раз.
+    По умолчанию значения берутся из настроек TPay на момент проверки"""
+
+    def __init__(
+        self, delay: float | None = None, max_attempts: int | None = None
+    ) -> None:
+        self._delay = delay
+        self._max_attempts = max_attempts
+
+    def next_delay(self, attempt: int, elapsed: float) -> float | None:
+        max_attempts = self._max_attempts or settings.t_pay.max_attempts
+        if attempt >= max_attempts:
+            return None
+        return self._delay if self._delay is not None else settings.t_pay.delay
+
+
+class AdaptivePolicy(PollingPolicy):
+    """Политика с быстрым стартом и редеющими проверками.
+    Сразу после выдачи ссылки, когда оплачивается большинство заказов, проверяем часто,
+    дальше — ступенями (tiers: пары «до скольких секунд, с каким интервалом»),
+    а после последней ступени интервал растет экспоненциально: каждый следующий
+    равен growth от прошедшего времени, но не больше max_interval.
+    Ко всем интервалам добавляется случайный разброс ±jitter, чтобы проверки
+    заказов, созданных одновременно, не совпадали по времени.
+    Проверки заканчиваются через deadline секунд.
+
+    Ступени подстраиваются под реальные данные: после min_samples наблюдений
+    границы ступеней ставятся на медиану и 90-й перцентиль времени оплаты,
+    а интервалы подбираются так, чтобы внутри каждой ступени было checks_per_tier проверок
+    """
+
+    def __init__(
+        self,
+        tiers: list[tuple[float, float]],
+        deadline: float,
+        jitter: float = 0.1,
+        growth: float = 0.25,
+        min_interval: float = 1.0,
+        max_interval: float = 300.0,
+        min_samples: int = 50,
+        checks_per_tier: int = 5,
+        histogram: LatencyHistogram | None = None,
+    ) -> None:
+        self.tiers = sorted(tiers)
+        self.deadline = deadline
+        self.jitter = jitter
+        self.growth = growth
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.min_samples = min_samples
+        self.checks_per_tier = checks_per_tier
+        self.histogram = histogram or LatencyHistogram()
+
+    def interval(self, elapsed: float) -> float:
+        """Интервал проверки без разброса для заказа, который отслеживается elapsed секунд"""
+        for until, interval in self.tiers:
+            if elapsed < until:
+                return interval
+        last_interval = self.tiers[-1][1] if self.tiers else self.min_interval
+        return min(self.max_interval, max(last_interval, elapsed * self.growth))
+
+    def next_delay(self, attempt: int, elapsed: float) -> float | None:
+        remaining = self.deadline - elapsed
+        if remaining <= 0:
+            return None
+        delay = self.interval(elapsed) * random.uniform(
+            1 - self.jitter, 1 + self.jitter
+        )
+        # Последняя проверка — ровно на дедлайне, чтобы не потерять конец окна оплаты
+        return max(0.0, min(delay, remaining))
+
+    def observe(self, latency: float) -> None:
+        self.histogram.observe(latency)
+        if self.histogram.count >= self.min_samples and (
+            self.histogram.count % self.min_samples == 0
+        ):
+            self.tune()
+
+    def tune(self) -> None:
+        """Пересчитываем ступени по гистограмме времени оплаты"""
+        median = self.histogram.quantile(0.5)
+        p90 = self.histogram.quantile(0.9)
+        if median is None or p90 is None:
+            return
+
+        def clamp(value: float) -> float:
+            return min(self.max_interval, max(self.min_interval, value))
+
+        tiers = [(median, clamp(median / self.checks_per_tier))]
+        if p90 > median:
+            tiers.append((p90, clamp((p90 - median) / self.checks_per_tier)))
+        self.tiers = tiers
+        logger.info(
+            f"Polling tiers tuned by {self.histogram.count} payments "
+            f"(median {median:.0f}s, p90 {p90:.0f}s): {self.tiers}"
+        )
+
+
+def create_policy() -> PollingPolicy:
+    """Создаем политику polling по настройкам TPay"""
+    # Итоговое время ожидания платежа не меняется: delay * max_attempts
+    deadline = settings.t_pay.delay * settings.t_pay.max_attempts
+    if settings.t_pay.mode == "webhook":
+        # Статусы приходят уведомлениями, polling — редкая страховка на все окно оплаты
+        return AdaptivePolicy(
+            tiers=[(deadline, settings.t_pay.safety_net_delay)],
+            deadline=deadline,
+            jitter=settings.t_pay.polling_jitter,
+        )
+    if settings.t_pay.polling_policy == "fixed":
+        return FixedPolicy()
+    return AdaptivePolicy(
+        tiers=settings.t_pay.polling_tiers,
+        deadline=deadline,
+        jitter=settings.t_pay.polling_jitter,
+        min_interval=settings.t_pay.polling_min_interval,
+        max_interval=settings.t_pay.polling_max_interval,
+        min_samples=settings.t_pay.polling_tune_min_samples,
+    )
@@ -0,0 +1,69 @@
+import asyncio
+from typing import Awaitable, Callable, Iterable
+
+from loguru import logger
+
+
+class SingleFlight:
+    """Реестр владения задачами: по каждому ключу одновременно выполняется только одна задача.
+    Задача регистрируется сразу под несколькими ключами (например, id заказа и PaymentId),
+    повторный вызов по любому из них не запускает новую задачу, а подключается к уже идущей
+    и получает ее результат. После завершения задачи ключи освобождаются."""
+
+    def __init__(self) -> None:
+        self._flights: dict[str, asyncio.Task] = {}
+        self._keys: dict[asyncio.Task, set[str]] = {}
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._flights
+
+    def __len__(self) -> int:
+        """Количество выполняющихся задач (а не ключей)"""
+        return len(self._keys)
+
+    def get(self, keys: Iterable[str]) -> asyncio.Task | None:
+        """Ищем выполняющуюся задачу по любому из ключей"""
+        for key in keys:
+            task = self._flights.get(key)
+            if task is not None:
+                return task
+        return None
+
+    def run(
+        self, keys: Iterable[str], factory: Callable[[], Awaitable]
+    ) -> asyncio.Future:
+        """Запускаем задачу под ключами или подключаемся к уже выполняющейся и ждем результат.
+        Возвращаем future, отмена которого не отменяет саму задачу:
+        другие вызывающие продолжают ждать ее результат"""
+        return asyncio.shield(self.start(keys, factory))
+
+    def start(
+        self, keys: Iterable[str], factory: Callable[[], Awaitable]
+    ) -> asyncio.Task:
+        """Запускаем задачу под ключами, если по ним еще ничего не выполняется,
+        и отдаем выполняющуюся задачу без ожидания результата"""
+        keys = [key for key in keys if key is not None]
+        task = self.get(keys)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._keys[task] = set()
+            task.add_done_callback(self._release)
+            logger.debug("Started a single-flight task for keys: {}", keys)
+        else:
+            logger.debug(
+                "Attached to the running single-flight task for keys: {}", keys
+            )
+
+        # Дорегистрируем ключи, которых еще не было (например, появился PaymentId)
+        for key in keys:
+            if key not in self._flights:
+                self._flights[key] = task
+                self._keys[task].add(key)
+        return task
+
+    def _release(self, task: asyncio.Task) -> None:
+        """Освобождаем ключи завершенной задачи и логируем ее ошибку"""
+        for key in self._keys.pop(task, ()):
+            del self._flights[key]
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Single-flight task failed: {task.exception()}")
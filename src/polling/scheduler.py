@@ -0,0 +1,277 @@
+import asyncio
+import datetime
+import heapq
+import itertools
+from typing import Awaitable, Callable
+
+from src import log, metrics
+from src.config import settings
+from src.polling.policy import PollingPolicy, create_policy
+from src.t_payment.models import Order, StatusCode
+
+from loguru import logger
+
+
+class _Check:
+    """Запланированная проверка заказа: сам заказ, номер последней попытки,
+    время начала отслеживания, время, на которое назначена проверка,
+    и future, в который попадет итоговый заказ после финализации.
+    detached — заказ завершили в обход планировщика (например, по уведомлению TPay)
+    """
+
+    __slots__ = ("order", "attempt", "started", "due", "future", "detached")
+
+    def __init__(self, order: Order, started: float, future: asyncio.Future) -> None:
+        self.order = order
+        self.attempt = 0
+        self.started = started
+        self.due = started
+        self.future = future
+        self.detached = False
+
+
+class PollingScheduler:
+    """Единый планировщик polling-проверок платежей.
+    Вместо отдельной корутины со sleep на каждый заказ держим кучу (heap) проверок,
+    упорядоченную по времени, когда проверку пора выполнить. Диспетчер достает созревшие проверки
+    и передает их ограниченному пулу воркеров через очередь конечного размера: если воркеры
+    не успевают, диспетчер ждет (backpressure). Так память и число одновременных GetState
+    не растут вместе с числом открытых заказов.
+
+    check — разовая проверка заказа (обычно TPay.check_order)
+    finalize — реакция на итоговый статус: подтверждение, отмена или лимит попыток
+    policy — когда проверять заказ в следующий раз, по умолчанию создается по настройкам TPay
+    gate — пауза перед выдачей проверок воркерам: например, пока TPay недоступен,
+    проверки копятся в куче и не тратят попытки, а после восстановления идут в обычном порядке
+    record — куда отдавать состояние проверок заказа после каждой попытки (обычно в БД),
+    чтобы после перезапуска продолжить проверки с той же попытки и в то же время
+    """
+
+    def __init__(
+        self,
+        check: Callable[[Order], Awaitable[Order]],
+        finalize: Callable[[Order], Awaitable[Order]],
+        workers: int | None = None,
+        queue_size: int | None = None,
+        policy: PollingPolicy | None = None,
+        gate: Callable[[], Awaitable[None]] | None = None,
+        record: Callable[[Order], None] | None = None,
+    ) -> None:
+        self._check = check
+        self._gate = gate
+        self._record = record
+        self._finalize = finalize
+        self._workers_count = workers or settings.t_pay.polling_workers
+        self._queue_size = queue_size or settings.t_pay.polling_queue_size
+        self.policy = policy or create_policy()
+
+        self._heap: list[tuple[float, int, _Check]] = []
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._queue: asyncio.Queue[_Check] | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._checks: dict[str, _Check] = {}
+
+    def __len__(self) -> int:
+        """Количество заказов, которые сейчас отслеживает планировщик"""
+        return len(self._checks)
+
+    def stats(self) -> dict:
+        """Счетчики планировщика: отслеживаемые заказы, запланированные проверки
+        и проверки, которые ждут свободного воркера"""
+        return {
+            "tracked": len(self._checks),
+            "scheduled": len(self._heap),
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+        }
+
+    def order_ids(self) -> list[str]:
+        """id заказов, которые сейчас отслеживает планировщик"""
+        return list(self._checks)
+
+    @property
+    def is_running(self) -> bool:
+        return bool(self._tasks)
+
+    async def start(self) -> None:
+        """Запускаем диспетчер и пул воркеров"""
+        if self.is_running:
+            return
+        self._queue = asyncio.Queue(maxsize=self._queue_size)
+        self._tasks = [asyncio.create_task(self._dispatch())]
+        self._tasks += [
+            asyncio.create_task(self._work()) for _ in range(self._workers_count)
+        ]
+        logger.info(
+            f"Polling scheduler started: {self._workers_count} workers, "
+            f"queue size {self._queue_size}"
+        )
+
+    async def stop(self) -> None:
+        """Останавливаем диспетчер и воркеров, незавершенные проверки отменяются"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        for check in self._checks.values():
+            check.future.cancel()
+        self._checks.clear()
+        self._heap.clear()
+        self._queue = None
+        logger.info("Polling scheduler stopped")
+
+    def submit(self, order: Order) -> asyncio.Future:
+        """Ставим заказ на проверку. Первая проверка — сразу,
+        дальше планировщик сам переназначает ее до итогового статуса.
+        Если у заказа есть сохраненное состояние проверок (например, после перезапуска),
+        продолжаем с той же попытки, а первая проверка — в назначенное ранее время.
+        Возвращает future с итоговым заказом"""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        if order.poll_attempts and order.created is not None:
+            # Время отслеживания считаем от создания заказа, как будто перезапуска не было
+            started -= (datetime.datetime.now() - order.created).total_seconds()
+        check = _Check(order, started, loop.create_future())
+        check.attempt = order.poll_attempts
+        self._checks[str(order.id)] = check
+        delay = 0.0
+        if order.next_check_at is not None:
+            delay = max(
+                0.0, (order.next_check_at - datetime.datetime.now()).total_seconds()
+            )
+        self._schedule(check, delay)
+        return check.future
+
+    def detach(self, order_id: str) -> asyncio.Future | None:
+        """Снимаем заказ с проверок, когда его итоговый статус узнали в обход планировщика.
+        Возвращаем future заказа, чтобы вызывающий положил в него итоговый заказ,
+        или None, если заказ не отслеживается"""
+        check = self._checks.pop(str(order_id), None)
+        if check is None:
+            return None
+        check.detached = True
+        return check.future
+
+    def _schedule(self, check: _Check, delay: float) -> None:
+        due = asyncio.get_running_loop().time() + delay
+        check.due = due
+        heapq.heappush(self._heap, (due, next(self._sequence), check))
+        self._wakeup.set()
+
+    async def _dispatch(self) -> None:
+        """Диспетчер: ждем ближайшую по времени проверку и отдаем ее воркерам"""
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._heap:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            wait = self._heap[0][0] - loop.time()
+            if wait > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            if self._gate is not None:
+                await self._gate()
+                if not self._heap:
+                    continue
+
+            _, _, check = heapq.heappop(self._heap)
+            if check.detached:
+                continue
+            # Если все воркеры заняты и очередь заполнена, здесь диспетчер и подождет
+            await self._queue.put(check)
+
+    async def _work(self) -> None:
+        """Воркер: выполняем проверки из очереди по одной"""
+        while True:
+            check = await self._queue.get()
+            try:
+                await self._process(check)
+            except Exception as e:
+                logger.error(f"Polling of the order {check.order.id} failed: {e}")
+                self._checks.pop(str(check.order.id), None)
+                if not check.future.done():
+                    check.future.set_exception(e)
+
+    async def _process(self, check: _Check) -> None:
+        """Проверяем заказ и решаем: финализировать или проверить еще раз позже"""
+        # Отставание проверки от назначенного времени: растет, когда воркеры или лимиты TPay не успевают
+        metrics.POLLING_LAG_SECONDS.observe(
+            asyncio.get_running_loop().time() - check.due
+        )
+        check.attempt += 1
+        try:
+            check.order = await self._check(check.order)
+        except Exception as e:
+            # Ошибка одной проверки не должна останавливать polling заказа, это просто неудачная попытка.
+            # Когда TPay недоступен, ошибки идут на каждую проверку — предупреждаем не чаще раза в 5 секунд
+            level = "WARNING" if log.throttle(5) else "DEBUG"
+            logger.log(level, "Payment {} check failed: {}", check.order.payment_id, e)
+
+        if check.detached:
+            return
+
+        order = check.order
+        # Состояние проверок едет вместе с заказом, следующую проверку назначим ниже
+        order.poll_attempts = check.attempt
+        order.last_tpay_status = order.status
+        order.last_checked_at = datetime.datetime.now()
+        order.next_check_at = None
+        elapsed = asyncio.get_running_loop().time() - check.started
+        # Сообщение на каждую проверку: в INFO попадает только каждое n-е, остальные — в DEBUG
+        logger.log(
+            "INFO" if log.sample() else "DEBUG",
+            "Payment {} verification attempt {}: {}",
+            order.payment_id,
+            check.attempt,
+            order.status,
+        )
+
+        if order.status in (
+            StatusCode.confirmed.value,
+            StatusCode.rejected.value,
+            StatusCode.cancelled.value,
+        ):
+            logger.info(
+                f"The order {order.id} has reached the final status: {order.status}"
+            )
+            if order.status != StatusCode.cancelled.value:
+                self.policy.observe(_payment_latency(order, elapsed))
+        else:
+            delay = self.policy.next_delay(check.attempt, elapsed)
+            if delay is not None:
+                self._save_state(order, delay)
+                self._schedule(check, delay)
+                return
+            logger.info(
+                f"Polling spent the maximum number of attempts ({check.attempt})"
+            )
+            order.status = StatusCode.max_attempts.value
+
+        self._checks.pop(str(order.id), None)
+        result = await self._finalize(order)
+        if not check.future.done():
+            check.future.set_result(result)
+
+    def _save_state(self, order: Order, delay: float) -> None:
+        """Отдаем состояние проверок заказа, которому назначена следующая проверка.
+        Состояние заказа, который идет на финализацию, не сохраняется: его итоговый статус пишет finalize
+        """
+        order.next_check_at = order.last_checked_at + datetime.timedelta(seconds=delay)
+        if self._record is not None:
+            self._record(order)
+
+
+def _payment_latency(order: Order, elapsed: float) -> float:
+    """Время от создания заказа до итогового статуса.
+    Если дата создания неизвестна, берем время отслеживания заказа планировщиком"""
+    if order.created is None:
+        return elapsed
+    return (datetime.datetime.now() - order.created).total_seconds()
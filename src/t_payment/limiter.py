@@ -0,0 +1,123 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import time
+
+
+class RateLimiter:
+    """Ограничитель запросов: токен-бакет (rate запросов в секунду, всплеск до burst)
+    плюс не больше max_in_flight одновременных запросов.
+    Ожидающие запросы выстраиваются по приоритету (меньше — важнее), а внутри приоритета — по очереди,
+    поэтому срочные запросы не ждут, пока разойдется фоновая волна.
+    rate <= 0 — без ограничения частоты, max_in_flight <= 0 — без ограничения параллельности.
+
+    Счетчики: сколько запросов прошло, сколько из них ждали, суммарное и максимальное ожидание
+    """
+
+    def __init__(self, name: str, rate: float, burst: int, max_in_flight: int) -> None:
+        self.name = name
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_in_flight = max_in_flight
+
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._in_flight = 0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._timer: asyncio.TimerHandle | None = None
+
+        self.requests = 0
+        self.delayed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def stats(self) -> dict:
+        """Счетчики ограничителя, время — в секундах"""
+        return {
+            "requests": self.requests,
+            "delayed": self.delayed,
+            "wait_total": self.wait_total,
+            "wait_max": self.wait_max,
+            "wait_avg": self.wait_total / self.requests if self.requests else 0.0,
+            "in_flight": self._in_flight,
+            "queued": sum(not future.done() for _, _, future in self._waiters),
+        }
+
+    @contextlib.asynccontextmanager
+    async def limit(self, priority: int = 0):
+        """Контекст запроса: ждем свою очередь, по выходу освобождаем место"""
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, priority: int = 0) -> None:
+        started = time.monotonic()
+        if not self._waiters and self._try_take():
+            self._record(0.0)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        self._wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Место могли выдать одновременно с отменой — тогда его нужно вернуть
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        self._record(time.monotonic() - started)
+
+    def release(self) -> None:
+        self._in_flight -= 1
+        self._wake()
+
+    def _record(self, wait: float) -> None:
+        self.requests += 1
+        if wait > 0:
+            self.delayed += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _try_take(self) -> bool:
+        """Занимаем место, если есть токен и свободный слот"""
+        if 0 < self.max_in_flight <= self._in_flight:
+            return False
+        if self.rate > 0:
+            self._refill()
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+        self._in_flight += 1
+        return True
+
+    def _wake(self) -> None:
+        """Пропускаем ожидающих по приоритету, пока есть места.
+        Если мест нет из-за частоты, заводим таймер до появления следующего токена"""
+        while self._waiters:
+            future = self._waiters[0][2]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            if not self._try_take():
+                break
+            heapq.heappop(self._waiters)
+            future.set_result(None)
+
+        slot_free = self.max_in_flight <= 0 or self._in_flight < self.max_in_flight
+        if self._waiters and slot_free and self._timer is None and self.rate > 0:
+            delay = max(0.0, (1 - self._tokens) / self.rate)
+            self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._wake()
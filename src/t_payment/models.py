@@ -1,5 +1,7 @@
 import datetime
 import enum
+
+import orjson
 from uuid_extensions import uuid7
 
 
@@ -8,14 +10,19 @@ def _create_uuidv7():
 
 
 class Model:
-    """Класс для объектов TPay"""
+    """Класс для объектов TPay.
+    Наследники перечисляют свои поля в __slots__: у объектов нет __dict__,
+    поэтому они компактнее и быстрее создаются, а __repr__ выводит поля в порядке __slots__
+    """
+
+    __slots__ = ()
 
     @classmethod
     def from_dict(cls, model_dict):
         raise NotImplementedError
 
     def __repr__(self):
-        state = ["%s=%s" % (k, repr(v)) for (k, v) in vars(self).items()]
+        state = ["%s=%s" % (k, repr(getattr(self, k))) for k in self.__slots__]
         return "%s(%s)" % (self.__class__.__name__, ", ".join(state))
 
 
@@ -47,13 +54,18 @@ class Order(Model):
     Атрибуты:
     — customer_key — ID в телеге
     — email — почта
-    — receipt — позиции чека
+    — receipt — позиции чека. Из БД чек приходит текстом JSON и разбирается при первом обращении,
+      receipt_changed — чек заменили и его нужно записать в БД (чек заменяют целиком, а не меняют на месте)
     — payment_id — ID платежа в системе TPay
     — description — Описание платежа
     — id — ID заказа для нас и для TPay
     — url — ссылка на платежную форму
     — status — статус заказа
     — created — дата и время создания
+    — poll_attempts — сколько polling-проверок уже сделано
+    — next_check_at — когда проверять заказ в следующий раз
+    — last_tpay_status — статус платежа в TPay по последней проверке
+    — last_checked_at — дата и время последней проверки
 
     Статусы заказа/платежа:
     — CREATED: заказ создан у нас, но его пока нет в TPay,
@@ -62,7 +74,28 @@ class Order(Model):
     — CONFIRMED: платеж успешно оплачен
     — REJECTED: платеж отклонен системой
     — MAX_ATTEMPTS: достигнуто максимальное число проверок
-    — CANCELLED: заказ отклонен нами"""
+    — CANCELLED: заказ отклонен нами
+
+    Порядок полей в __slots__ совпадает с порядком аргументов конструктора:
+    строка из БД с колонками в этом порядке превращается в заказ вызовом Order(*row)"""
+
+    __slots__ = (
+        "amount",
+        "customer_key",
+        "email",
+        "description",
+        "_receipt",
+        "status",
+        "id",
+        "url",
+        "payment_id",
+        "created",
+        "poll_attempts",
+        "next_check_at",
+        "last_tpay_status",
+        "last_checked_at",
+        "receipt_changed",
+    )
 
     def __init__(
         self,
@@ -70,23 +103,52 @@ class Order(Model):
         customer_key: int,
         email: str,
         description: str = "Пополнение аккаунта Voicee",
-        receipt: str | None = None,
+        receipt: dict | str | None = None,
         status: str = StatusCode.created.value,
-        id: str = _create_uuidv7(),
+        id: str | None = None,
         url: str | None = None,
         payment_id: str | None = None,
         created: datetime.datetime | None = None,
+        poll_attempts: int = 0,
+        next_check_at: datetime.datetime | None = None,
+        last_tpay_status: str | None = None,
+        last_checked_at: datetime.datetime | None = None,
+        receipt_changed: bool | None = None,
     ):
         self.amount = amount
         self.customer_key = customer_key
         self.email = email
-        self.receipt = receipt
-        self.payment_id = payment_id
         self.description = description
-        self.id = id
-        self.url = url
+        # Строка — текст JSON из БД, он разбирается только при обращении к receipt
+        self._receipt = receipt
         self.status = status
+        # id по умолчанию создается для каждого заказа, а не один раз при объявлении класса
+        self.id = id if id is not None else _create_uuidv7()
+        self.url = url
+        self.payment_id = payment_id
         self.created = created
+        # Состояние polling: после перезапуска проверки продолжаются с того же места
+        self.poll_attempts = poll_attempts
+        self.next_check_at = next_check_at
+        self.last_tpay_status = last_tpay_status
+        self.last_checked_at = last_checked_at
+        # По умолчанию новым считается чек, который передали объектом, а не текстом из БД
+        self.receipt_changed = (
+            receipt_changed
+            if receipt_changed is not None
+            else receipt is not None and not isinstance(receipt, str)
+        )
+
+    @property
+    def receipt(self) -> dict | None:
+        if isinstance(self._receipt, str):
+            self._receipt = orjson.loads(self._receipt)
+        return self._receipt
+
+    @receipt.setter
+    def receipt(self, receipt: dict | None) -> None:
+        self._receipt = receipt
+        self.receipt_changed = True
 
 
 class Endpoints(enum.Enum):
@@ -95,8 +157,10 @@ class Endpoints(enum.Enum):
     — Init — инициализация платежа
     — GetState — проверка платежа
     — Cancel — отмена платежа
+    — CheckOrder — платежи по номеру заказа (нужен, когда PaymentId еще неизвестен)
     """
 
     init: str = "Init"
     get_state: str = "GetState"
     cancel: str = "Cancel"
+    check_order: str = "CheckOrder"
@@ -0,0 +1,79 @@
+import json
+from typing import Awaitable, Callable
+
+from aiohttp import web
+from src.config import settings
+from src.t_payment.t_payment import TPay
+
+from loguru import logger
+
+
+class NotificationReceiver:
+    """Локальный HTTP-эндпоинт для уведомлений TPay (NotificationURL).
+    Принимает уведомление, проверяет его токен той же подписью, что и запросы к API,
+    и передает данные в on_notification. TPay считает уведомление доставленным,
+    только если получил в ответ текст OK, иначе повторяет его — поэтому обработка должна быть идемпотентной.
+
+    Методы:
+    start() — поднимает HTTP-сервер
+    stop() — останавливает его"""
+
+    def __init__(
+        self, client: TPay, on_notification: Callable[[dict], Awaitable[None]]
+    ) -> None:
+        self.client = client
+        self.on_notification = on_notification
+        self.app = web.Application()
+        self.app.router.add_post(settings.t_pay.webhook_path, self._handle)
+        self._runner: web.AppRunner | None = None
+        self.url: str | None = None
+
+    async def start(self, host: str | None = None, port: int | None = None) -> str:
+        """Поднимаем HTTP-сервер и возвращаем локальный адрес эндпоинта"""
+        host = host or settings.t_pay.webhook_host
+        port = settings.t_pay.webhook_port if port is None else port
+
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}{settings.t_pay.webhook_path}"
+        logger.info(f"TPay notification receiver is listening on {self.url}")
+        return self.url
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+            logger.info("TPay notification receiver stopped")
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        """Проверяем подпись уведомления и передаем его дальше"""
+        try:
+            data = await request.json()
+        except json.JSONDecodeError:
+            logger.warning("Received a TPay notification with invalid JSON")
+            return web.Response(status=400, text="Invalid JSON")
+
+        if not isinstance(data, dict) or not self.client.verify_notification(data):
+            logger.warning(
+                f"Received a TPay notification with an invalid token: {data}"
+            )
+            return web.Response(status=403, text="Invalid token")
+
+        logger.info(
+            f"Received a TPay notification for the payment {data.get('PaymentId')}: "
+            f"{data.get('Status')}"
+        )
+        try:
+            await self.on_notification(data)
+        except Exception as e:
+            # Не отвечаем OK, чтобы TPay повторил уведомление позже
+            logger.error(
+                f"Error processing the notification for the payment {data.get('PaymentId')}: {e}"
+            )
+            return web.Response(status=500, text="Processing error")
+
+        return web.Response(text="OK")
@@ -0,0 +1,174 @@
+import asyncio
+import random
+import time
+
+import httpx
+
+
+class CircuitOpenError(Exception):
+    """Запрос не отправлен: автомат отключения открыт, TPay сейчас считается недоступным"""
+
+
+def is_retryable(error: Exception) -> bool:
+    """Ошибки, после которых запрос имеет смысл повторить: сетевые ошибки, таймауты,
+    ответы 5xx и 429. Ответы TPay с Success=false — это ответ по существу, их не повторяем
+    """
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status >= 500 or status == 429
+    return isinstance(error, (httpx.TransportError, asyncio.TimeoutError))
+
+
+def never_sent(error: Exception) -> bool:
+    """Ошибки, которые доказывают, что TPay не выполнял запрос: соединение не установлено,
+    не дождались соединения из пула, TPay отклонил запрос по лимиту (429) или его не пропустил автомат отключения.
+    После остальных ошибок (таймаут ответа, обрыв соединения, 5xx) запрос мог дойти до TPay и выполниться
+    """
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code == 429
+    return isinstance(
+        error,
+        (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout, CircuitOpenError),
+    )
+
+
+def backoff(attempt: int, base: float, cap: float) -> float:
+    """Пауза перед повтором номер attempt: экспонента с полным джиттером (случайно от 0 до base * 2^attempt),
+    чтобы повторы многих запросов не приходили в TPay одной волной"""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+class RetryBudget:
+    """Бюджет повторов эндпоинта: каждый запрос добавляет ratio повтора, копится не больше maximum,
+    каждый повтор тратит один. При массовых сбоях повторы не умножают нагрузку на TPay:
+    их доля в трафике не превышает ratio"""
+
+    def __init__(self, ratio: float, maximum: int) -> None:
+        self.ratio = ratio
+        self.maximum = maximum
+        self.tokens = float(maximum)
+
+    def deposit(self) -> None:
+        self.tokens = min(self.maximum, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class CircuitBreaker:
+    """Автомат отключения для запросов к TPay.
+    closed — запросы идут как обычно. После failure_threshold ошибок подряд автомат открывается (open):
+    запросы не отправляются reset_timeout секунд. Потом автомат пропускает один пробный запрос (half_open):
+    удачный закрывает автомат, неудачный открывает снова на вдвое большее время, но не больше max_reset_timeout.
+
+    wait() — ждем, пока запросы снова можно отправлять; так фоновые проверки встают на паузу,
+    а не тратят попытки на заведомо неудачные запросы"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int,
+        reset_timeout: float,
+        max_reset_timeout: float,
+    ) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_reset_timeout = reset_timeout
+        self.max_reset_timeout = max(reset_timeout, max_reset_timeout)
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.reset_timeout = reset_timeout
+        self.retry_at = 0.0
+        self._probe_in_flight = False
+        self._changed = asyncio.Event()
+
+        self.opened = 0
+        self.rejected = 0
+
+    def stats(self) -> dict:
+        """Счетчики автомата: состояние, ошибки подряд, сколько раз открывался и сколько запросов отклонил"""
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "opened": self.opened,
+            "rejected": self.rejected,
+        }
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос сейчас. В half_open пропускаем только один пробный запрос"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() >= self.retry_at:
+            self._set_state(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self._probe_in_flight = False
+        if self.state != self.CLOSED:
+            self.reset_timeout = self.base_reset_timeout
+            self._set_state(self.CLOSED)
+
+    def release_probe(self) -> None:
+        """Пробный запрос прервали, не дождавшись ответа (например, отменили задачу):
+        исхода нет, поэтому состояние не меняем, а следующий запрос снова может стать пробным
+        """
+        if self.state == self.HALF_OPEN and self._probe_in_flight:
+            self._probe_in_flight = False
+            self._notify()
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == self.HALF_OPEN:
+            # Пробный запрос не прошел: открываем снова и ждем дольше
+            self._probe_in_flight = False
+            self.reset_timeout = min(self.max_reset_timeout, self.reset_timeout * 2)
+            self._open()
+        elif self.state == self.CLOSED and self.failures >= self.failure_threshold:
+            self._open()
+
+    async def wait(self) -> None:
+        """Ждем, пока запросы можно отправлять: автомат закрыт
+        или пора отправить пробный запрос и его еще никто не отправил"""
+        while True:
+            changed = self._changed
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                return
+            # Пока идет пробный запрос, ждем его результата, в open — времени пробного запроса
+            delay = None
+            if self.state == self.OPEN:
+                delay = self.retry_at - time.monotonic()
+                if delay <= 0:
+                    return
+            try:
+                await asyncio.wait_for(changed.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _open(self) -> None:
+        self.retry_at = time.monotonic() + self.reset_timeout
+        self.opened += 1
+        self._set_state(self.OPEN)
+
+    def _set_state(self, state: str) -> None:
+        self.state = state
+        self._notify()
+
+    def _notify(self) -> None:
+        # Будим всех, кто ждет в wait(): каждый ждет свое событие, поэтому заменяем его новым
+        self._changed.set()
+        self._changed = asyncio.Event()
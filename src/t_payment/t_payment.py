@@ -1,12 +1,28 @@
-from httpx import AsyncClient
+from httpx import AsyncClient, Limits, Timeout
 from src.config import settings
+from src import log, metrics
 import asyncio
 import decimal
+import functools
+import hmac
+import importlib.util
 import json
 import hashlib
+import time
+from typing import Awaitable, Callable
 
 from src.t_payment.models import StatusCode, Endpoints
 from src.t_payment.models import Order
+from src.t_payment.limiter import RateLimiter
+from src.t_payment.resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    RetryBudget,
+    backoff,
+    is_retryable,
+    never_sent,
+)
+from src.polling.policy import PollingPolicy, create_policy
 
 from loguru import logger
 
@@ -14,17 +30,112 @@ from loguru import logger
 #  Сейчас для этого нет механизма: возвращать деньги и обновлять инфу в бд, нужно вручную.
 #  Нужно уточнить процесс и сделать такую функицональность
 
+# Режим подписи для уведомлений TPay на NotificationURL
+NOTIFICATION_MODE = "Notification"
+
+
+# Приоритет эндпоинтов при ограничении запросов: меньше — важнее
+ENDPOINT_PRIORITY = {
+    Endpoints.init.value: 0,
+    Endpoints.check_order.value: 1,
+    Endpoints.cancel.value: 2,
+    Endpoints.get_state.value: 3,
+}
+
+
+def _create_limiters() -> tuple[RateLimiter, dict[str, RateLimiter]]:
+    """Создаем общий ограничитель запросов к TPay и ограничители для каждого эндпоинта"""
+    t_pay = settings.t_pay
+    total_limiter = RateLimiter(
+        "total", t_pay.rate_limit, t_pay.rate_burst, t_pay.max_in_flight
+    )
+    endpoint_limiters = {
+        endpoint.value: RateLimiter(
+            endpoint.value,
+            getattr(t_pay, f"{endpoint.name}_rate_limit"),
+            getattr(t_pay, f"{endpoint.name}_rate_burst"),
+            getattr(t_pay, f"{endpoint.name}_max_in_flight"),
+        )
+        for endpoint in Endpoints
+    }
+    return total_limiter, endpoint_limiters
+
+
+class TPayError(Exception):
+    """TPay ответил на запрос ошибкой (Success=false)"""
 
-async def _send_request(endpoint, params=None) -> json:
-    """Универсальный внутренний метод для создания асинхронного запроса к API с нужными параметрами"""
-    headers = {"Content-Type": "application/json"}
-    async with AsyncClient() as async_client:
-        async_response = await async_client.post(
-            url=settings.t_pay.tpay_url + endpoint,
-            headers=headers,
-            json=params,
+    def __init__(self, endpoint: str, response: dict) -> None:
+        self.endpoint = endpoint
+        self.error_code = response.get("ErrorCode")
+        self.response = response
+        super().__init__(
+            f"TPay {endpoint} failed with the error {self.error_code}: "
+            f"{response.get('Message')} {response.get('Details') or ''}".rstrip()
         )
-        return async_response.json(parse_float=decimal.Decimal)
+
+
+def _create_breaker() -> CircuitBreaker:
+    """Общий автомат отключения для всех запросов к TPay: при сбое API недоступны все эндпоинты"""
+    t_pay = settings.t_pay
+    return CircuitBreaker(
+        "TPay",
+        t_pay.breaker_failures,
+        t_pay.breaker_reset_timeout,
+        t_pay.breaker_max_reset_timeout,
+    )
+
+
+def _token_value(value) -> str:
+    """Приводим значение параметра к строке так, как его подписывает TPay"""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+def _create_http_client() -> AsyncClient:
+    """Создаем HTTP-клиента с пулом соединений по настройкам TPay.
+    Соединения переиспользуются между запросами (keep-alive), поэтому TCP+TLS рукопожатие
+    происходит один раз на соединение, а не на каждый Init/GetState/Cancel"""
+    http2 = settings.t_pay.http2
+    if http2 and importlib.util.find_spec("h2") is None:
+        logger.warning(
+            "HTTP/2 is enabled, but the h2 package is not installed. Using HTTP/1.1"
+        )
+        http2 = False
+
+    return AsyncClient(
+        base_url=settings.t_pay.tpay_url,
+        headers={"Content-Type": "application/json"},
+        limits=Limits(
+            max_connections=settings.t_pay.http_max_connections,
+            max_keepalive_connections=settings.t_pay.http_max_keepalive_connections,
+            keepalive_expiry=settings.t_pay.http_keepalive_expiry,
+        ),
+        timeout=Timeout(
+            settings.t_pay.http_timeout, connect=settings.t_pay.http_connect_timeout
+        ),
+        http2=http2,
+    )
+
+
+async def _send_request(
+    endpoint, params=None, client: AsyncClient | None = None
+) -> json:
+    """Универсальный внутренний метод для создания асинхронного запроса к API с нужными параметрами.
+    Если клиент не передан, создается одноразовый клиент без пула соединений"""
+    if client is None:
+        async with AsyncClient() as async_client:
+            async_response = await async_client.post(
+                url=settings.t_pay.tpay_url + endpoint,
+                headers={"Content-Type": "application/json"},
+                json=params,
+            )
+            return async_response.json(parse_float=decimal.Decimal)
+
+    async_response = await client.post(url=endpoint, json=params)
+    # Ответы 4xx и 5xx — не ответ API по существу, а ошибка, которую решает повторять ли _request
+    async_response.raise_for_status()
+    return async_response.json(parse_float=decimal.Decimal)
 
 
 class TPay:
@@ -32,17 +143,219 @@ class TPay:
     create_order_link() — формирует платеж в системе и отдает ссылку для оплаты
     check_order() — разовая проверка статуса платежа
     check_order_polling() — перманентный метод для проверки платежа в формате polling
-                            (раз в несколько секунд, определенное количество раз, в зависимости от настроек)
+                            (с паузами и лимитом по политике polling, в зависимости от настроек)
     cancel_payment() — отменяет платеж
-    update_order() — обновляет статус-код в инстансе заказа"""
+    update_order() — обновляет статус-код в инстансе заказа
+    open()/close() — открывают и закрывают общий пул HTTP-соединений,
+                     клиент можно использовать и как асинхронный контекстный менеджер
+    limiter_stats() — счетчики ограничителей запросов, в том числе время ожидания в очереди
+    breaker_stats() — состояние автомата отключения запросов
+    wait_available() — ждет, пока автомат отключения снова пропускает запросы
+    """
+
+    def __init__(
+        self, tpay_term_key: str | None = None, tpay_password: str | None = None
+    ) -> None:
+        # Креды по умолчанию, ограничители и автомат отключения берутся из настроек при первом запросе,
+        # поэтому создание клиента не читает настройки
+        self._tpay_term_key = tpay_term_key
+        self._tpay_password = tpay_password
+        self._http: AsyncClient | None = None
+
+    @property
+    def tpay_term_key(self) -> str:
+        return self._tpay_term_key or settings.t_pay.tpay_term_key
+
+    @property
+    def tpay_password(self) -> str:
+        return self._tpay_password or settings.t_pay.tpay_pass
+
+    @functools.cached_property
+    def _limiters(self) -> tuple[RateLimiter, dict[str, RateLimiter]]:
+        return _create_limiters()
+
+    @property
+    def _limiter(self) -> RateLimiter:
+        return self._limiters[0]
+
+    @property
+    def _endpoint_limiters(self) -> dict[str, RateLimiter]:
+        return self._limiters[1]
+
+    @functools.cached_property
+    def _breaker(self) -> CircuitBreaker:
+        return _create_breaker()
+
+    @functools.cached_property
+    def _retry_budgets(self) -> dict[str, RetryBudget]:
+        return {
+            endpoint.value: RetryBudget(
+                settings.t_pay.retry_budget_ratio, settings.t_pay.retry_budget_max
+            )
+            for endpoint in Endpoints
+        }
+
+    async def open(self) -> None:
+        """Открываем пул HTTP-соединений. Вызывается на старте приложения"""
+        if self._http is None or self._http.is_closed:
+            self._http = _create_http_client()
+            logger.info("TPay HTTP connection pool opened")
+
+    async def close(self) -> None:
+        """Закрываем пул HTTP-соединений. Вызывается при остановке приложения"""
+        if self._http is not None and not self._http.is_closed:
+            await self._http.aclose()
+            logger.info("TPay HTTP connection pool closed")
+        self._http = None
+
+    async def __aenter__(self) -> "TPay":
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        await self.close()
+
+    def _get_http(self) -> AsyncClient:
+        """Отдаем общий HTTP-клиент. Если пул еще не открыли явно, открываем его лениво"""
+        if self._http is None or self._http.is_closed:
+            self._http = _create_http_client()
+        return self._http
+
+    def limiter_stats(self) -> dict[str, dict]:
+        """Счетчики общего ограничителя и ограничителей каждого эндпоинта"""
+        limiters = [self._limiter, *self._endpoint_limiters.values()]
+        return {limiter.name: limiter.stats() for limiter in limiters}
+
+    def breaker_stats(self) -> dict:
+        """Счетчики автомата отключения запросов к TPay"""
+        return self._breaker.stats()
+
+    async def wait_available(self) -> None:
+        """Ждем, пока запросы к TPay снова можно отправлять (автомат отключения не открыт)"""
+        await self._breaker.wait()
+
+    async def _request(
+        self,
+        endpoint: str,
+        params: dict,
+        reached: Callable[[], Awaitable[bool]] | None = None,
+    ) -> json:
+        """Отправляем запрос к API через автомат отключения и с повторами.
+        Сетевые ошибки, таймауты и ответы 5xx/429 повторяются с экспоненциальной паузой и джиттером,
+        пока не кончатся попытки эндпоинта, его бюджет повторов или время retry_deadline.
+        Пока автомат отключения открыт, запрос не отправляется и сразу падает с CircuitOpenError.
+        reached — проверка для неидемпотентных запросов (Init): выполнил ли TPay запрос, на который не пришел ответ.
+        Если ошибка не доказывает, что запрос не дошел до TPay, повторяем его, только если проверка ответила «нет»
+        """
+        t_pay = settings.t_pay
+        attempts = getattr(t_pay, f"{Endpoints(endpoint).name}_attempts")
+        budget = self._retry_budgets[endpoint]
+        budget.deposit()
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            if not self._breaker.allow():
+                metrics.TPAY_REQUESTS.inc(endpoint=endpoint, outcome="rejected")
+                raise CircuitOpenError(
+                    f"TPay requests are paused after {self._breaker.failures} failures"
+                )
+            # В half_open автомат пропускает только пробный запрос
+            probe = self._breaker.state == CircuitBreaker.HALF_OPEN
+            try:
+                response = await self._send(endpoint, params)
+            except BaseException as e:
+                if not isinstance(e, Exception):
+                    # Запрос прервали (отмена, таймаут вызывающего, остановка): исхода нет,
+                    # но пробный запрос нужно отпустить, иначе автомат не пропустит больше ни одного
+                    if probe:
+                        self._breaker.release_probe()
+                    raise
+                if not is_retryable(e):
+                    # TPay ответил, пусть и ошибкой: API доступен
+                    self._breaker.record_success()
+                    raise
+                self._breaker.record_failure()
+                delay = backoff(attempt, t_pay.retry_base_delay, t_pay.retry_max_delay)
+                if (
+                    attempt >= attempts
+                    or time.monotonic() - started + delay > t_pay.retry_deadline
+                ):
+                    raise
+                if (
+                    reached is not None
+                    and not never_sent(e)
+                    and await self._reached(endpoint, reached)
+                ):
+                    raise
+                if not budget.withdraw():
+                    raise
+                metrics.TPAY_RETRIES.inc(endpoint=endpoint)
+                level = "WARNING" if log.throttle(5) else "DEBUG"
+                logger.log(
+                    level,
+                    "TPay {} attempt {} failed: {!r}, retrying in {:.2f} s",
+                    endpoint,
+                    attempt,
+                    e,
+                    delay,
+                )
+                await asyncio.sleep(delay)
+                continue
+
+            self._breaker.record_success()
+            return response
+
+    async def _reached(
+        self, endpoint: str, reached: Callable[[], Awaitable[bool]]
+    ) -> bool:
+        """Выполнил ли TPay запрос, на который не пришел ответ. Если проверить не удалось, считаем, что выполнил:
+        повтор неидемпотентного запроса опаснее ошибки"""
+        try:
+            done = await reached()
+        except Exception as e:
+            logger.warning(
+                "Could not check whether TPay {} went through: {!r}", endpoint, e
+            )
+            return True
+        if done:
+            logger.warning(
+                "TPay {} went through without a response, not retrying", endpoint
+            )
+        return done
 
-    def __init__(self, tpay_term_key: str, tpay_password: str) -> None:
-        self.tpay_term_key = tpay_term_key
-        self.tpay_password = tpay_password
+    async def _send(self, endpoint: str, params: dict) -> json:
+        """Одна попытка запроса через ограничители: сначала ждем место у эндпоинта,
+        затем в общем лимите, где очередь упорядочена по приоритету эндпоинта.
+        Попытка целиком (вместе с ожиданием соединения из пула) ограничена http_timeout.
+        Время самого запроса и его исход пишутся в метрики, ожидание в очереди видно по счетчикам ограничителей
+        """
+        priority = ENDPOINT_PRIORITY.get(endpoint, len(ENDPOINT_PRIORITY))
+        async with self._endpoint_limiters[endpoint].limit(priority):
+            async with self._limiter.limit(priority):
+                started = time.perf_counter()
+                outcome = "error"
+                try:
+                    response = await asyncio.wait_for(
+                        _send_request(endpoint, params, self._get_http()),
+                        settings.t_pay.http_timeout,
+                    )
+                    if isinstance(response, dict) and response.get("Success"):
+                        outcome = "success"
+                    else:
+                        outcome = "failure"
+                    return response
+                finally:
+                    metrics.TPAY_REQUEST_SECONDS.observe(
+                        time.perf_counter() - started, endpoint=endpoint
+                    )
+                    metrics.TPAY_REQUESTS.inc(endpoint=endpoint, outcome=outcome)
 
     def _generate_token(self, data: dict, mode: str) -> str:
         """Метод для генерации токена, подписывающего запрос
-        Mode: init — инициализация платежа, check — проверка, cancel — отмена"""
+        Mode: init — инициализация платежа, check — проверка, cancel — отмена,
+        check_order — платежи по номеру заказа,
+        notification — проверка подписи уведомления от TPay"""
         params = []
         if mode == Endpoints.init.value:
             # Собираем массив пар Ключ-Значение для создания платежа
@@ -53,12 +366,26 @@ class TPay:
                 ["Description", data.get("Description")],
                 ["CustomerKey", data.get("CustomerKey")],
             ]
+            if data.get("NotificationURL"):
+                params += [["NotificationURL", data.get("NotificationURL")]]
+        elif mode == Endpoints.check_order.value:
+            params = [
+                ["TerminalKey", data.get("TerminalKey")],
+                ["OrderId", data.get("OrderId")],
+            ]
         elif mode in (Endpoints.get_state.value, Endpoints.cancel.value):
             # Собираем массив пар Ключ-Значение
             params = [
                 ["TerminalKey", data.get("TerminalKey")],
                 ["PaymentId", data.get("PaymentId")],
             ]
+        elif mode == NOTIFICATION_MODE:
+            # В уведомлении подписаны все параметры корневого уровня, кроме самого токена и вложенных объектов
+            params = [
+                [key, _token_value(value)]
+                for key, value in data.items()
+                if key != "Token" and not isinstance(value, (dict, list))
+            ]
         # Добавляем пароль — обязательное требование для формирования нужного токена
         params += [["Password", self.tpay_password]]
         # Сортируем массив по ключам
@@ -69,8 +396,18 @@ class TPay:
         token = hashlib.sha256(concatenated_values.encode()).hexdigest()
         return token
 
+    def verify_notification(self, data: dict) -> bool:
+        """Проверяем, что уведомление пришло от TPay: его токен совпадает с нашей подписью"""
+        token = data.get("Token")
+        if not isinstance(token, str):
+            return False
+        expected_token = self._generate_token(data, mode=NOTIFICATION_MODE)
+        return hmac.compare_digest(token, expected_token)
+
     async def create_order_link(self, order: Order) -> Order:
-        """Метод, который создает заказ в TPay и возвращает объект заказа"""
+        """Метод, который создает заказ в TPay и возвращает объект заказа.
+        Если TPay ответил ошибкой, бросает TPayError, если недоступен — ошибку запроса или CircuitOpenError
+        """
         endpoint = Endpoints.init.value
 
         # Заполняем параметры для запроса
@@ -97,6 +434,10 @@ class TPay:
                 ],
             },
         }
+        # В режиме уведомлений TPay сам присылает изменения статуса на наш адрес
+        if settings.t_pay.notification_url:
+            params["NotificationURL"] = settings.t_pay.notification_url
+
         # Генерируем токен и отправляем запрос
         params["Token"] = await asyncio.to_thread(
             self._generate_token, params, mode=endpoint
@@ -105,27 +446,46 @@ class TPay:
         # TODO: Реализовать добавление чека в объект лучше, мб через промежуточную модельку
         order.receipt = params["Receipt"]
 
-        logger.info(f"Sending the request: {params}")
-        create_order_response = await _send_request(endpoint, params)
-        logger.debug(f"The response: {create_order_response}")
+        logger.info("Sending the Init request for the order {}", order.id)
+        logger.debug("The request: {}", params)
+        # Init не идемпотентен: если ответ не пришел, повторяем, только когда TPay не создал платеж по заказу
+        create_order_response = await self._request(
+            endpoint, params, reached=functools.partial(self._order_exists, order)
+        )
+        logger.debug("The response: {}", create_order_response)
 
         if create_order_response["Success"]:
             # Выводим id платежа и содержимое ответа для дебага
             logger.info(
-                f"The response has been received. Payment id is: {create_order_response['PaymentId']}"
-            )
-            logger.debug(
-                f"The response of {create_order_response['PaymentId']} is: {create_order_response}"
+                "The response has been received. Payment id is: {}",
+                create_order_response["PaymentId"],
             )
 
             # Обновляем поля объекта заказа, выводим для дебага
             order.payment_id = create_order_response["PaymentId"]
             order.url = create_order_response["PaymentURL"]
             order.status = create_order_response["Status"]
-            logger.debug(f"The order object has been updated: {order}")
+            logger.debug("The order object has been updated: {}", order)
 
             return order
 
+        raise TPayError(endpoint, create_order_response)
+
+    async def _order_exists(self, order: Order) -> bool:
+        """Есть ли в TPay платеж по заказу (CheckOrder по OrderId).
+        Нужен после Init без ответа: PaymentId еще неизвестен, поэтому GetState не подходит
+        """
+        endpoint = Endpoints.check_order.value
+        params = {"TerminalKey": self.tpay_term_key, "OrderId": str(order.id)}
+        params["Token"] = await asyncio.to_thread(
+            self._generate_token, params, mode=endpoint
+        )
+
+        response = await self._request(endpoint, params)
+        if not response["Success"]:
+            raise TPayError(endpoint, response)
+        return bool(response.get("Payments"))
+
     async def check_order(self, order: Order) -> Order:
         """Метод для разовой проверки платежа.
         Подходит для финальной сверки и полинга, в режиме хуков избыточен"""
@@ -141,38 +501,41 @@ class TPay:
         )
 
         # Делаем запрос
-        checked_order_response = await _send_request(endpoint, params)
+        checked_order_response = await self._request(endpoint, params)
+        if not checked_order_response["Success"]:
+            raise TPayError(endpoint, checked_order_response)
 
         # Обновляем статус платежа в объекте
         order.status = checked_order_response["Status"]
-        logger.debug(f"Order has been updated: {checked_order_response}")
+        logger.debug("Order has been updated: {}", checked_order_response)
 
         return order
 
-    async def check_order_polling(self, order: Order) -> Order:
-        """Метод для проверки платежа в формате polling:
-        раз в несколько секунд, какое-то количество раз (в зависимости от настроек).
+    async def check_order_polling(
+        self, order: Order, policy: PollingPolicy | None = None
+    ) -> Order:
+        """Метод для проверки платежа в формате polling: паузы между проверками
+        и момент, когда проверки заканчиваются, определяет политика polling (по умолчанию — из настроек).
         Подходит, когда нет возможности работать с хуками и нужно проверять все руками.
         """
+        policy = policy or create_policy()
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        attempt = 0
 
-        # Проверяем платеж раз в DELAY секунд MAX_ATTEMPTS раз (+1, чтобы начинался с 1 и заканчивался max_attempts)
-        for attempt in range(1, settings.t_pay.max_attempts + 1):
+        while True:
+            attempt += 1
             # Вызываем метод разовой проверки статуса заказа
             order = await self.check_order(order)
-            logger.info(
-                f"Payment {order.payment_id} verification attempt {attempt} "
-                f"out of {settings.t_pay.max_attempts} possible: {order.status}"
+            logger.log(
+                "INFO" if log.sample() else "DEBUG",
+                "Payment {} verification attempt {}: {}",
+                order.payment_id,
+                attempt,
+                order.status,
             )
 
-            # Проверяем на максимальное количество попыток
-            if attempt == settings.t_pay.max_attempts:
-                logger.info(
-                    f"Polling spent the maximum number of attempts ({settings.t_pay.max_attempts})"
-                )
-                order.status = StatusCode.max_attempts.value
-                return order
-
-            elif order.status in (
+            if order.status in (
                 StatusCode.rejected.value,
                 StatusCode.cancelled.value,
             ):
@@ -183,15 +546,19 @@ class TPay:
                 logger.info(f"The order has been confirmed. Status: {order.status}")
                 return order
 
-            # Делаем паузу между запросами проверки для polling
-            await asyncio.sleep(settings.t_pay.delay)
+            # Проверяем, не закончились ли попытки, и делаем паузу между запросами проверки
+            delay = policy.next_delay(attempt, loop.time() - started)
+            if delay is None:
+                logger.info(f"Polling spent the maximum number of attempts ({attempt})")
+                order.status = StatusCode.max_attempts.value
+                return order
 
-        return order
+            await asyncio.sleep(delay)
 
     async def cancel_payment(self, order: Order) -> Order:
         """Метод для ручного удаления платежа. Можно удалить платеж после окончания
         попыток проверки в polling-режиме, чтобы точно не пропустить платеж."""
-        logger.debug(f"Canceling a payment in the client: {order}")
+        logger.debug("Canceling a payment in the client: {}", order)
 
         endpoint = Endpoints.cancel.value
         params = {
@@ -204,15 +571,19 @@ class TPay:
         )
 
         # Вызываем метод отмены заказа
-        checked_order_response = await _send_request(endpoint, params)
-        logger.debug(f"The response: {checked_order_response}")
+        checked_order_response = await self._request(endpoint, params)
+        logger.debug("The response: {}", checked_order_response)
+        if not checked_order_response["Success"]:
+            raise TPayError(endpoint, checked_order_response)
 
         # Обновляем статус платежа в объекте
         order.status = checked_order_response["Status"]
 
         logger.info(f"Canceling the payment {order.payment_id}")
         logger.debug(
-            f"The response to the cancellation of payment {order.payment_id}: {order}"
+            "The response to the cancellation of payment {}: {}",
+            order.payment_id,
+            order,
         )
 
         return order
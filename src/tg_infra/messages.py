@@ -0,0 +1,328 @@
+import asyncio
+import collections
+import functools
+import heapq
+import itertools
+import time
+
+import aiohttp
+from aiogram.utils.exceptions import NetworkError, RetryAfter, TelegramAPIError
+from src import log, metrics
+from src.config import settings
+from src.db_infra import db
+from src.t_payment.limiter import RateLimiter
+
+from loguru import logger
+
+# Сколько сохраненных сообщений забираем из БД за раз
+_TAKE_BATCH = 1000
+
+# Пауза перед повторной попыткой забрать сообщения из БД, если БД недоступна
+_TAKE_RETRY_DELAY = 5.0
+
+
+class MessageQueue:
+    """Общая очередь исходящих сообщений юзерам.
+    send_message() только ставит сообщение в очередь и сразу возвращается, поэтому обработка статусов
+    не ждет доставки в Telegram. Отправляет один фоновый цикл с лимитами Telegram: не больше rate сообщений
+    в секунду всего и одно сообщение в chat_interval секунд в один чат, до max_in_flight отправок одновременно.
+    Сообщения одного чата уходят по порядку, а чаты между собой — по очереди, поэтому один чат
+    с кучей сообщений не задерживает остальных.
+
+    Если Telegram просит подождать (RetryAfter), вся отправка встает на паузу на указанное время
+    и сообщение уходит заново. Сетевые ошибки повторяются до attempts раз, остальные ошибки Telegram
+    (юзер заблокировал бота, чат не найден) повторять бессмысленно — такие сообщения отбрасываем.
+
+    В памяти держится до max_size сообщений. Все, что сверх, и все неотправленное при остановке
+    сохраняется в БД и отправляется, когда очередь освободится, в том числе после перезапуска.
+    Пока сообщения чата лежат в БД, новые сообщения этого чата тоже уходят в БД, чтобы не обогнать их.
+
+    Методы:
+    start() — запускает отправку через бота и подхватывает сохраненные в БД сообщения
+    send_message() — ставит сообщение в очередь, вызывается так же, как у бота
+    close() — дожидается текущих отправок и сохраняет неотправленное в БД
+    """
+
+    def __init__(
+        self,
+        rate: float | None = None,
+        chat_interval: float | None = None,
+        max_in_flight: int | None = None,
+        max_size: int | None = None,
+        attempts: int | None = None,
+    ) -> None:
+        # Параметры, которые не передали явно, берутся из настроек в момент использования
+        self._rate = rate
+        self._chat_interval = chat_interval
+        self._max_in_flight = max_in_flight
+        self._max_size = max_size
+        self._attempts = attempts
+
+        self._bot = None
+        # Сообщения по чатам: текст и номер попытки. Чат есть в словаре, пока у него есть сообщения,
+        # идет отправка или не прошло chat_interval после последней отправки
+        self._chats: dict[int, collections.deque[tuple[str, int]]] = {}
+        # Чаты с сообщениями, упорядоченные по времени, когда в чат снова можно писать
+        self._ready: list[tuple[float, int, int]] = []
+        self._sequence = itertools.count()
+        self._size = 0
+        self._paused_until = 0.0
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._sends: set[asyncio.Task] = set()
+
+        # Сообщения, которые не поместились в очередь и ждут записи в БД
+        self._overflow: list[tuple[int, str]] = []
+        # Чаты, чьи сообщения ушли в БД: пока БД не опустеет, их новые сообщения тоже идут туда
+        self._diverted: set[int] = set()
+        self._saving: asyncio.Task | None = None
+        # В БД могут быть сохраненные сообщения: при старте проверяем всегда
+        self._stored = True
+        self._take_at = 0.0
+
+        self.sent = 0
+        self.dropped = 0
+        self.throttled = 0
+        self.persisted = 0
+        self.restored = 0
+
+    @property
+    def chat_interval(self) -> float:
+        if self._chat_interval is None:
+            return settings.tg.message_chat_interval
+        return self._chat_interval
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size or settings.tg.message_queue_size
+
+    @property
+    def attempts(self) -> int:
+        return self._attempts or settings.tg.message_attempts
+
+    @functools.cached_property
+    def limiter(self) -> RateLimiter:
+        """Общий лимит Telegram на отправку сообщений"""
+        rate = settings.tg.message_rate if self._rate is None else self._rate
+        return RateLimiter(
+            "telegram",
+            rate,
+            burst=int(rate),
+            max_in_flight=self._max_in_flight or settings.tg.message_max_in_flight,
+        )
+
+    def __len__(self) -> int:
+        """Количество сообщений в очереди в памяти"""
+        return self._size
+
+    def stats(self) -> dict:
+        """Счетчики очереди: отправленные, отброшенные, паузы по RetryAfter,
+        сохраненные в БД и поднятые из БД сообщения"""
+        return {
+            "queued": self._size,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "throttled": self.throttled,
+            "persisted": self.persisted,
+            "restored": self.restored,
+        }
+
+    async def start(self, bot) -> None:
+        """Запускаем отправку сообщений через бота"""
+        if self._task is not None:
+            return
+        self._bot = bot
+        self._task = asyncio.create_task(self._run())
+        logger.info(
+            f"Telegram message queue started: {self.limiter.rate} messages/s, "
+            f"{self.chat_interval}s per chat, queue size {self.max_size}"
+        )
+
+    async def close(self) -> None:
+        """Останавливаем отправку, дожидаемся текущих отправок
+        и сохраняем в БД все, что не успели отправить"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._sends:
+            await asyncio.gather(*self._sends, return_exceptions=True)
+        if self._saving is not None:
+            await asyncio.gather(self._saving, return_exceptions=True)
+
+        pending = [
+            (chat_id, text) for chat_id, chat in self._chats.items() for text, _ in chat
+        ]
+        self._chats.clear()
+        self._ready.clear()
+        self._size = 0
+        if pending:
+            self._overflow.extend(pending)
+            await self._save()
+        logger.info(f"Telegram message queue stopped, {len(pending)} messages saved")
+
+    async def send_message(self, chat_id: int, text: str) -> None:
+        """Ставим сообщение в очередь. Если очередь заполнена или более ранние сообщения чата
+        еще лежат в БД, сообщение уходит в БД"""
+        if self._size >= self.max_size or chat_id in self._diverted:
+            self._diverted.add(chat_id)
+            self._overflow.append((chat_id, text))
+            if self._saving is None:
+                self._saving = asyncio.create_task(self._save())
+            return
+        self._push(chat_id, text)
+
+    def _push(
+        self, chat_id: int, text: str, attempt: int = 1, first: bool = False
+    ) -> None:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = collections.deque()
+            heapq.heappush(self._ready, (0.0, next(self._sequence), chat_id))
+            self._wakeup.set()
+        if first:
+            chat.appendleft((text, attempt))
+        else:
+            chat.append((text, attempt))
+        self._size += 1
+
+    async def _run(self) -> None:
+        """Цикл отправки: ждем чат, в который уже можно писать, и место в лимите Telegram"""
+        while True:
+            await self._restore()
+
+            delay = None
+            if self._ready:
+                ready_at = max(self._ready[0][0], self._paused_until)
+                delay = ready_at - time.monotonic()
+            if delay is None or delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            if not self._chats[self._ready[0][2]]:
+                # В чат недавно писали, и новых сообщений для него нет: убираем чат из очереди
+                _, _, chat_id = heapq.heappop(self._ready)
+                del self._chats[chat_id]
+                continue
+
+            await self.limiter.acquire()
+            if (
+                time.monotonic() < self._paused_until
+                or not self._chats[self._ready[0][2]]
+            ):
+                # Пока ждали лимит, Telegram попросил подождать или очередь чатов изменилась
+                self.limiter.release()
+                continue
+            _, _, chat_id = heapq.heappop(self._ready)
+            text, attempt = self._chats[chat_id].popleft()
+            self._size -= 1
+            task = asyncio.create_task(self._send(chat_id, text, attempt))
+            self._sends.add(task)
+            task.add_done_callback(self._sends.discard)
+
+    async def _send(self, chat_id: int, text: str, attempt: int) -> None:
+        """Отправляем одно сообщение, по ошибке решаем: повторить или отбросить"""
+        try:
+            with metrics.measure(
+                metrics.TELEGRAM_SEND_SECONDS,
+                metrics.TELEGRAM_MESSAGES,
+                method="send_message",
+            ):
+                await self._bot.send_message(chat_id, text)
+            self.sent += 1
+        except RetryAfter as e:
+            # Превысили лимит Telegram: ставим всю отправку на паузу, сообщение отправим заново
+            self.throttled += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + e.timeout)
+            logger.warning(f"Telegram flood control, sending paused for {e.timeout}s")
+            self._push(chat_id, text, attempt, first=True)
+        except (NetworkError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt < self.attempts:
+                self._push(chat_id, text, attempt + 1, first=True)
+            else:
+                self.dropped += 1
+                logger.error(f"Failed to send a message to {chat_id}: {e!r}")
+        except TelegramAPIError as e:
+            self.dropped += 1
+            logger.warning(f"Telegram rejected a message to {chat_id}: {e!r}")
+        except Exception as e:
+            self.dropped += 1
+            logger.error(f"Failed to send a message to {chat_id}: {e!r}")
+        finally:
+            self.limiter.release()
+            self._reschedule(chat_id)
+
+    def _reschedule(self, chat_id: int) -> None:
+        """После отправки в чат можно писать не раньше, чем через chat_interval.
+        Чат остается в очереди до этого времени, даже если сообщений для него больше нет,
+        чтобы новое сообщение не ушло раньше"""
+        if chat_id not in self._chats:
+            return
+        ready_at = time.monotonic() + self.chat_interval
+        heapq.heappush(self._ready, (ready_at, next(self._sequence), chat_id))
+        self._wakeup.set()
+
+    async def _save(self) -> None:
+        """Пишем в БД сообщения, которые не поместились в очередь, пока они не кончатся"""
+        try:
+            while self._overflow:
+                batch, self._overflow = self._overflow, []
+                try:
+                    self.persisted += await db.save_messages(batch)
+                    self._stored = True
+                except Exception as e:
+                    self.dropped += len(batch)
+                    logger.error(f"Failed to save {len(batch)} messages: {e}")
+        finally:
+            self._saving = None
+
+    async def _restore(self) -> None:
+        """Когда очередь освободилась, поднимаем сохраненные в БД сообщения"""
+        if not self._stored or self._size > self.max_size // 2:
+            return
+        if self._saving is not None or time.monotonic() < self._take_at:
+            return
+        limit = min(_TAKE_BATCH, self.max_size - self._size)
+        # Если за время запроса _save() запишет новые сообщения, он снова поднимет флаг
+        self._stored = False
+        try:
+            messages = await db.take_messages(limit)
+        except Exception as e:
+            self._stored = True
+            self._take_at = time.monotonic() + _TAKE_RETRY_DELAY
+            if log.throttle(60):
+                logger.warning(f"Failed to load saved messages: {e}")
+            return
+        if len(messages) == limit:
+            self._stored = True
+        self.restored += len(messages)
+        for chat_id, text in messages:
+            self._push(chat_id, text)
+        if not self._stored and self._saving is None and not self._overflow:
+            # В БД сообщений больше нет: новые сообщения всех чатов снова идут в память
+            self._diverted.clear()
+
+
+# Общая очередь сообщений для всех частей приложения
+message_queue = MessageQueue()
+
+metrics.GaugeFunc(
+    "telegram_queue_size",
+    "Messages waiting in the Telegram send queue",
+    lambda: len(message_queue),
+)
+metrics.GaugeFunc(
+    "telegram_queue_events",
+    "Telegram send queue counters: sent, dropped, throttled (flood control), "
+    "persisted to and restored from the DB",
+    lambda: {
+        (event,): value
+        for event, value in message_queue.stats().items()
+        if event != "queued"
+    },
+    ("event",),
+)
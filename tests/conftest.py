@@ -1,7 +1,7 @@
 import pytest
 from src.t_payment.t_payment import TPay
 from src.config import settings
-from src.db_infra import db
+from src.db_infra import db, migrations
 from loguru import logger
 from aiogram.types import Message
 
@@ -9,16 +9,14 @@ from aiogram.types import Message
 @pytest.fixture
 def get_client() -> TPay:
     """Создаем клиента T-Pay: передаем ему креды, получаем доступ к методам"""
-    return TPay(settings.tpay_term_key, settings.tpay_pass)
+    return TPay(settings.t_pay.tpay_term_key, settings.t_pay.tpay_pass)
 
 
 @pytest.fixture
 def create_tables() -> None:
-    """Тесты могут выполняться и без готовых таблиу в БД.
-    Нужно проверить, существует ли нужная таблица, и создать ее, если нет"""
-    db_name = db.Orders._meta.table_name
-    if not db.db.table_exists(db_name):
-        db.create_tables(db.db, db.Orders)
+    """Тесты могут выполняться и без готовых таблиц в БД.
+    Приводим схему к актуальной версии теми же миграциями, что и приложение"""
+    migrations.migrate(db.db)
 
 
 @pytest.fixture
@@ -1,10 +1,13 @@
 import pytest
 from src import main
+from src.app import Application
 from loguru import logger
 
 
 @pytest.mark.asyncio(loop_scope="module")
 async def test_bot():
-    result_message = await main.bot.send_message(542570177, "Бот работает")
+    result_message = await Application(main.register_handlers).bot.send_message(
+        542570177, "Бот работает"
+    )
     logger.info(f"Результат: {result_message}")
     assert result_message.message_id is not None
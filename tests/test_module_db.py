@@ -1,6 +1,14 @@
+import asyncio
+import datetime
+import inspect
+from decimal import Decimal
 from loguru import logger
+from unittest.mock import AsyncMock, patch
 from src.t_payment import models
-from src.db_infra import db
+from src.db_infra import db, migrations
+from src.db_infra.cache import OrderCache
+from src.db_infra.writer import OrderBatchWriter, PollStateWriter
+from src.config import settings
 import pytest
 
 
@@ -52,6 +60,7 @@ async def test_update_order_in_db(create_tables, new_status):
     # Получаем запись из базы вручную и сравниваем статус со статусом объекта
     received_object = await db.get_order_by_number(db_order.id)
     assert updated_order.id == received_object.id
+    assert updated_order.status == received_object.status == new_status
 
 
 @pytest.mark.asyncio(loop_scope="module")
@@ -89,6 +98,360 @@ async def test_get_all_orders_by_status(create_tables, status):
         assert order.status == status
 
 
+@pytest.mark.asyncio(loop_scope="module")
+async def test_iter_orders_by_status_pages(create_tables):
+    # Заказы приходят страницами в порядке (created, id), без повторов и пропусков
+    created = [
+        await db.add_order(
+            amount=100,
+            customer_key=542570177,
+            description="TEST ITER",
+            email="test@test",
+            status=models.StatusCode.new.value,
+        )
+        for _ in range(5)
+    ]
+    orders = [
+        order
+        async for order in db.iter_orders_by_status(
+            models.StatusCode.new.value, page_size=2
+        )
+    ]
+    keys = [(order.created, str(order.id)) for order in orders]
+    assert keys == sorted(keys)
+    assert len(set(keys)) == len(keys)
+    assert {str(order.id) for order in created} <= {key[1] for key in keys}
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_iter_orders_by_status_reads_lazily():
+    # Следующая страница запрашивается только после того, как разобрана предыдущая,
+    # а короткая страница завершает обход
+    # Строки приходят кортежами в порядке аргументов Order
+    rows = [
+        (100, 1, "test@test", "TEST ITER", None, "NEW", f"test-{i}", None, None, None)
+        for i in range(5)
+    ]
+    manager = AsyncMock()
+    manager.execute.side_effect = [rows[0:2], rows[2:4], rows[4:5]]
+    with patch.object(db, "_get_conn", return_value=manager):
+        orders = db.iter_orders_by_status(models.StatusCode.new.value, page_size=2)
+        first = await anext(orders)
+        assert manager.execute.call_count == 1
+        rest = [order async for order in orders]
+
+    assert [first.id] + [order.id for order in rest] == [row[6] for row in rows]
+    assert manager.execute.call_count == 3
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_receipt_is_written_only_when_changed():
+    # Чек из БД приходит текстом JSON и разбирается только при обращении,
+    # а в UPDATE попадает, только если его заменили
+    stored = models.Order(
+        100, 1, "test@test", receipt='{"Email": "test@test", "Items": []}', id="test-0"
+    )
+    changed = models.Order(100, 1, "test@test", id="test-1")
+    changed.receipt = {"Items": [{"Price": Decimal("100.00"), "Tax": Decimal("0.2")}]}
+    manager = AsyncMock()
+    manager.execute.return_value = []
+    with patch.object(db, "_get_conn", return_value=manager), patch.object(
+        db, "order_cache", OrderCache(ttl=0)
+    ):
+        await db.update_orders([stored, changed])
+
+    assert isinstance(stored._receipt, str)
+    assert stored.receipt == {"Email": "test@test", "Items": []}
+    assert not stored.receipt_changed
+    _, params = manager.execute.await_args.args[0].sql()
+    # Параметры заказа: id, статус, ссылка, заменен ли чек, чек, PaymentId
+    assert params[3:5] == [False, None]
+    assert params[9:11] == [True, '{"Items":[{"Price":100,"Tax":"0.2"}]}']
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_removed_receipt_is_written_by_both_update_paths():
+    # Чек, замененный на None, пишется как NULL и одиночным, и пакетным обновлением
+    order = models.Order(
+        100, 1, "test@test", receipt='{"Email": "test@test"}', id="test-0"
+    )
+    order.receipt = None
+    manager = AsyncMock()
+    manager.execute.return_value = []
+    with patch.object(db, "_get_conn", return_value=manager), patch.object(
+        db, "order_cache", OrderCache(ttl=0)
+    ):
+        await db.update_orders([order])
+        _, batch_params = manager.execute.await_args.args[0].sql()
+        await db.update_order(order)
+        single_sql, single_params = manager.execute.await_args.args[0].sql()
+
+    assert batch_params[3:5] == [True, None]
+    assert '"receipt" = %s' in single_sql
+    assert None in single_params
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_receipt_is_stored_as_jsonb(create_tables):
+    # Чек пишется в JSONB и читается обратно объектом, а обновление статуса его не трогает
+    order = await db.add_order(
+        amount=1000,
+        customer_key=542570177,
+        description="TEST RECEIPT",
+        email="test@test",
+        status=models.StatusCode.new.value,
+    )
+    order.receipt = {"Email": "test@test", "Items": [{"Price": Decimal("1000")}]}
+    updated_order = await db.update_order(order)
+    assert updated_order.receipt == {
+        "Email": "test@test",
+        "Items": [{"Price": 1000}],
+    }
+
+    updated_order.status = models.StatusCode.confirmed.value
+    assert not updated_order.receipt_changed
+    assert (await db.update_orders([updated_order]))[0].receipt == {
+        "Email": "test@test",
+        "Items": [{"Price": 1000}],
+    }
+    rows = await db._get_conn().execute(
+        db.Orders.raw(
+            'SELECT jsonb_typeof("receipt") FROM "Orders" WHERE "id" = %s', order.id
+        ).tuples()
+    )
+    assert list(rows)[0][0] == "object"
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_update_orders_in_one_query(create_tables):
+    # Создаем несколько заказов в БД
+    db_orders = [
+        await db.add_order(
+            amount=1000,
+            customer_key=542570177,
+            description="TEST BATCH UPDATE",
+            email="test@test",
+            status=models.StatusCode.created.value,
+        )
+        for _ in range(3)
+    ]
+
+    # Меняем статусы и обновляем все заказы одним запросом
+    for db_order in db_orders:
+        db_order.status = models.StatusCode.confirmed.value
+    updated_orders = await db.update_orders(db_orders)
+
+    assert {order.id for order in updated_orders} == {order.id for order in db_orders}
+    for order in updated_orders:
+        received_object = await db.get_order_by_number(order.id)
+        assert received_object.status == models.StatusCode.confirmed.value
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_order_leases(create_tables):
+    # Два процесса разбирают заказы без пересечений, а итоговый статус освобождает аренду
+    for _ in range(4):
+        await db.add_order(
+            amount=1000,
+            customer_key=542570177,
+            description="TEST LEASE",
+            email="test@test",
+            status=models.StatusCode.new.value,
+        )
+    first = await db.claim_orders("test-worker-1", 2, ttl=60)
+    second = await db.claim_orders("test-worker-2", 2, ttl=60)
+    assert len(first) == len(second) == 2
+    assert not {order.id for order in first} & {order.id for order in second}
+
+    # Чужой заказ с действующей арендой взять нельзя, свой — можно
+    assert not await db.claim_order(first[0].id, "test-worker-2", ttl=60)
+    assert await db.claim_order(first[0].id, "test-worker-1", ttl=60)
+    assert {str(order.id) for order in first} <= await db.renew_leases(
+        "test-worker-1", ttl=60
+    )
+
+    first[0].status = models.StatusCode.confirmed.value
+    assert len(await db.update_orders([first[0]])) == 1
+    assert str(first[0].id) not in await db.renew_leases("test-worker-1", ttl=60)
+    # Завершенный заказ повторно не финализируется
+    assert await db.update_orders([first[0]]) == []
+
+    # Аренда с истекшим сроком достается другому процессу
+    assert await db.renew_leases("test-worker-2", ttl=-1)
+    taken = await db.claim_orders("test-worker-1", 100, ttl=60)
+    assert {order.id for order in second} <= {order.id for order in taken}
+
+    # Прежний владелец, у которого забрали аренду, больше не пишет заказ
+    lost = second[0]
+    lost.poll_attempts = 7
+    assert await db.save_poll_states([lost], owner="test-worker-2") == 0
+    lost.status = models.StatusCode.rejected.value
+    assert await db.update_orders([lost], owner="test-worker-2") == []
+    stored = await db.get_order_by_number(lost.id)
+    assert stored.status == models.StatusCode.new.value
+    assert stored.poll_attempts == 0
+
+    # Уведомление забирает аренду и у действующего владельца
+    assert await db.claim_order(lost.id, "test-worker-2", ttl=60, force=True)
+    assert str(lost.id) not in await db.renew_leases("test-worker-1", ttl=60)
+    assert len(await db.update_orders([lost], owner="test-worker-2")) == 1
+
+    await db.release_leases("test-worker-1")
+    await db.release_leases("test-worker-2")
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_batch_writer_coalesces_updates():
+    """Изменения за окно уходят одним запросом, каждый вызывающий получает свой заказ"""
+    orders = [
+        models.Order(
+            amount=100, customer_key=542570177, email="test@test", id=f"test-{n}"
+        )
+        for n in range(3)
+    ]
+
+    async def update_orders(
+        batch: list[models.Order], owner: str | None = None
+    ) -> list[models.Order]:
+        return batch
+
+    writer = OrderBatchWriter(window=0.01)
+    with patch(
+        "src.db_infra.writer.db.update_orders", side_effect=update_orders
+    ) as mock_update:
+        # Второе изменение первого заказа перекрывает первое
+        duplicate = models.Order(
+            amount=100,
+            customer_key=542570177,
+            email="test@test",
+            id="test-0",
+            status=models.StatusCode.confirmed.value,
+        )
+        results = await asyncio.gather(
+            *(writer.update(order) for order in orders), writer.update(duplicate)
+        )
+        await writer.close()
+
+    assert mock_update.call_count == 1
+    assert len(mock_update.call_args.args[0]) == 3
+    assert results[0] is results[3] is duplicate
+    assert [order.id for order in results[1:3]] == ["test-1", "test-2"]
+    assert len(writer) == 0
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_writers_skip_orders_leased_by_another_worker():
+    """В режиме аренды пакетные записи проверяют владельца: заказ, аренду которого забрал
+    другой процесс, не перезаписывается ни статусом, ни состоянием проверок"""
+    order = models.Order(100, 1, "test@test", id="test-0")
+    manager = AsyncMock()
+    manager.execute.return_value = []
+    with (
+        patch.object(db, "_get_conn", return_value=manager),
+        patch.object(db, "order_cache", OrderCache(ttl=0)),
+        patch.object(settings.t_pay, "leasing", True),
+        patch.object(settings.t_pay, "worker_id", "test-worker-1"),
+    ):
+        assert await OrderBatchWriter(window=0).update(order) is None
+        batch_sql, batch_params = manager.execute.await_args.args[0].sql()
+        writer = PollStateWriter(window=0)
+        writer.record(order)
+        await writer.close()
+        state_sql, state_params = manager.execute.await_args.args[0].sql()
+
+    for sql, params in ((batch_sql, batch_params), (state_sql, state_params)):
+        assert "o.lease_owner IS NULL OR o.lease_owner = %s" in sql
+        assert params[-1] == "test-worker-1"
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_poll_state_writer_saves_latest_state():
+    """Состояние проверок за окно уходит одним запросом, от каждого заказа — последнее"""
+    orders = [
+        models.Order(
+            amount=100, customer_key=542570177, email="test@test", id=f"test-{n}"
+        )
+        for n in range(3)
+    ]
+    writer = PollStateWriter(window=0.01)
+    with patch(
+        "src.db_infra.writer.db.save_poll_states", AsyncMock(return_value=3)
+    ) as mock_save:
+        for order in orders:
+            writer.record(order)
+        orders[0].poll_attempts = 2
+        writer.record(orders[0])
+        await asyncio.sleep(0.05)
+        await writer.close()
+
+    mock_save.assert_awaited_once()
+    saved = mock_save.await_args.args[0]
+    assert [order.id for order in saved] == ["test-0", "test-1", "test-2"]
+    assert saved[0].poll_attempts == 2
+    assert len(writer) == 0
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_poll_state_survives_restart(create_tables):
+    """Сохраненное состояние проверок читается вместе с заказом,
+    а обход пропускает заказы, которые проверять еще рано"""
+    order = await db.add_order(
+        amount=1000,
+        customer_key=542570177,
+        description="TEST POLL STATE",
+        email="test@test",
+        status=models.StatusCode.new.value,
+    )
+    now = datetime.datetime.now()
+    order.poll_attempts = 4
+    order.last_tpay_status = "FORM_SHOWED"
+    order.last_checked_at = now
+    order.next_check_at = now + datetime.timedelta(hours=1)
+    assert await db.save_poll_states([order]) == 1
+
+    stored = await db.get_order_by_number(order.id)
+    assert stored.poll_attempts == 4
+    assert stored.last_tpay_status == "FORM_SHOWED"
+    assert stored.next_check_at == order.next_check_at
+
+    due = [
+        due_order.id
+        async for due_order in db.iter_orders_by_status(
+            models.StatusCode.new.value, due_before=now
+        )
+    ]
+    assert order.id not in due
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_pool_stats(create_tables):
+    # Параллельные запросы идут через общий пул и не выходят за его размер
+    await asyncio.gather(*(db.get_orders() for _ in range(20)))
+    stats = db.pool_stats()
+    assert stats["acquires"] >= 20
+    assert 0 < stats["size"] <= stats["max"]
+    assert stats["waiting"] == 0
+
+
+def test_open_order_index_matches_open_statuses() -> None:
+    # Условие частичного индекса из миграции совпадает с набором незавершенных статусов в запросах
+    source = inspect.getsource(migrations._create_order_indexes)
+    assert f'"status" IN {db._OPEN_STATUSES_SQL}' in source
+
+
+def test_migrations_are_idempotent(create_tables) -> None:
+    # Повторный запуск миграций ничего не меняет, а индексы для сканирования статусов на месте
+    version = migrations.current_version(db.db)
+    assert migrations.migrate(db.db) == version == migrations.MIGRATIONS[-1].version
+
+    indexes = {index.name for index in db.db.get_indexes(db.Orders._meta.table_name)}
+    assert {
+        "orders_open_status_idx",
+        "orders_payment_id_idx",
+        "orders_customer_key_idx",
+    } <= indexes
+
+
 def test_clean_database() -> None:
     # Находим все записи, где email 'test@test'
     orders_to_delete = db.Orders.select().where(db.Orders.email == "test@test")
@@ -0,0 +1,41 @@
+from unittest.mock import MagicMock, patch
+
+from src import log
+from src.db_infra import db
+from src.t_payment import models
+from loguru import logger
+
+
+def test_sample_counts_each_call_site():
+    # У каждого места вызова свой счетчик: первое сообщение проходит, дальше каждое третье
+    first = [log.sample(3) for _ in range(7)]
+    second = [log.sample(3) for _ in range(2)]
+    assert first == [True, False, False, True, False, False, True]
+    assert second == [True, False]
+    assert all(log.sample(1) for _ in range(3))
+
+
+def test_throttle_passes_once_per_interval():
+    passed = [log.throttle(60) for _ in range(5)]
+    assert passed == [True, False, False, False, False]
+    assert log.throttle(0)
+
+
+def test_hot_path_logs_are_not_formatted_above_debug():
+    """При уровне INFO строки из БД и статистика не приводятся к строке ради лога"""
+    row = (100, 1, "test@test", "TEST LOG", None, "NEW", "test-1", None, None, None)
+    stats = MagicMock(return_value={})
+
+    logger.remove()
+    logger.add(lambda message: None, level="INFO")
+    try:
+        with patch.object(models.Order, "__repr__") as order_repr:
+            [order] = db._to_orders([row])
+            logger.opt(lazy=True).debug("Stats: {}", stats)
+    finally:
+        # Возвращаем вывод логов, как его настраивает приложение
+        log.setup_logging()
+
+    assert order.status == "NEW"
+    order_repr.assert_not_called()
+    stats.assert_not_called()
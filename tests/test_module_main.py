@@ -0,0 +1,189 @@
+import asyncio
+import time
+
+import pytest
+from aiogram.types import Message
+from unittest.mock import AsyncMock, patch
+from loguru import logger
+from src import main
+from src.config import settings
+from src.polling import checker
+from src.polling.open_orders import OpenOrders
+from src.t_payment.models import Order, StatusCode
+
+# Сколько юзеров одновременно просят ссылку на оплату
+USERS = 2000
+
+# Задержка ответа TPay на Init
+TPAY_LATENCY = 0.05
+
+
+def _get_payment_message(user_id: int) -> Message:
+    """Сообщение /get_payment от юзера user_id"""
+    return Message.to_object(
+        {
+            "message_id": user_id,
+            "from": {"id": user_id, "is_bot": False, "first_name": "Иван"},
+            "chat": {"id": user_id, "type": "private"},
+            "date": 1600000000,
+            "text": "/get_payment",
+        }
+    )
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_get_payment_does_not_wait_for_polling():
+    """Тысячи /get_payment одновременно: каждый хендлер укладывается в бюджет времени,
+    юзер получает ссылку, а заказ остается на фоновой проверке, которую хендлер не ждет
+    """
+    order_ids = iter(range(1, USERS + 1))
+    paid = asyncio.Event()
+
+    async def add_order(**fields) -> Order:
+        return Order(id=next(order_ids), **fields)
+
+    async def create_order_link(order: Order) -> Order:
+        await asyncio.sleep(TPAY_LATENCY)
+        order.payment_id = str(order.id)
+        order.url = f"https://pay.test/{order.id}"
+        order.status = StatusCode.new.value
+        return order
+
+    async def poll_order(order: Order, bot, leased: bool = False) -> Order:
+        # Платеж оплатят уже после того, как все хендлеры вернутся
+        await paid.wait()
+        return order
+
+    async def handle(message: Message) -> float:
+        started = time.perf_counter()
+        await main.get_payment_link(message)
+        return time.perf_counter() - started
+
+    send_message = AsyncMock()
+    with patch("src.db_infra.db.add_order", side_effect=add_order), patch(
+        "src.db_infra.db.get_open_order", AsyncMock(return_value=None)
+    ), patch(
+        "src.db_infra.db.update_order", side_effect=lambda order: order
+    ), patch.object(
+        main.client, "create_order_link", side_effect=create_order_link
+    ), patch.object(
+        main.message_queue, "send_message", send_message
+    ), patch(
+        "src.polling.checker._poll_order", side_effect=poll_order
+    ), patch(
+        "src.main.open_orders", OpenOrders()
+    ):
+        messages = [_get_payment_message(user_id) for user_id in range(1, USERS + 1)]
+        latencies = await asyncio.gather(*(handle(message) for message in messages))
+
+        assert max(latencies) < settings.tg.handler_latency_budget
+        assert send_message.await_count == USERS
+        assert all(
+            "https://pay.test/" in call.args[1] for call in send_message.await_args_list
+        )
+        # Все заказы на фоновой проверке, ни один хендлер не ждал оплаты
+        assert len(checker.in_flight) == USERS
+
+        paid.set()
+        for _ in range(100):
+            if not len(checker.in_flight):
+                break
+            await asyncio.sleep(0.01)
+    assert len(checker.in_flight) == 0
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_double_tap_reuses_the_open_order():
+    """Повторные /get_payment юзера, пока заказ открыт, отдают ту же ссылку без нового Init,
+    а после финализации заказа создается новый"""
+    order_ids = iter(range(1, 10))
+
+    async def add_order(**fields) -> Order:
+        return Order(id=next(order_ids), **fields)
+
+    async def create_order_link(order: Order) -> Order:
+        await asyncio.sleep(TPAY_LATENCY)
+        order.url = f"https://pay.test/{order.id}"
+        order.status = StatusCode.new.value
+        return order
+
+    create_link = AsyncMock(side_effect=create_order_link)
+    send_message = AsyncMock()
+    open_orders = OpenOrders()
+    with patch("src.db_infra.db.add_order", side_effect=add_order), patch(
+        "src.db_infra.db.get_open_order", AsyncMock(return_value=None)
+    ), patch(
+        "src.db_infra.db.update_order", side_effect=lambda order: order
+    ), patch.object(
+        main.client, "create_order_link", create_link
+    ), patch.object(
+        main.message_queue, "send_message", send_message
+    ), patch(
+        "src.main.checker.track_order"
+    ) as track_order, patch(
+        "src.main.open_orders", open_orders
+    ):
+        message = _get_payment_message(42)
+        await asyncio.gather(*(main.get_payment_link(message) for _ in range(5)))
+        await main.get_payment_link(message)
+
+        assert create_link.await_count == 1
+        assert {call.args[1] for call in send_message.await_args_list} == {
+            "Link to your order: https://pay.test/1. Payment status: NEW"
+        }
+        assert open_orders.stats()["hits"] == 1
+        assert track_order.call_count == 6
+
+        paid = track_order.call_args.args[0]
+        paid.status = StatusCode.confirmed.value
+        open_orders.discard(paid)
+        await main.get_payment_link(message)
+
+    assert create_link.await_count == 2
+    assert send_message.await_args.args[1].startswith(
+        "Link to your order: https://pay.test/2."
+    )
+
+
+@pytest.mark.asyncio(loop_scope="module")
+@pytest.mark.parametrize("leasing", [False, True])
+async def test_failed_order_is_logged_and_answered(leasing):
+    """Ошибка БД при создании заказа попадает в лог, а юзер получает ответ;
+    заказ, который не записался в БД (update_order вернул None), не выдается и не отслеживается
+    """
+
+    async def create_order_link(order: Order) -> Order:
+        order.url = f"https://pay.test/{order.id}"
+        order.status = StatusCode.new.value
+        return order
+
+    errors = []
+    sink = logger.add(errors.append, level="ERROR")
+    send_message = AsyncMock()
+    try:
+        with patch.object(settings.t_pay, "leasing", leasing), patch(
+            "src.db_infra.db.add_order",
+            AsyncMock(side_effect=[ConnectionError("db is down"), Order(1, 7, "t@t")]),
+        ), patch("src.db_infra.db.get_open_order", AsyncMock(return_value=None)), patch(
+            "src.db_infra.db.update_order", AsyncMock(return_value=None)
+        ), patch.object(
+            main.client, "create_order_link", side_effect=create_order_link
+        ), patch.object(
+            main.message_queue, "send_message", send_message
+        ), patch(
+            "src.main.checker.track_order"
+        ) as track_order, patch(
+            "src.main.open_orders", OpenOrders()
+        ):
+            message = _get_payment_message(7)
+            await main.get_payment_link(message)
+            await main.get_payment_link(message)
+    finally:
+        logger.remove(sink)
+
+    [error] = [error for error in errors if "Failed to get a payment link" in error]
+    assert "db is down" in error
+    assert [call.args[1] for call in send_message.await_args_list] == [
+        "The payment service is temporarily unavailable. Please try again later."
+    ] * 2
+    track_order.assert_not_called()
@@ -0,0 +1,186 @@
+import asyncio
+import time
+
+import pytest
+from aiogram.utils.exceptions import BotBlocked, RetryAfter
+from unittest.mock import AsyncMock, patch
+from src.tg_infra.messages import MessageQueue
+
+
+class _Bot:
+    """Бот, который запоминает отправленные сообщения и время отправки.
+    errors — ошибки, которые бот выбросит на первые отправки"""
+
+    def __init__(self, errors: list[Exception] | None = None) -> None:
+        self.sent: list[tuple[float, int, str]] = []
+        self.errors = list(errors or [])
+
+    async def send_message(self, chat_id: int, text: str) -> None:
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append((time.monotonic(), chat_id, text))
+
+
+@pytest.fixture
+def no_saved_messages():
+    """В БД нет сохраненных сообщений"""
+    with patch("src.db_infra.db.take_messages", AsyncMock(return_value=[])):
+        yield
+
+
+async def _drain(queue: MessageQueue, bot: _Bot, count: int) -> None:
+    """Ждем, пока бот отправит count сообщений"""
+    for _ in range(500):
+        if len(bot.sent) >= count:
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"Only {len(bot.sent)} of {count} messages sent")
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_messages_are_paced_per_chat(no_saved_messages):
+    """Сообщения одного чата уходят по порядку и не чаще chat_interval,
+    а другой чат при этом не ждет"""
+    bot = _Bot()
+    queue = MessageQueue(rate=100, chat_interval=0.2, max_size=100)
+    for text in ("first", "second", "third"):
+        await queue.send_message(1, text)
+    await queue.send_message(2, "other")
+
+    # Постановка в очередь не ждет отправки
+    assert bot.sent == []
+    await queue.start(bot)
+    try:
+        await _drain(queue, bot, 4)
+    finally:
+        await queue.close()
+
+    first_chat = [
+        (sent_at, text) for sent_at, chat_id, text in bot.sent if chat_id == 1
+    ]
+    assert [text for _, text in first_chat] == ["first", "second", "third"]
+    assert all(
+        later - earlier >= 0.19
+        for (earlier, _), (later, _) in zip(first_chat, first_chat[1:])
+    )
+    assert [chat_id for _, chat_id, _ in bot.sent[:2]] == [1, 2]
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_retry_after_pauses_sending(no_saved_messages):
+    """Если Telegram просит подождать, отправка встает на паузу, а сообщение уходит позже;
+    сообщения заблокировавшим бота юзерам отбрасываются"""
+    bot = _Bot(errors=[RetryAfter(1), BotBlocked("Forbidden: bot was blocked")])
+    queue = MessageQueue(rate=100, chat_interval=0, max_size=100)
+    started = time.monotonic()
+    await queue.send_message(1, "paused")
+    await queue.send_message(2, "blocked")
+    await queue.send_message(3, "delivered")
+
+    await queue.start(bot)
+    try:
+        await _drain(queue, bot, 2)
+    finally:
+        await queue.close()
+
+    sent = {text: sent_at - started for sent_at, _, text in bot.sent}
+    assert sorted(sent) == ["delivered", "paused"]
+    assert sent["paused"] >= 1
+    assert queue.stats()["throttled"] == 1
+    assert queue.stats()["dropped"] == 1
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_undelivered_messages_are_persisted():
+    """Сообщения сверх размера очереди и неотправленные при остановке сохраняются в БД,
+    а после запуска поднимаются из нее и отправляются"""
+    saved = []
+
+    async def save_messages(messages: list[tuple[int, str]]) -> int:
+        saved.extend(messages)
+        return len(messages)
+
+    with patch("src.db_infra.db.save_messages", side_effect=save_messages), patch(
+        "src.db_infra.db.take_messages", AsyncMock(return_value=[])
+    ):
+        queue = MessageQueue(rate=100, chat_interval=0, max_size=2)
+        for number in range(4):
+            await queue.send_message(number, f"message {number}")
+        assert len(queue) == 2
+        await queue.close()
+
+    assert sorted(saved) == [(number, f"message {number}") for number in range(4)]
+    assert queue.stats()["persisted"] == 4
+
+    bot = _Bot()
+    take_messages = AsyncMock(side_effect=[saved[:], []])
+    with patch("src.db_infra.db.take_messages", take_messages):
+        queue = MessageQueue(rate=100, chat_interval=0, max_size=100)
+        await queue.start(bot)
+        try:
+            await _drain(queue, bot, 4)
+        finally:
+            await queue.close()
+
+    assert sorted(text for _, _, text in bot.sent) == [
+        f"message {number}" for number in range(4)
+    ]
+    assert queue.stats()["restored"] == 4
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_chat_order_survives_overflow():
+    """Сообщение чата, которое пришло, пока его более раннее сообщение лежит в БД,
+    тоже уходит в БД и отправляется после него, даже если в очереди уже есть место"""
+    stored = []
+    taking = asyncio.Event()
+    release = asyncio.Event()
+
+    async def save_messages(messages: list[tuple[int, str]]) -> int:
+        stored.extend(messages)
+        return len(messages)
+
+    async def take_messages(limit: int) -> list[tuple[int, str]]:
+        if not taking.is_set():
+            # Первый подъем из БД ждет, пока в очередь придет новое сообщение чата
+            taking.set()
+            await release.wait()
+        batch = stored[:limit]
+        del stored[:limit]
+        return batch
+
+    bot = _Bot()
+    with patch("src.db_infra.db.save_messages", side_effect=save_messages), patch(
+        "src.db_infra.db.take_messages", side_effect=take_messages
+    ):
+        queue = MessageQueue(rate=100, chat_interval=0, max_size=2)
+        await queue.send_message(1, "first")
+        await queue.send_message(2, "other")
+        # Очередь заполнена: второе сообщение первого чата уходит в БД
+        await queue.send_message(1, "second")
+        await asyncio.sleep(0.01)
+        assert stored == [(1, "second")]
+
+        await queue.start(bot)
+        try:
+            await asyncio.wait_for(taking.wait(), 1)
+            assert len(queue) < queue.max_size
+            await queue.send_message(1, "third")
+            await asyncio.sleep(0.01)
+            release.set()
+            await _drain(queue, bot, 4)
+
+            # БД опустела: новые сообщения чата снова идут в память
+            await queue.send_message(1, "fourth")
+            assert not stored
+            await _drain(queue, bot, 5)
+        finally:
+            await queue.close()
+
+    assert [text for _, chat_id, text in bot.sent if chat_id == 1] == [
+        "first",
+        "second",
+        "third",
+        "fourth",
+    ]
+    assert queue.stats()["restored"] == 2
@@ -0,0 +1,76 @@
+import pytest
+from httpx import AsyncClient
+from unittest.mock import patch
+from src import metrics
+from src.polling import checker
+from src.t_payment.models import Order
+
+
+def _sample(text: str, line: str) -> float:
+    """Значение строки метрики в тексте для Prometheus"""
+    for metric in text.splitlines():
+        if metric.startswith(line + " "):
+            return float(metric.rsplit(" ", 1)[1])
+    raise AssertionError(f"{line} not found")
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = metrics.Histogram(
+        "test_seconds", "Test latency", ("kind",), buckets=(0.1, 1)
+    )
+    metrics.REGISTRY.remove(histogram)
+    for value in (0.05, 0.5, 0.5, 5):
+        histogram.observe(value, kind='a"b')
+
+    text = histogram.render()
+    assert "# TYPE test_seconds histogram" in text
+    assert _sample(text, 'test_seconds_bucket{kind="a\\"b",le="0.1"}') == 1
+    assert _sample(text, 'test_seconds_bucket{kind="a\\"b",le="1"}') == 3
+    assert _sample(text, 'test_seconds_bucket{kind="a\\"b",le="+Inf"}') == 4
+    assert _sample(text, 'test_seconds_count{kind="a\\"b"}') == 4
+    assert _sample(text, 'test_seconds_sum{kind="a\\"b"}') == pytest.approx(6.05)
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_timed_counts_outcomes():
+    histogram = metrics.Histogram("test_call_seconds", "Test calls", ("function",))
+    counter = metrics.Counter("test_calls_total", "Test calls", ("function", "outcome"))
+    metrics.REGISTRY.remove(histogram)
+    metrics.REGISTRY.remove(counter)
+
+    @metrics.timed(histogram, counter)
+    async def fail() -> None:
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        await fail()
+    assert counter.values == {("fail", "error"): 1}
+    assert histogram.values[("fail",)][2] == 1
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_metrics_endpoint_exposes_tpay_requests(get_client):
+    """Запросы к TPay попадают в метрики по эндпоинтам, а эндпоинт отдает их в формате Prometheus"""
+    line = 'tpay_requests_total{endpoint="GetState",outcome="success"}'
+    before = _sample(metrics.render(), line) if line in metrics.render() else 0
+
+    with patch("src.t_payment.t_payment._send_request") as mock_send_request:
+        mock_send_request.return_value = {"Success": True, "Status": "NEW"}
+        order = Order(
+            amount=100, customer_key=542570177, email="test@test", payment_id="1"
+        )
+        await get_client.check_order(order)
+
+    server = metrics.MetricsServer()
+    url = await server.start(host="127.0.0.1", port=0)
+    try:
+        async with AsyncClient() as prometheus:
+            response = await prometheus.get(url)
+    finally:
+        await server.stop()
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert _sample(response.text, line) == before + 1
+    assert 'tpay_request_seconds_count{endpoint="GetState"}' in response.text
+    assert _sample(response.text, "polling_open_orders") == len(checker.in_flight)
@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+from httpx import AsyncClient
+from unittest.mock import AsyncMock, patch
+from src.polling import checker
+from src.polling.policy import FixedPolicy
+from src.polling.scheduler import PollingScheduler
+from src.t_payment import models
+from src.t_payment.models import Order
+from src.t_payment.notifications import NotificationReceiver
+from src.t_payment.t_payment import NOTIFICATION_MODE
+
+
+def _make_notification(client, status: str, token: str | None = None) -> dict:
+    """Собираем уведомление в формате TPay и подписываем его, как это делает TPay"""
+    notification = {
+        "TerminalKey": client.tpay_term_key,
+        "OrderId": "test06761d58-139d-71c3-8000-d17cc1fd2289",
+        "Success": True,
+        "Status": status,
+        "PaymentId": 5516169993,
+        "ErrorCode": "0",
+        "Amount": 100,
+        "CardId": 123,
+        "Pan": "430000******0777",
+        "ExpDate": "1122",
+        "Data": {"Route": "ACQ"},
+    }
+    notification["Token"] = token or client._generate_token(
+        notification, mode=NOTIFICATION_MODE
+    )
+    return notification
+
+
+@pytest.mark.asyncio(loop_scope="module")
+@pytest.mark.parametrize(
+    "token, response_status, delivered",
+    [(None, 200, True), ("wrong-token", 403, False)],
+)
+async def test_notification_receiver(get_client, token, response_status, delivered):
+    """Приемник принимает только уведомления с верной подписью и отвечает TPay текстом OK"""
+    received = []
+
+    async def on_notification(data: dict) -> None:
+        received.append(data)
+
+    receiver = NotificationReceiver(get_client, on_notification)
+    url = await receiver.start(host="127.0.0.1", port=0)
+    try:
+        notification = _make_notification(
+            get_client, models.StatusCode.confirmed.value, token
+        )
+        async with AsyncClient() as tpay_stand_in:
+            response = await tpay_stand_in.post(url, json=notification)
+    finally:
+        await receiver.stop()
+
+    assert response.status_code == response_status
+    assert (response.text == "OK") is delivered
+    assert bool(received) is delivered
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_notification_finalizes_polled_order(get_client):
+    """Уведомление завершает заказ один раз и снимает его с polling-проверок"""
+    order = Order(
+        amount=100,
+        customer_key=542570177,
+        email="test@test",
+        id="test06761d58-139d-71c3-8000-d17cc1fd2289",
+        payment_id="5516169993",
+        status=models.StatusCode.new.value,
+    )
+
+    async def check(order: Order) -> Order:
+        return order
+
+    async def finalize(order: Order) -> Order:
+        raise AssertionError("The order must be finalized by the notification")
+
+    scheduler = PollingScheduler(
+        check, finalize, policy=FixedPolicy(delay=60, max_attempts=3)
+    )
+    await scheduler.start()
+    polling = scheduler.submit(order)
+    notification = _make_notification(get_client, models.StatusCode.confirmed.value)
+
+    with (
+        patch("src.polling.checker.scheduler", scheduler),
+        patch("src.polling.checker.db.get_order_by_number", return_value=order),
+        patch(
+            "src.polling.checker.payment_received", new_callable=AsyncMock
+        ) as mock_received,
+    ):
+        mock_received.side_effect = lambda order, bot: order
+        result = await checker.handle_notification(notification, None)
+        # Повторное уведомление по уже завершенному заказу ничего не делает
+        await checker.handle_notification(notification, None)
+
+    polled_order = await asyncio.wait_for(polling, 1)
+    await scheduler.stop()
+
+    assert result.status == models.StatusCode.confirmed.value
+    assert polled_order is result
+    assert mock_received.call_count == 1
+    assert len(scheduler) == 0
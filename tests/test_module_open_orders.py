@@ -0,0 +1,68 @@
+import datetime
+
+import pytest
+from unittest.mock import AsyncMock, patch
+from src.polling.open_orders import OpenOrders
+from src.t_payment.models import Order, StatusCode
+
+
+def _open_order(id: int, customer_key: int, created=None) -> Order:
+    return Order(
+        amount=1000,
+        customer_key=customer_key,
+        email="test@test",
+        status=StatusCode.new.value,
+        id=str(id),
+        url=f"https://pay.test/{id}",
+        created=created,
+    )
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_open_order_from_db_is_reused_until_ttl():
+    """Открытый заказ из БД отдается без создания нового и держится в памяти,
+    пока не истечет ttl с момента его создания"""
+    created = datetime.datetime.now() - datetime.timedelta(seconds=59)
+    stored = _open_order(1, customer_key=7, created=created)
+    create = AsyncMock(return_value=_open_order(2, customer_key=7))
+    get_open_order = AsyncMock(side_effect=[stored, None])
+
+    with patch("src.db_infra.db.get_open_order", get_open_order):
+        open_orders = OpenOrders(ttl=60, max_size=10)
+        assert await open_orders.get_or_create(7, 1000, create) is stored
+        assert await open_orders.get_or_create(7, 1000, create) is stored
+        assert get_open_order.await_count == 1
+
+        # Ссылке больше ttl секунд: создаем новый заказ
+        with patch("time.monotonic", return_value=10**9):
+            assert (await open_orders.get_or_create(7, 1000, create)).id == "2"
+
+    create.assert_awaited_once()
+    assert open_orders.stats() == {
+        "hits": 1,
+        "db_hits": 1,
+        "misses": 1,
+        "evictions": 0,
+    }
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_open_orders_evict_least_recently_used():
+    """При переполнении из памяти уходит заказ, который дольше всех не запрашивали"""
+    with patch("src.db_infra.db.get_open_order", AsyncMock(return_value=None)):
+        open_orders = OpenOrders(ttl=60, max_size=2)
+        for customer_key in (1, 2):
+            await open_orders.get_or_create(
+                customer_key,
+                1000,
+                AsyncMock(return_value=_open_order(customer_key, customer_key)),
+            )
+        await open_orders.get_or_create(1, 1000, AsyncMock())
+        await open_orders.get_or_create(
+            3, 1000, AsyncMock(return_value=_open_order(3, 3))
+        )
+
+    assert len(open_orders) == 2
+    assert open_orders.stats()["evictions"] == 1
+    assert open_orders._get((2, 1000)) is None
+    assert open_orders._get((1, 1000)).id == "1"
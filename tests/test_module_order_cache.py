@@ -0,0 +1,154 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from unittest.mock import AsyncMock, patch
+from src.db_infra import db
+from src.db_infra.cache import OrderCache
+from src.polling import checker
+from src.t_payment.models import Order, StatusCode
+
+
+def _row(id: str, status: str = StatusCode.new.value, payment_id: str = "1") -> tuple:
+    """Строка заказа из БД: колонки в порядке аргументов Order"""
+    order = Order(
+        amount=1000,
+        customer_key=7,
+        email="test@test",
+        status=status,
+        id=id,
+        payment_id=payment_id,
+    )
+    return tuple(getattr(order, field) for field in Order.__slots__)
+
+
+def _conn(*results) -> SimpleNamespace:
+    """Менеджер запросов, который на каждый запрос отдает следующий набор строк"""
+    return SimpleNamespace(execute=AsyncMock(side_effect=list(results)))
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_update_replaces_the_cached_order():
+    """Чтение заполняет кэш, запись заменяет заказ в нем: после обновления
+    не отдается старый статус, а изменения объекта у вызывающего не попадают в кэш"""
+    conn = _conn(
+        [_row("order-1")], [_row("order-1", status=StatusCode.confirmed.value)]
+    )
+    with (
+        patch("src.db_infra.db.order_cache", OrderCache(ttl=60, max_size=10)),
+        patch("src.db_infra.db._get_conn", return_value=conn),
+    ):
+        order = await db.get_order_by_number("order-1")
+        assert order.status == StatusCode.new.value
+        # Статус из GetState, который еще не записан в БД
+        order.status = "FORM_SHOWED"
+        assert (await db.get_order_by_number("order-1")).status == StatusCode.new.value
+
+        order.status = StatusCode.confirmed.value
+        await db.update_order(order)
+        assert (
+            await db.get_order_by_number("order-1")
+        ).status == StatusCode.confirmed.value
+        assert (
+            await db.get_order_by_payment_id("1")
+        ).status == StatusCode.confirmed.value
+        stats = db.order_cache_stats()
+
+    assert conn.execute.await_count == 2
+    assert stats["hits"] == 3
+    assert stats["misses"] == 1
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_read_overtaken_by_update_is_not_cached():
+    """Чтение, которое началось до записи, а закончилось после, не кладет в кэш старую строку"""
+    read_started = asyncio.Event()
+    updated = asyncio.Event()
+
+    async def execute(query):
+        if not read_started.is_set():
+            read_started.set()
+            await updated.wait()
+            return [_row("order-1")]
+        if not updated.is_set():
+            updated.set()
+            return [_row("order-1", status=StatusCode.confirmed.value)]
+        return [_row("order-1", status=StatusCode.confirmed.value)]
+
+    conn = SimpleNamespace(execute=AsyncMock(side_effect=execute))
+    with (
+        patch("src.db_infra.db.order_cache", OrderCache(ttl=60, max_size=10)),
+        patch("src.db_infra.db._get_conn", return_value=conn),
+    ):
+        read = asyncio.create_task(db.get_order_by_number("order-1"))
+        await read_started.wait()
+        order = Order(
+            amount=1000,
+            customer_key=7,
+            email="test@test",
+            status=StatusCode.confirmed.value,
+            id="order-1",
+        )
+        await db.update_orders([order])
+        assert (await read).status == StatusCode.new.value
+
+        assert (
+            await db.get_order_by_number("order-1")
+        ).status == StatusCode.confirmed.value
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_finalized_elsewhere_is_invalidated():
+    """Заказ, который batch-обновление не записало (его уже завершили), уходит из кэша"""
+    conn = _conn([_row("order-1")], [], [_row("order-1", status="REJECTED")])
+    with (
+        patch("src.db_infra.db.order_cache", OrderCache(ttl=60, max_size=10)),
+        patch("src.db_infra.db._get_conn", return_value=conn),
+    ):
+        order = await db.get_order_by_number("order-1")
+        order.status = StatusCode.confirmed.value
+        assert await db.update_orders([order]) == []
+        assert (await db.get_order_by_number("order-1")).status == "REJECTED"
+        assert db.order_cache_stats()["invalidations"] == 1
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_notification_reads_past_the_cache():
+    """Уведомление читает заказ из БД, а не из кэша процесса: заказ, который уже завершил
+    другой процесс, не отменяется в TPay по устаревшему снимку в NEW"""
+    cache = OrderCache(ttl=60, max_size=10)
+    cache.put([Order(*_row("order-1"))], cache.token())
+    conn = _conn([_row("order-1", status=StatusCode.confirmed.value)])
+    notification = {
+        "Status": StatusCode.rejected.value,
+        "OrderId": "order-1",
+        "PaymentId": "1",
+    }
+    with (
+        patch("src.db_infra.db.order_cache", cache),
+        patch("src.db_infra.db._get_conn", return_value=conn),
+        patch.object(checker.client, "cancel_payment", AsyncMock()) as mock_cancel,
+    ):
+        order = await checker.handle_notification(notification, None)
+
+    assert order.status == StatusCode.confirmed.value
+    mock_cancel.assert_not_awaited()
+    # Прочитанный заказ заменил устаревший снимок в кэше
+    assert cache.get("order-1").status == StatusCode.confirmed.value
+
+
+def test_order_cache_is_bounded_and_expires():
+    """При переполнении вытесняется давно не запрошенный заказ, устаревший заказ не отдается"""
+    cache = OrderCache(ttl=60, max_size=2)
+    cache.put([Order(*_row(f"order-{n}", payment_id=str(n))) for n in (1, 2)], 0)
+    assert cache.get("order-1") is not None
+    cache.put([Order(*_row("order-3", payment_id="3"))], cache.token())
+
+    assert len(cache) == 2
+    assert cache.get("order-2") is None
+    assert cache.get_by_payment_id("2") is None
+    assert cache.stats()["evictions"] == 1
+
+    with patch("time.monotonic", return_value=10**9):
+        assert cache.get("order-1") is None
+    assert len(cache) == 1
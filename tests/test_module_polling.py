@@ -0,0 +1,354 @@
+import asyncio
+import datetime
+
+import pytest
+from unittest.mock import patch
+from src.polling import checker
+from src.polling.policy import AdaptivePolicy, FixedPolicy, LatencyHistogram
+from src.polling.registry import SingleFlight
+from src.polling.scheduler import PollingScheduler
+from src.t_payment.models import Order
+from src.t_payment import models
+
+
+def _make_order(number: int) -> Order:
+    return Order(
+        amount=100,
+        customer_key=542570177,
+        email="test@test",
+        id=f"test-{number}",
+        payment_id=str(number),
+        status=models.StatusCode.new.value,
+    )
+
+
+@pytest.mark.asyncio(loop_scope="module")
+@pytest.mark.parametrize(
+    "tpay_status, final_status, checks",
+    [
+        (models.StatusCode.confirmed.value, models.StatusCode.confirmed.value, 1),
+        (models.StatusCode.rejected.value, models.StatusCode.rejected.value, 1),
+        (models.StatusCode.new.value, models.StatusCode.max_attempts.value, 3),
+    ],
+)
+async def test_scheduler_finalizes_order(tpay_status, final_status, checks):
+    """Планировщик проверяет заказ до итогового статуса или до лимита попыток"""
+    check_calls = []
+    finalized = []
+
+    async def check(order: Order) -> Order:
+        check_calls.append(order.id)
+        order.status = tpay_status
+        return order
+
+    async def finalize(order: Order) -> Order:
+        finalized.append(order.id)
+        return order
+
+    scheduler = PollingScheduler(
+        check, finalize, policy=FixedPolicy(delay=0.01, max_attempts=3)
+    )
+    await scheduler.start()
+    try:
+        order = await asyncio.wait_for(scheduler.submit(_make_order(1)), 5)
+    finally:
+        await scheduler.stop()
+
+    assert order.status == final_status
+    assert len(check_calls) == checks
+    assert finalized == [order.id]
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_scheduler_resumes_saved_state():
+    """Состояние проверок сохраняется после каждой попытки, а заказ с сохраненным состоянием
+    (после перезапуска) проверяется в назначенное время и только оставшиеся попытки"""
+    checked_at = []
+    saved = []
+
+    async def check(order: Order) -> Order:
+        checked_at.append(datetime.datetime.now())
+        order.status = "FORM_SHOWED"
+        return order
+
+    async def finalize(order: Order) -> Order:
+        return order
+
+    def record(order: Order) -> None:
+        saved.append((order.poll_attempts, order.next_check_at, order.last_tpay_status))
+
+    policy = FixedPolicy(delay=0.01, max_attempts=3)
+    scheduler = PollingScheduler(check, finalize, policy=policy, record=record)
+    await scheduler.start()
+    try:
+        await asyncio.wait_for(scheduler.submit(_make_order(1)), 5)
+        assert [(attempts, status) for attempts, _, status in saved] == [
+            (1, "FORM_SHOWED"),
+            (2, "FORM_SHOWED"),
+        ]
+        assert all(next_check_at is not None for _, next_check_at, _ in saved)
+
+        # Процесс перезапустился после второй попытки: осталась одна проверка
+        checked_at.clear()
+        order = _make_order(2)
+        order.poll_attempts = 2
+        due = datetime.datetime.now() + datetime.timedelta(seconds=0.1)
+        order.next_check_at = due
+        order = await asyncio.wait_for(scheduler.submit(order), 5)
+    finally:
+        await scheduler.stop()
+
+    assert len(checked_at) == 1
+    assert checked_at[0] >= due
+    assert order.poll_attempts == 3
+    assert order.status == models.StatusCode.max_attempts.value
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_scheduler_bounds_concurrency():
+    """Сколько бы заказов ни было, одновременно выполняется не больше проверок, чем воркеров"""
+    workers = 4
+    in_flight = 0
+    max_in_flight = 0
+
+    async def check(order: Order) -> Order:
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.001)
+        in_flight -= 1
+        order.status = models.StatusCode.confirmed.value
+        return order
+
+    async def finalize(order: Order) -> Order:
+        return order
+
+    scheduler = PollingScheduler(
+        check,
+        finalize,
+        workers=workers,
+        queue_size=2,
+        policy=FixedPolicy(delay=0.01, max_attempts=3),
+    )
+    await scheduler.start()
+    try:
+        futures = [scheduler.submit(_make_order(number)) for number in range(500)]
+        orders = await asyncio.wait_for(asyncio.gather(*futures), 10)
+    finally:
+        await scheduler.stop()
+
+    assert len(orders) == 500
+    assert max_in_flight <= workers
+    assert len(scheduler) == 0
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_scheduler_survives_check_errors():
+    """Ошибка запроса — это неудачная попытка, а не остановка polling"""
+    attempts = 0
+
+    async def check(order: Order) -> Order:
+        nonlocal attempts
+        attempts += 1
+        if attempts == 1:
+            raise ConnectionError("TPay is unavailable")
+        order.status = models.StatusCode.confirmed.value
+        return order
+
+    async def finalize(order: Order) -> Order:
+        return order
+
+    scheduler = PollingScheduler(
+        check, finalize, policy=FixedPolicy(delay=0.01, max_attempts=3)
+    )
+    await scheduler.start()
+    try:
+        order = await asyncio.wait_for(scheduler.submit(_make_order(1)), 5)
+    finally:
+        await scheduler.stop()
+
+    assert order.status == models.StatusCode.confirmed.value
+    assert attempts == 2
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_scheduler_pauses_while_gate_is_closed():
+    """Пока TPay недоступен (gate не пропускает), проверки не идут и не тратят попытки"""
+    available = asyncio.Event()
+    attempts = 0
+
+    async def check(order: Order) -> Order:
+        nonlocal attempts
+        attempts += 1
+        order.status = models.StatusCode.confirmed.value
+        return order
+
+    async def finalize(order: Order) -> Order:
+        return order
+
+    scheduler = PollingScheduler(
+        check,
+        finalize,
+        policy=FixedPolicy(delay=0.01, max_attempts=3),
+        gate=available.wait,
+    )
+    await scheduler.start()
+    try:
+        future = scheduler.submit(_make_order(1))
+        await asyncio.sleep(0.05)
+        assert attempts == 0 and not future.done()
+
+        available.set()
+        order = await asyncio.wait_for(future, 5)
+    finally:
+        await scheduler.stop()
+
+    assert order.status == models.StatusCode.confirmed.value
+    assert attempts == 1
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_single_flight_attaches_duplicates():
+    """Повторные вызовы по любому из ключей получают результат уже идущей задачи"""
+    registry = SingleFlight()
+    started = 0
+    release = asyncio.Event()
+
+    async def poll() -> str:
+        nonlocal started
+        started += 1
+        await release.wait()
+        return "done"
+
+    first = registry.run(["order:1"], poll)
+    second = registry.run(["order:1", "payment:1"], poll)
+    third = registry.run(["payment:1"], poll)
+    assert len(registry) == 1
+
+    release.set()
+    assert await asyncio.gather(first, second, third) == ["done"] * 3
+    assert started == 1
+    assert "order:1" not in registry and "payment:1" not in registry
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_order_is_polled_once():
+    """Хендлер и фоновая проверка не запускают второй polling того же заказа"""
+    order = _make_order(1)
+    release = asyncio.Event()
+
+    async def poll_order(order: Order, bot) -> Order:
+        await release.wait()
+        order.status = models.StatusCode.confirmed.value
+        return order
+
+    with patch("src.polling.checker._poll_order", side_effect=poll_order) as mock_poll:
+        handler_check = asyncio.ensure_future(checker.check_order_status(order, None))
+        await asyncio.sleep(0)
+        assert checker.is_tracked(order)
+        checker.track_order(_make_order(1), None)
+        duplicate_check = asyncio.ensure_future(checker.check_order_status(order, None))
+
+        release.set()
+        results = await asyncio.gather(handler_check, duplicate_check)
+
+    assert mock_poll.call_count == 1
+    assert results[0] is results[1]
+    assert not checker.is_tracked(order)
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_new_orders_are_taken_from_db_notifications():
+    """Заказы из уведомлений БД берутся на отслеживание, а обрыв подписки
+    переводит фоновую проверку на частый полный обход"""
+    orders = {f"test-{number}": _make_order(number) for number in (1, 2)}
+    orders["test-2"].status = models.StatusCode.confirmed.value
+    taken = []
+    notified = asyncio.Event()
+
+    async def listen_new_orders():
+        yield []
+        assert checker.listening
+        yield ["test-1", "test-2", "test-1"]
+        notified.set()
+        raise ConnectionError("The DB connection is lost")
+
+    async def get_orders_by_ids(ids: list[str]) -> list[Order]:
+        return [orders[order_id] for order_id in ids]
+
+    with patch.object(checker.db, "listen_new_orders", listen_new_orders), patch.object(
+        checker.db, "get_orders_by_ids", side_effect=get_orders_by_ids
+    ), patch.object(
+        checker, "track_order", side_effect=lambda order, bot: taken.append(order.id)
+    ):
+        listener = asyncio.create_task(checker._listen_new_orders(None))
+        await asyncio.wait_for(notified.wait(), 1)
+        await asyncio.sleep(0)
+        listener.cancel()
+
+    assert taken == ["test-1"]
+    assert not checker.listening
+    assert checker._reconcile_interval() == (
+        checker.settings.t_pay.reconcile_fallback_interval
+    )
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_lost_leases_are_detached():
+    """Заказ, аренду которого забрал другой процесс, снимается с проверок этого процесса"""
+    scheduler = PollingScheduler(
+        _finalize_unexpectedly,
+        _finalize_unexpectedly,
+        policy=FixedPolicy(delay=60, max_attempts=3),
+    )
+    owned, lost = _make_order(1), _make_order(2)
+    owned_future = scheduler.submit(owned)
+    lost_future = scheduler.submit(lost)
+
+    async def renew_leases(owner: str, ttl: int) -> set[str]:
+        renewed.set()
+        return {str(owned.id)}
+
+    renewed = asyncio.Event()
+    with patch.object(checker, "scheduler", scheduler), patch.object(
+        checker.db, "renew_leases", side_effect=renew_leases
+    ), patch.object(checker.settings.t_pay, "lease_ttl", 0.03):
+        renewing = asyncio.create_task(checker._renew_leases())
+        await asyncio.wait_for(renewed.wait(), 1)
+        await asyncio.sleep(0)
+        renewing.cancel()
+
+    assert lost_future.cancelled()
+    assert not owned_future.done()
+    assert scheduler.order_ids() == [str(owned.id)]
+
+
+async def _finalize_unexpectedly(order: Order) -> Order:
+    raise AssertionError("The scheduler is not started in this test")
+
+
+def test_adaptive_policy_fast_start_and_deadline():
+    """Сначала проверяем часто, потом реже, а после дедлайна перестаем"""
+    policy = AdaptivePolicy(
+        tiers=[(60, 3), (300, 10)], deadline=1800, jitter=0, max_interval=120
+    )
+    assert policy.next_delay(1, 0) == 3
+    assert policy.next_delay(10, 100) == 10
+    assert policy.next_delay(50, 1000) == 120
+    assert policy.next_delay(60, 1790) == 10
+    assert policy.next_delay(61, 1800) is None
+
+
+def test_adaptive_policy_tunes_tiers_by_latency():
+    """После набора статистики ступени встают на медиану и 90-й перцентиль времени оплаты"""
+    histogram = LatencyHistogram()
+    policy = AdaptivePolicy(
+        tiers=[(60, 3)], deadline=1800, jitter=0, min_samples=10, histogram=histogram
+    )
+    for latency in [20] * 8 + [200] * 2:
+        policy.observe(latency)
+
+    (median, fast_interval), (p90, slow_interval) = policy.tiers
+    assert 20 <= median < 30 and 200 <= p90 < 300
+    assert fast_interval < slow_interval
+    assert policy.interval(median / 2) == fast_interval
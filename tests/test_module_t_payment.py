@@ -1,9 +1,16 @@
 from src.t_payment.models import Order
 from src.t_payment import models
+from src.t_payment.limiter import RateLimiter
+from src.t_payment.resilience import CircuitBreaker, CircuitOpenError
+from src.t_payment.t_payment import TPayError
+from src.config import settings
 import pytest
 from unittest.mock import patch
+import httpx
 from loguru import logger
+import asyncio
 import json
+import time
 
 
 @pytest.mark.asyncio(loop_scope="module")
@@ -217,3 +224,274 @@ async def test_cancel_order(get_client, amount, customer_key, email, id, payment
         # Отменяем заказ после теста и проверяем совпадение статусов изначального и возвращенного заказов
         canceled_order = await get_client.cancel_payment(test_order)
         assert canceled_order.status is not models.StatusCode.cancelled.value
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_connection_pool_lifecycle(get_client):
+    """Все запросы клиента идут через один пул соединений, который закрывается вместе с клиентом"""
+    with patch("src.t_payment.t_payment._send_request") as mock_send_request:
+        mock_send_request.return_value = {"Success": True, "Status": "NEW"}
+        test_order = Order(
+            amount=100, customer_key=542570177, email="test@test", payment_id="1"
+        )
+
+        async with get_client as client:
+            await client.check_order(test_order)
+            await client.check_order(test_order)
+            http_clients = {call.args[2] for call in mock_send_request.call_args_list}
+            assert len(http_clients) == 1
+
+        assert http_clients.pop().is_closed
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_limiter_serves_priority_first():
+    """Когда места заняты, первым проходит запрос с более высоким приоритетом (Init)"""
+    limiter = RateLimiter("test", rate=0, burst=1, max_in_flight=1)
+    order_of_service = []
+
+    async def request(name: str, priority: int) -> None:
+        async with limiter.limit(priority):
+            order_of_service.append(name)
+
+    await limiter.acquire()
+    background = [asyncio.create_task(request(f"GetState {n}", 2)) for n in range(3)]
+    await asyncio.sleep(0)
+    init = asyncio.create_task(request("Init", 0))
+    await asyncio.sleep(0)
+    assert limiter.stats()["queued"] == 4
+
+    limiter.release()
+    await asyncio.gather(init, *background)
+    assert order_of_service[0] == "Init"
+    assert limiter.stats()["delayed"] == 4
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_limiter_rate():
+    """Токен-бакет пропускает всплеск burst, а дальше — rate запросов в секунду"""
+    limiter = RateLimiter("test", rate=100, burst=2, max_in_flight=0)
+
+    async def request() -> None:
+        async with limiter.limit():
+            pass
+
+    started = time.monotonic()
+    await asyncio.gather(*(request() for _ in range(7)))
+
+    assert time.monotonic() - started >= 0.045
+    assert limiter.stats()["requests"] == 7
+    assert limiter.stats()["delayed"] == 5
+
+
+def test_order_is_slotted_with_unique_default_ids():
+    """У каждого заказа свой id по умолчанию, а сам объект — без __dict__"""
+    first = Order(amount=100, customer_key=542570177, email="test@test")
+    second = Order(amount=100, customer_key=542570177, email="test@test")
+    assert first.id != second.id
+    assert not hasattr(first, "__dict__")
+    assert repr(first).startswith("Order(amount=100, customer_key=542570177, ")
+
+    # Строка из БД в порядке __slots__ превращается в заказ без именованных аргументов
+    row = tuple(getattr(first, field) for field in Order.__slots__)
+    assert repr(Order(*row)) == repr(first)
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_transient_errors_are_retried(get_client):
+    """Сетевая ошибка и таймаут повторяются, ответ TPay с ошибкой — нет"""
+    test_order = Order(
+        amount=100, customer_key=542570177, email="test@test", payment_id="1"
+    )
+    with (
+        patch.object(settings.t_pay, "retry_base_delay", 0.001),
+        patch("src.t_payment.t_payment._send_request") as mock_send_request,
+    ):
+        mock_send_request.side_effect = [
+            httpx.ConnectError("Connection refused"),
+            asyncio.TimeoutError(),
+            {"Success": True, "Status": "CONFIRMED"},
+        ]
+        order = await get_client.cancel_payment(test_order)
+        assert order.status == "CONFIRMED"
+        assert mock_send_request.call_count == 3
+
+        mock_send_request.reset_mock(side_effect=True)
+        mock_send_request.return_value = {
+            "Success": False,
+            "ErrorCode": "8",
+            "Message": "Неверный статус транзакции",
+        }
+        with pytest.raises(TPayError):
+            await get_client.cancel_payment(test_order)
+        assert mock_send_request.call_count == 1
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_init_is_retried_only_when_not_created(get_client):
+    """Init повторяется сразу, если запрос точно не дошел до TPay. После таймаута ответа —
+    только если CheckOrder не нашел платежа по заказу, иначе повтор создал бы второй платеж
+    """
+    created = {
+        "Success": True,
+        "Status": "NEW",
+        "PaymentId": "1",
+        "PaymentURL": "https://securepayments.tinkoff.ru/test",
+    }
+    get_client._breaker = CircuitBreaker(
+        "test", failure_threshold=10, reset_timeout=1, max_reset_timeout=1
+    )
+
+    def tpay(init_errors: list, payments: list):
+        """Ответы TPay: Init сначала падает с init_errors, CheckOrder отвечает платежами payments"""
+
+        async def send_request(endpoint, params=None, client=None):
+            if endpoint == models.Endpoints.check_order.value:
+                return {
+                    "Success": True,
+                    "OrderId": params["OrderId"],
+                    "Payments": payments,
+                }
+            if init_errors:
+                raise init_errors.pop(0)
+            return created
+
+        return send_request
+
+    with (
+        patch.object(settings.t_pay, "retry_base_delay", 0.001),
+        patch("src.t_payment.t_payment._send_request") as mock_send_request,
+    ):
+        # Соединение не установлено: TPay запрос не получал, CheckOrder не нужен
+        mock_send_request.side_effect = tpay(
+            [httpx.ConnectError("Connection refused")], []
+        )
+        order = await get_client.create_order_link(
+            Order(amount=100, customer_key=542570177, email="test@test")
+        )
+        assert order.payment_id == "1"
+        assert [call.args[0] for call in mock_send_request.call_args_list] == [
+            "Init",
+            "Init",
+        ]
+
+        # Ответа нет, но платежа по заказу в TPay тоже нет: повторяем
+        mock_send_request.reset_mock()
+        mock_send_request.side_effect = tpay([httpx.ReadTimeout("Timed out")], [])
+        order = await get_client.create_order_link(
+            Order(amount=100, customer_key=542570177, email="test@test")
+        )
+        assert order.payment_id == "1"
+        assert [call.args[0] for call in mock_send_request.call_args_list] == [
+            "Init",
+            "CheckOrder",
+            "Init",
+        ]
+
+        # TPay создал платеж, хотя ответ не дошел: второй Init не отправляем
+        mock_send_request.reset_mock()
+        mock_send_request.side_effect = tpay(
+            [httpx.ReadTimeout("Timed out")], [{"PaymentId": "1", "Status": "NEW"}]
+        )
+        with pytest.raises(httpx.ReadTimeout):
+            await get_client.create_order_link(
+                Order(amount=100, customer_key=542570177, email="test@test")
+            )
+        assert [call.args[0] for call in mock_send_request.call_args_list] == [
+            "Init",
+            "CheckOrder",
+        ]
+
+        # Проверить не удалось: считаем, что платеж мог создаться, и тоже не повторяем
+        mock_send_request.reset_mock()
+        mock_send_request.side_effect = [
+            httpx.HTTPStatusError(
+                "Bad Gateway",
+                request=httpx.Request("POST", "Init"),
+                response=httpx.Response(502),
+            ),
+            httpx.ReadTimeout("Timed out"),
+        ]
+        with (
+            patch.object(settings.t_pay, "check_order_attempts", 1),
+            pytest.raises(httpx.HTTPStatusError),
+        ):
+            await get_client.create_order_link(
+                Order(amount=100, customer_key=542570177, email="test@test")
+            )
+        assert mock_send_request.call_count == 2
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_circuit_breaker_opens_and_recovers(get_client):
+    """После серии ошибок запросы не отправляются, а после паузы пробный запрос возвращает работу"""
+    test_order = Order(
+        amount=100, customer_key=542570177, email="test@test", payment_id="1"
+    )
+    get_client._breaker = CircuitBreaker(
+        "test", failure_threshold=2, reset_timeout=0.05, max_reset_timeout=1
+    )
+    with (
+        patch.object(settings.t_pay, "get_state_attempts", 1),
+        patch("src.t_payment.t_payment._send_request") as mock_send_request,
+    ):
+        mock_send_request.side_effect = httpx.ReadTimeout("Timed out")
+        for _ in range(2):
+            with pytest.raises(httpx.ReadTimeout):
+                await get_client.check_order(test_order)
+        assert get_client.breaker_stats()["state"] == CircuitBreaker.OPEN
+
+        # Пока автомат открыт, запросы не уходят в TPay
+        with pytest.raises(CircuitOpenError):
+            await get_client.check_order(test_order)
+        assert mock_send_request.call_count == 2
+
+        mock_send_request.side_effect = None
+        mock_send_request.return_value = {"Success": True, "Status": "NEW"}
+        await asyncio.wait_for(get_client.wait_available(), 1)
+        order = await get_client.check_order(test_order)
+
+    assert order.status == "NEW"
+    assert get_client.breaker_stats()["state"] == CircuitBreaker.CLOSED
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_cancelled_probe_is_released(get_client):
+    """Отмененный пробный запрос не оставляет автомат занятым: следующий запрос проходит"""
+    test_order = Order(
+        amount=100, customer_key=542570177, email="test@test", payment_id="1"
+    )
+    get_client._breaker = CircuitBreaker(
+        "test", failure_threshold=1, reset_timeout=0.01, max_reset_timeout=1
+    )
+    sent = asyncio.Event()
+
+    async def hang(*args, **kwargs):
+        sent.set()
+        await asyncio.Event().wait()
+
+    with (
+        patch.object(settings.t_pay, "get_state_attempts", 1),
+        patch("src.t_payment.t_payment._send_request") as mock_send_request,
+    ):
+        mock_send_request.side_effect = httpx.ReadTimeout("Timed out")
+        with pytest.raises(httpx.ReadTimeout):
+            await get_client.check_order(test_order)
+        await asyncio.wait_for(get_client.wait_available(), 1)
+
+        # Пробный запрос отменяют, пока он ждет ответа TPay
+        mock_send_request.side_effect = hang
+        probe = asyncio.create_task(get_client.check_order(test_order))
+        await asyncio.wait_for(sent.wait(), 1)
+        assert get_client.breaker_stats()["state"] == CircuitBreaker.HALF_OPEN
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+        mock_send_request.side_effect = None
+        mock_send_request.return_value = {"Success": True, "Status": "NEW"}
+        await asyncio.wait_for(get_client.wait_available(), 1)
+        order = await get_client.check_order(test_order)
+
+    assert order.status == "NEW"
+    assert get_client.breaker_stats()["state"] == CircuitBreaker.CLOSED